@@ -4,13 +4,27 @@ For this app to work, two environment variables need to be set:
 `PFIN_SERVER`: The endpoint leading to the MongoDB server.
 `PFIN_SECRET`: A secret key used by Flask.
 
+The app is built by `create_app`, e.g. `flask --app app run`.
+Importing this module doesn't connect to the database.
+
 """
 
+import os
 import logging
+import hashlib
 
 import pfin
 
-from flask import Flask, session, redirect, render_template, url_for, request
+from pfin.sessions import SessionStore, SQLiteBackend
+from pfin.export import iter_ndjson, iter_zip
+from pfin.image import image_structure
+from pfin.similarity import SimilarityIndex
+from pfin.cache import LRUCache
+from pfin.serving import MappedFiles, image_response
+from pfin.metrics import enable_command_metrics, instrument_app
+from flask import Flask, Blueprint, Response, current_app, session, redirect, render_template, url_for, request, \
+    jsonify, abort, stream_with_context, make_response
+from markupsafe import Markup
 from flask_login import LoginManager, login_required, login_user, logout_user, current_user
 
 from functools import wraps
@@ -21,17 +35,82 @@ from functools import wraps
 ##############
 
 
-app = Flask(__name__)
+views = Blueprint('views', __name__)
+login_manager = LoginManager()
 
-# Get Flask secret
-PFIN_SERVER = pfin.config.PFIN_SERVER
-PFIN_SECRET = pfin.config.PFIN_SECRET
 
-if PFIN_SECRET == "" or PFIN_SERVER == "":
-    raise ValueError('Please set your configuration variables. '
-                     'They are needed to run the server.')
+def create_app(in_memory: bool = False, index_text: bool = False, track_rights: bool = False,
+               watch_changes: bool = False, session_path: str = '.cache/pfin/sessions.sqlite3',
+               metrics: bool = False, slow_query_threshold: float = 0.1) -> Flask:
+    """
+    Creates the app, and the databases it uses.
+    By default, the images are only read from the database: the in-memory structures,
+    which each worker builds before serving requests and keeps up to date, are enabled one by one.
+
+    :param bool in_memory: Whether to load the images in memory, see `ImageDatabase`.
+    :param bool index_text: Whether to rank the results of the "name" field by relevance, see `pfin.fulltext`.
+                            Otherwise, the text is searched in the ids only.
+    :param bool track_rights: Whether to flag the images whose rights end, while the app runs, see `pfin.rights`.
+                              Otherwise, `python -m pfin.rights sync` is to be scheduled.
+    :param bool watch_changes: Whether to follow the changes made by the other processes (e.g. `pfin.ingest`)
+                               in a background thread, see `ImageDatabase.watch_changes`.
+    :param str session_path: Path of the session store, shared by the workers.
+    :param bool metrics: Whether to time the requests and the database commands, see `pfin.metrics`.
+                         They are then exposed at `/metrics`.
+    :param float slow_query_threshold: With `metrics`, the duration in seconds above which
+                                       a database command is logged with its query plan.
+    """
+    app = Flask(__name__)
+    pfin.configure_logging()
+
+    # The listener must be registered before the database client is created.
+    command_metrics = enable_command_metrics(slow_query_threshold) if metrics else None
+
+    # Get Flask secret
+    PFIN_SERVER = pfin.config.PFIN_SERVER
+    PFIN_SECRET = pfin.config.PFIN_SECRET
+
+    if PFIN_SECRET == "" or PFIN_SERVER == "":
+        raise ValueError('Please set your configuration variables. '
+                         'They are needed to run the server.')
+
+    app.config['SECRET_KEY'] = PFIN_SECRET.encode()
+
+    if pfin.ImageDatabase.persistent_cache or pfin.UserDatabase.persistent_cache:
+        # The workers would share the file of the disk tier, which isn't locked.
+        raise ValueError('The persistent cache is for a single process, it must be disabled in the app')
+
+    # Both databases share the same client, see `pfin.database.get_client`.
+    app.extensions['pfin'] = {
+        'image_db': pfin.ImageDatabase('PFIN', 'images', in_memory=in_memory, index_text=index_text,
+                                       track_rights=track_rights),
+        'user_db': pfin.UserDatabase('PFIN', 'users'),
+        # Loaded on the first "more like this" request. Built with `python -m pfin.similarity build`.
+        'similarity_index': None,
+        # Shared by the workers of the machine.
+        'sessions': SessionStore(SQLiteBackend(session_path)),
+        # Rendered grids of images, by catalog version and search, see `home`.
+        'fragments': LRUCache(max_size=256, ttl=3600),
+        # Image files served by `images`, when the app hosts them.
+        'image_files': MappedFiles(max_files=256),
+    }
+    if watch_changes:
+        # The changes made by the other processes change the ETags of the pages.
+        app.extensions['pfin']['image_db'].watch_changes()
+    # Part of the ETags, so that they change when the templates do.
+    app.extensions['pfin']['templates_digest'] = hashlib.sha256(b''.join(
+        app.jinja_env.loader.get_source(app.jinja_env, name)[0].encode() for name in ('index.html', 'grid.html')
+    )).hexdigest()
 
-app.config['SECRET_KEY'] = PFIN_SECRET.encode()
+    if command_metrics is not None:
+        client = app.extensions['pfin']['image_db']._client
+        command_metrics.explain = lambda database_name, command: client[database_name].command(
+            'explain', command, verbosity='queryPlanner')
+        instrument_app(app)
+
+    login_manager.init_app(app)
+    app.register_blueprint(views)
+    return app
 
 
 ##################
@@ -39,8 +118,19 @@ app.config['SECRET_KEY'] = PFIN_SECRET.encode()
 ##################
 
 
-image_db = pfin.ImageDatabase('PFIN', 'images')
-user_db = pfin.UserDatabase('PFIN', 'users')
+def get_image_db() -> pfin.ImageDatabase:
+    return current_app.extensions['pfin']['image_db']
+
+
+def get_user_db() -> pfin.UserDatabase:
+    return current_app.extensions['pfin']['user_db']
+
+
+def get_similarity_index() -> SimilarityIndex:
+    extension = current_app.extensions['pfin']
+    if extension['similarity_index'] is None:
+        extension['similarity_index'] = SimilarityIndex.load()
+    return extension['similarity_index']
 
 
 ###################
@@ -48,17 +138,13 @@ user_db = pfin.UserDatabase('PFIN', 'users')
 ###################
 
 
-login_manager = LoginManager()
-login_manager.init_app(app)
-
-
-authenticated_users = {}
+def get_sessions() -> SessionStore:
+    return current_app.extensions['pfin']['sessions']
 
 
 @login_manager.user_loader
 def load_user(user_identifier):
-    if user_identifier in authenticated_users:
-        return authenticated_users[user_identifier]
+    return get_sessions().get(user_identifier)
 
 
 def permissions_required(group_id):
@@ -106,43 +192,173 @@ def require_login(func):
 ##########
 
 
-@app.route('/')
+@views.route('/')
 def home():
-    return render_template('index.html', image_db=image_db, user=current_user)
+    """
+    Renders the images matching the search passed in the arguments.
+    The grid is cached by catalog version and search, and the page carries an ETag,
+    so that a client having it up to date gets a "304 Not Modified" without any search.
+    """
+    image_db = get_image_db()
+    extension = current_app.extensions['pfin']
 
+    # The page depends on the images, on the arguments, and on the user (see the navigation bar).
+    user_key = (current_user.get_id(), current_user.name) if current_user.is_authenticated else None
+    etag = hashlib.sha256(repr((extension['templates_digest'], image_db.version,
+                                request.query_string, user_key)).encode()).hexdigest()
 
-@app.route('/sort', methods=['GET', 'POST'])
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        f = image_db.create_filter_from_args(request.args)
+        key = (image_db.version, f.plan())
+        grid = extension['fragments'].get(key)
+        if grid is None:
+            images = image_db.search(f, limit=12, fields=['id', 'extension', 'tags'])
+            grid = Markup(render_template('grid.html', images=images))
+            extension['fragments'].set(key, grid)
+        response = make_response(render_template('index.html', user=current_user, grid=grid))
+
+    response.set_etag(etag)
+    # Revalidated on each visit, and not shared between users.
+    response.headers['Cache-Control'] = 'private, no-cache'
+    response.vary.add('Cookie')
+    return response
+
+
+@views.route('/sort', methods=['GET', 'POST'])
 def sort():
-    return render_template('sort.html', image_db=image_db, user=current_user)
+    image_db = get_image_db()
+    # Counts of each choice of the form, among the images matching the current search.
+    facets = image_db.facet_counts(image_db.create_filter_from_args(request.args))
+    return render_template('sort.html', image_db=image_db, user=current_user, facets=facets)
+
+
+@views.route('/api/images')
+def images_page():
+    """
+    Returns a page of the images matching the filter passed in the arguments, as JSON.
+    The `next_cursor` value is passed as the `cursor` argument to get the next page.
+    """
+    image_db = get_image_db()
+    try:
+        page_size = min(int(request.args.get('page_size', 12)), 100)
+    except ValueError:
+        abort(400)
+    f = image_db.create_filter_from_args(request.args)
+    try:
+        images, next_cursor = image_db.search_page(f, request.args.get('cursor'), page_size=page_size,
+                                                   fields=['id', 'extension', 'tags'])
+    except ValueError:
+        abort(400)
+
+    page = []
+    for img in images:
+        full_url, thumb_url = img.get_url()
+        page.append({'id': img.id, 'extension': img.extension, 'tags': img.tags,
+                     'full': full_url, 'thumb': thumb_url})
+    return jsonify(images=page, next_cursor=next_cursor)
+
+
+@views.route('/similar/<image_id>')
+def similar(image_id):
+    """
+    Returns the images looking the most like a given one, as JSON.
+    """
+    try:
+        k = min(int(request.args.get('k', 12)), 100)
+    except ValueError:
+        abort(400)
+    try:
+        index = get_similarity_index()
+    except FileNotFoundError:
+        # The index was not built.
+        abort(503)
+    try:
+        matches = dict(index.similar(image_id, k))
+    except KeyError:
+        abort(404)
+    except ValueError:
+        abort(400)
+
+    results = []
+    for img in get_image_db().get_images(list(matches), fields=['id', 'extension', 'tags']):
+        full_url, thumb_url = img.get_url()
+        results.append({'id': img.id, 'extension': img.extension, 'tags': img.tags,
+                        'full': full_url, 'thumb': thumb_url, 'similarity': matches[img.id]})
+    return jsonify(images=results)
+
+
+@views.route('/export.ndjson')
+@login_required
+def export_ndjson():
+    """
+    Streams the metadata of all the images matching the filter passed in the arguments, as NDJSON.
+    """
+    image_db = get_image_db()
+    f = image_db.create_filter_from_args(request.args)
+    fields = [field for field in image_structure if field != '_id']
+    chunks = iter_ndjson(image_db.iter_search(f, fields=fields), fields)
+    return Response(stream_with_context(chunks), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': 'attachment; filename="images.ndjson"'})
+
+
+@views.route('/export.zip')
+@login_required
+def export_zip():
+    """
+    Streams a ZIP archive of the original files of the images matching the filter passed in the arguments.
+    """
+    image_db = get_image_db()
+    f = image_db.create_filter_from_args(request.args)
+    images_dir = os.path.join(current_app.static_folder, 'images', 'fulls')
+    chunks = iter_zip(image_db.iter_search(f, fields=['id', 'extension']), images_dir)
+    return Response(stream_with_context(chunks), mimetype='application/zip',
+                    headers={'Content-Disposition': 'attachment; filename="images.zip"'})
+
+
+@views.route('/images/<size>/<file_name>')
+def images(size: str, file_name: str):
+    """
+    Serves the image files in `static/images`, when `IMAGE_HOST_URL` is `/images/`.
+    See `pfin.serving`.
+    """
+    images_dir = os.path.join(current_app.static_folder, 'images')
+    response = image_response(request, current_app.extensions['pfin']['image_files'], images_dir, size, file_name)
+    if response is None:
+        abort(404)
+    return response
 
 
-@app.route('/login', methods=['POST'])
+@views.route('/login', methods=['POST'])
 def login():
     email = request.form.get('email')
     password = request.form.get('password')
 
-    user = user_db.login_user(email, password)
+    user = get_user_db().login_user(email, password)
     if user is not None:
         # Logged in successfully.
         login_user(user)
-        global authenticated_users
-        authenticated_users.update({user.get_id(): user})
+        get_sessions().set(user)
         return redirect('/')
     else:
         return redirect('/')
 
 
-@app.route('/dashboard')
+@views.route('/dashboard')
 @login_required
 def dashboard():
     return render_template('dashboard.html', user=current_user)
 
 
-@app.route('/logout')
+@views.route('/logout')
 def logout():
+    user_id = current_user.get_id()
+    if user_id is not None:
+        get_sessions().delete(user_id)
     logout_user()
     return redirect('/')
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
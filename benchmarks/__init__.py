@@ -0,0 +1,13 @@
+"""
+
+Benchmarks of the `pfin` package.
+Each module can be run on its own, e.g. `python -m benchmarks.filter_compile`.
+
+`benchmarks.suite` times the main operations on a synthetic catalog
+generated by `benchmarks.synthetic`, in mongomock or in a local `mongod`,
+and stores the results as JSON, to compare them from run to run:
+
+    python -m benchmarks.suite --output before.json
+    python -m benchmarks.suite --compare before.json
+
+"""
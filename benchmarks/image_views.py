@@ -0,0 +1,94 @@
+"""
+
+Benchmark of the construction of search results.
+
+Compares building full `Image` objects from decoded documents,
+to building `ImageView` objects over raw BSON documents restricted
+to the fields displayed by the grid.
+
+Usage: python -m benchmarks.image_views [--count N]
+
+"""
+
+import bson
+import time
+import argparse
+import logging
+import tracemalloc
+
+from bson.raw_bson import RawBSONDocument
+
+from pfin.image import ImageView, build_images, validate_projection
+
+
+grid_fields = ['id', 'extension', 'tags']
+
+
+def make_document(i: int) -> dict:
+    return {
+        '_id': bson.ObjectId(),
+        'id': f'{i:064x}',
+        'extension': 'jpg',
+        'type': 'PassionFroid',
+        'product_in': True,
+        'human_in': False,
+        'institutional': True,
+        'format': False,
+        'credits': 'Studio',
+        'limited_usage': False,
+        'copyright': False,
+        'usage_end': '',
+        'tags': ['glace', 'dessert', 'été'],
+    }
+
+
+def measure(build) -> tuple:
+    """
+    Returns the time taken by `build`, in milliseconds,
+    and the memory held by its result, in kilobytes.
+    """
+    start = time.perf_counter()
+    build()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    result = build()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return elapsed * 1000, size / 1024
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--count', type=int, default=10000, help='Number of result objects to build.')
+    args = parser.parse_args()
+
+    # Silence the validation messages.
+    logging.disable(logging.WARNING)
+
+    # What the driver receives, for a full query and for a projected one.
+    documents = [make_document(i) for i in range(args.count)]
+    full = [bson.encode(d) for d in documents]
+    projected = [bson.encode({k: d[k] for k in ['_id'] + grid_fields}) for d in documents]
+
+    def build_full_images():
+        return build_images([bson.decode(data) for data in full])
+
+    def build_views():
+        projection = validate_projection(grid_fields)
+        views = [ImageView(RawBSONDocument(data), projection) for data in projected]
+        # Access what the grid displays.
+        for view in views:
+            view.tags
+        return views
+
+    full_time, full_memory = measure(build_full_images)
+    view_time, view_memory = measure(build_views)
+
+    print(f'{args.count} objects')
+    print(f'{"Image":<10} {full_time:>8.1f} ms {full_memory:>10.0f} KiB')
+    print(f'{"ImageView":<10} {view_time:>8.1f} ms {view_memory:>10.0f} KiB')
+
+
+if __name__ == '__main__':
+    main()
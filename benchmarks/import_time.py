@@ -0,0 +1,93 @@
+"""
+
+Benchmark of the import time of the package, with `python -X importtime`.
+
+Each statement is run in a fresh interpreter, and is charged with the modules it imports,
+those imported by the interpreter's startup aside. The lightweight ones (`Filter`, `User`)
+must stay within a budget, as they are used by the CLI tools and the workers:
+the benchmark fails when they don't, e.g. when a module eagerly imports pymongo, NumPy or Pillow.
+
+Usage: python -m benchmarks.import_time [--budget MS] [--repeat N] [--top N]
+
+"""
+
+import sys
+import argparse
+import statistics
+import subprocess
+
+from typing import Dict, List, Tuple
+
+
+# Statements timed, by name, and whether they are held to the budget.
+statements: Dict[str, Tuple[str, bool]] = {
+    'import pfin': ('import pfin', True),
+    'pfin.Filter': ('import pfin; pfin.Filter', True),
+    'pfin.User': ('import pfin; pfin.User', True),
+    'pfin.Image': ('import pfin; pfin.Image', False),
+    'pfin.ImageDatabase': ('import pfin; pfin.ImageDatabase', False),
+    'import app': ('import app', False),
+}
+
+
+def import_times(code: str) -> List[Tuple[str, int, int]]:
+    """
+    Runs code in a new interpreter, and returns the modules it imported.
+
+    :return list: The modules, in import order, with their nesting level and cumulative time in microseconds.
+    """
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            capture_output=True, text=True, check=True).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        level = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), level, int(cumulative)))
+    return modules
+
+
+def statement_time(code: str, startup: set) -> Tuple[float, List[Tuple[str, int]]]:
+    """
+    Returns the time taken by the imports of code, in milliseconds,
+    and its top-level imports with their cumulative time in microseconds.
+
+    :param set startup: The modules imported by the interpreter's startup, which are not counted.
+    """
+    top_level = [(name, cumulative) for name, level, cumulative in import_times(code)
+                 if level == 0 and name not in startup]
+    return sum(cumulative for _, cumulative in top_level) / 1e3, top_level
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--budget', type=float, default=75.0,
+                        help='Maximum import time of the lightweight statements, in milliseconds.')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of runs of each statement, the median is kept.')
+    parser.add_argument('--top', type=int, default=5, help='Number of the heaviest imports shown per statement.')
+    args = parser.parse_args()
+
+    startup = {name for name, _, _ in import_times('pass')}
+
+    over_budget = []
+    for name, (code, budgeted) in statements.items():
+        runs = [statement_time(code, startup) for _ in range(args.repeat)]
+        median = statistics.median(total for total, _ in runs)
+        mark = ''
+        if budgeted:
+            mark = 'ok' if median <= args.budget else f'OVER {args.budget:.0f} ms'
+            if median > args.budget:
+                over_budget.append(name)
+        print(f'{name:<30} {median:10.1f} ms  {mark}')
+        heaviest = sorted(runs[-1][1], key=lambda item: item[1], reverse=True)[:args.top]
+        if heaviest:
+            print('    ' + ', '.join(f'{module} {cumulative / 1e3:.1f}' for module, cumulative in heaviest))
+
+    if over_budget:
+        print(f'Over the budget of {args.budget:.0f} ms: {", ".join(over_budget)}')
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""
+
+Benchmark of the login throughput, with a local MongoDB stand-in (mongomock).
+
+Logs in with a mix of valid credentials, wrong passwords and unknown addresses,
+drawn from a small working set as in real traffic, and reports the number of
+logins per second and of database lookups, for:
+- no cache (the previous behaviour) ;
+- the positive and negative caches ;
+- the caches and the Bloom filter.
+
+The stand-in answers much faster than a remote server: with one,
+each avoided lookup saves a full round trip.
+
+Usage: python -m benchmarks.login [--users N] [--attempts N]
+
+"""
+
+import time
+import random
+import argparse
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=2000, help='Number of users in the collection.')
+    parser.add_argument('--attempts', type=int, default=5000, help='Number of login attempts.')
+    args = parser.parse_args()
+
+    from pfin import database
+    from benchmarks.synthetic import connect, populate
+
+    client = connect()
+    populate(client, images=0, users=args.users)
+
+    # Count the lookups reaching the database.
+    lookups = {'count': 0}
+    collection = client.PFIN.users
+    find_one = collection.find_one
+
+    def counting_find_one(*a, **k):
+        lookups['count'] += 1
+        return find_one(*a, **k)
+
+    collection.find_one = counting_find_one
+
+    rng = random.Random(0)
+    attempts = []
+    for _ in range(args.attempts):
+        i = rng.randrange(min(args.users, 500))
+        kind = rng.random()
+        if kind < 0.5:
+            attempts.append((f'user{i}@example.com', f'password{i}'))
+        elif kind < 0.7:
+            attempts.append((f'user{i}@example.com', 'wrong'))
+        else:
+            # Unknown addresses, e.g. credential stuffing: mostly different ones.
+            attempts.append((f'nobody{rng.randrange(args.attempts)}@example.com', 'password'))
+
+    configurations = {
+        'no cache': {'user_cache_size': 0, 'negative_cache_size': 0, 'use_bloom_filter': False},
+        'caches': {'use_bloom_filter': False},
+        'caches + Bloom filter': {'use_bloom_filter': True},
+    }
+    for name, settings in configurations.items():
+        database.close_clients()
+        user_db = database.UserDatabase('PFIN', 'users')
+        for key, value in settings.items():
+            setattr(user_db, key, value)
+        user_db._preprocess()
+        if user_db.use_bloom_filter:
+            user_db.load_bloom_filter()
+
+        lookups['count'] = 0
+        start = time.perf_counter()
+        for email, password in attempts:
+            user_db.login_user(email, password)
+        elapsed = time.perf_counter() - start
+        print(f'{name:<25} {len(attempts) / elapsed:10.0f} logins/s {lookups["count"]:8d} lookups')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+"""
+
+Benchmark of the near-duplicate lookup of `pfin.phash.PerceptualIndex`.
+
+Indexes random 64-bit hashes, along with slightly altered copies of some of them,
+and measures the time of a Hamming-radius query, compared to a vectorized scan of all the hashes.
+Exits with an error if a query takes longer than the budget.
+
+Usage: python -m benchmarks.near_duplicates [--size N] [--radius R] [--budget MS]
+
+"""
+
+import sys
+import random
+import argparse
+import timeit
+import numpy as np
+
+from pfin.phash import PerceptualIndex, _popcount
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=100_000, help='Number of indexed hashes.')
+    parser.add_argument('--radius', type=int, default=6, help='Radius of the queries, in bits.')
+    parser.add_argument('--budget', type=float, default=3, help='Maximum time of a query, in milliseconds.')
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    hashes = [rng.getrandbits(64) for _ in range(args.size)]
+    index = PerceptualIndex()
+    for key, value in enumerate(hashes):
+        index.add(key, value)
+    array = np.array(hashes, dtype=np.uint64)
+
+    # Queries are altered copies of indexed hashes, at the edge of the radius.
+    queries = []
+    for value in rng.sample(hashes, 100):
+        for bit in rng.sample(range(64), args.radius):
+            value ^= 1 << bit
+        queries.append(value)
+
+    for value in queries:
+        expected = np.flatnonzero(_popcount(array ^ np.uint64(value)) <= args.radius).tolist()
+        assert sorted(key for key, _ in index.query(value, args.radius)) == expected
+
+    def run_index():
+        for value in queries:
+            index.query(value, args.radius)
+
+    def run_scan():
+        for value in queries:
+            np.flatnonzero(_popcount(array ^ np.uint64(value)) <= args.radius)
+
+    indexed = min(timeit.repeat(run_index, number=1, repeat=5)) / len(queries) * 1e3
+    scanned = min(timeit.repeat(run_scan, number=1, repeat=5)) / len(queries) * 1e3
+    print(f'{args.size} hashes, radius {args.radius}: '
+          f'index {indexed:.3f} ms, full scan {scanned:.3f} ms per query')
+    if indexed > args.budget:
+        print(f'Over the budget of {args.budget} ms')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
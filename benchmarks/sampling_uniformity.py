@@ -0,0 +1,110 @@
+"""
+
+Statistical check of the uniformity of the random image sampling.
+
+Draws `--size` images `--rounds` times from a synthetic collection,
+counts how many times each image was drawn, and runs a chi-squared
+goodness-of-fit test against the uniform distribution.
+Both the in-memory catalog and the collection (with a local MongoDB stand-in,
+mongomock) are checked, with and without an additional filter.
+
+Exits with a non-zero status if one of the samplers is not uniform.
+
+Usage: python -m benchmarks.sampling_uniformity [--images N] [--size K] [--rounds R]
+
+"""
+
+import sys
+import math
+import random
+import argparse
+import numpy as np
+
+from collections import Counter
+
+from pfin.catalog import ColumnarCatalog
+from pfin.sampling import sample_catalog, sample_collection
+
+
+# z-score of the significance level (one-sided, alpha = 0.001).
+z_alpha = 3.09
+
+
+def chi2_critical(degrees: int) -> float:
+    """
+    Approximation of the critical value of the chi-squared distribution (Wilson-Hilferty).
+    """
+    k = 2 / (9 * degrees)
+    return degrees * (1 - k + z_alpha * math.sqrt(k)) ** 3
+
+
+def check(name: str, draw, population: list, size: int, rounds: int) -> bool:
+    """
+    Runs the test on a sampler and prints the result.
+
+    :param draw: Function returning a list of drawn documents.
+    :param list population: The `id`s which can be drawn.
+    """
+    counts = Counter()
+    for _ in range(rounds):
+        drawn = [document['id'] for document in draw()]
+        assert len(drawn) == len(set(drawn)) == min(size, len(population)), 'Invalid sample'
+        counts.update(drawn)
+    assert set(counts) <= set(population), 'Drew an image not matching the filter'
+
+    expected = rounds * min(size, len(population)) / len(population)
+    statistic = sum((counts[i] - expected) ** 2 / expected for i in population)
+    critical = chi2_critical(len(population) - 1)
+    uniform = statistic < critical
+    print(f'{name:<30} chi2={statistic:10.1f} critical={critical:8.1f} '
+          f'{"uniform" if uniform else "NOT UNIFORM"}')
+    return uniform
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=200, help='Number of images in the collection.')
+    parser.add_argument('--size', type=int, default=10, help='Number of images drawn per round.')
+    parser.add_argument('--rounds', type=int, default=2000, help='Number of rounds.')
+    args = parser.parse_args()
+
+    documents = [{'_id': i, 'id': f'{i:05d}', 'product_in': 'true' if i % 3 else 'false', 'tags': []}
+                 for i in range(args.images)]
+    everything = [document['id'] for document in documents]
+    with_product = [document['id'] for document in documents if document['product_in'] == 'true']
+    query = {'product_in': 'true'}
+
+    results = []
+
+    catalog = ColumnarCatalog(documents)
+    rng = np.random.default_rng(0)
+    results.append(check('catalog', lambda: sample_catalog(catalog, {}, args.size, rng),
+                         everything, args.size, args.rounds))
+    results.append(check('catalog, filtered', lambda: sample_catalog(catalog, query, args.size, rng),
+                         with_product, args.size, args.rounds))
+
+    try:
+        import mongomock
+    except ImportError:
+        print('mongomock is not installed, skipping the collection sampler')
+    else:
+        collection = mongomock.MongoClient().db.images
+        collection.insert_many([dict(document) for document in documents])
+        # Keep it fast: the stand-in sampler is much slower than a server.
+        rounds = args.rounds // 4
+        results.append(check('collection', lambda: sample_collection(collection, {}, args.size),
+                             everything, args.size, rounds))
+        results.append(check('collection, filtered', lambda: sample_collection(collection, query, args.size),
+                             with_product, args.size, rounds))
+
+    # The previous implementation, shuffling the first `5 * limit` documents, for reference.
+    check('legacy (first 5 * limit)',
+          lambda: random.sample(documents[:args.size * 5], args.size),
+          everything, args.size, args.rounds)
+
+    if not all(results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+
+Benchmark of the startup of the app, with a local MongoDB stand-in (mongomock).
+
+Measures:
+- the import of `app`, in a fresh interpreter: it must not touch the database ;
+- `create_app`, with and without the in-memory catalog ;
+- the creation of many `Database` instances, sharing the registry's client,
+  compared to the previous behaviour (a new client, and the names listed, for each one).
+
+The stand-in answers instantly: with a remote server, each avoided round trip
+(listing the names, connecting a new client) saves tens of milliseconds more.
+
+Usage: python -m benchmarks.startup [--images N] [--instances N]
+
+"""
+
+import sys
+import time
+import argparse
+import subprocess
+
+
+def import_time() -> float:
+    """
+    Returns the time taken to import `app` in a new interpreter, in milliseconds.
+    """
+    code = 'import time; start = time.perf_counter(); import app; print(time.perf_counter() - start)'
+    output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+    return float(output.strip().splitlines()[-1]) * 1e3
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=10000, help='Number of images in the collection.')
+    parser.add_argument('--instances', type=int, default=100, help='Number of Database instances created.')
+    args = parser.parse_args()
+
+    print(f'{"import app":<40} {import_time():10.1f} ms')
+
+    import app
+    from pfin import database
+    from benchmarks.synthetic import connect, populate
+
+    # Every client created by the package is the stand-in.
+    client = connect()
+    populate(client, images=args.images, users=1)
+
+    for in_memory in (False, True):
+        database.close_clients()
+        start = time.perf_counter()
+        app.create_app(in_memory=in_memory)
+        print(f'{f"create_app(in_memory={in_memory})":<40} {(time.perf_counter() - start) * 1e3:10.1f} ms')
+
+    database.close_clients()
+    start = time.perf_counter()
+    for _ in range(args.instances):
+        database.UserDatabase('PFIN', 'users').get_user_information('user0@example.com')
+    shared = (time.perf_counter() - start) * 1e3
+
+    calls = {'clients': 0}
+
+    def new_client(*a, **k):
+        calls['clients'] += 1
+        return client
+
+    database.Database.client_factory = new_client
+    start = time.perf_counter()
+    for _ in range(args.instances):
+        # The previous behaviour: a new client, and the names checked, for each instance.
+        database.close_clients()
+        database.UserDatabase('PFIN', 'users').get_user_information('user0@example.com')
+    legacy = (time.perf_counter() - start) * 1e3
+    print(f'{f"{args.instances} instances, shared client":<40} {shared:10.1f} ms')
+    print(f'{f"{args.instances} instances, a client each":<40} {legacy:10.1f} ms '
+          f'({calls["clients"]} clients, {2 * calls["clients"]} listings)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+
+Benchmark suite of the main operations, on a synthetic catalog (see `benchmarks.synthetic`).
+
+Times:
+- `Filter.forge_query` ;
+- `ImageDatabase.search` and `get_x_random_images`, with the in-memory catalog and with the database ;
+- `ImageDatabase.facet_counts`, with the in-memory catalog and with the database ;
+- `ImageDatabase.search` of a text, ranked with the full-text index ;
+- `UserDatabase.login_user` ;
+- a render of `index.html`, through Flask's test client, and its revalidation with its ETag.
+
+The results are written as JSON. Passing the results of a previous run with `--compare`
+prints the ratio of each timing, and exits with an error if one regressed beyond `--threshold`.
+
+Usage: python -m benchmarks.suite [--images N] [--users N] [--uri URI] [--repeat N]
+                                  [--output FILE] [--compare FILE] [--threshold RATIO]
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+
+from typing import Callable, Dict
+
+from benchmarks.synthetic import connect, populate
+
+
+results_folder: str = '.cache/pfin/benchmarks/'
+
+
+def measure(func: Callable, repeat: int, number: int = 1) -> Dict[str, float]:
+    """
+    Calls a function `repeat` times `number` times, and returns statistics
+    of the time per call, in milliseconds.
+    """
+    func()  # Warm up.
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        timings.append((time.perf_counter() - start) / number * 1e3)
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'mean': statistics.fmean(timings),
+    }
+
+
+def run(args) -> Dict[str, Dict[str, float]]:
+    import pfin
+    import app
+
+    client = connect(args.uri)
+    start = time.perf_counter()
+    populate(client, images=args.images, users=args.users)
+    print(f'Generated the collections in {time.perf_counter() - start:.1f} s')
+
+    filters = {
+        'empty': pfin.Filter(),
+        'form': pfin.Filter(text_filter='a', product_in='true', human_in='false', institutional='true'),
+        'tags': pfin.Filter(product_in='true', tags=['glace', 'été']),
+    }
+    results = {}
+
+    for name, f in filters.items():
+        results[f'forge_query[{name}]'] = measure(f.forge_query, args.repeat, number=1000)
+
+    for in_memory in (True, False):
+        image_db = pfin.ImageDatabase('PFIN', 'images', in_memory=in_memory)
+        # Measure the queries themselves, not the result cache.
+        image_db.cache_size = 0
+        image_db._preprocess()
+        where = 'catalog' if in_memory else 'database'
+        for name, f in filters.items():
+            results[f'search[{where}, {name}]'] = measure(lambda: image_db.search(f, limit=12), args.repeat)
+        results[f'search[{where}, form, projected]'] = measure(
+            lambda: image_db.search(filters['form'], limit=12, fields=['id', 'extension', 'tags']), args.repeat)
+        results[f'get_x_random_images[{where}]'] = measure(lambda: image_db.get_x_random_images(12), args.repeat)
+        results[f'facet_counts[{where}, form]'] = measure(lambda: image_db.facet_counts(filters['form']), args.repeat)
+
+    image_db = pfin.ImageDatabase('PFIN', 'images', in_memory=True, index_text=True)
+    image_db.cache_size = 0
+    image_db._preprocess()
+    for text in ('glace', 'studio lum', 'a'):
+        results[f'search[text index, {text!r}]'] = measure(
+            lambda: image_db.search(pfin.Filter(text_filter=text), limit=12), args.repeat)
+
+    user_db = pfin.UserDatabase('PFIN', 'users')
+    rng = random.Random(0)
+
+    def login():
+        i = rng.randrange(args.users)
+        assert user_db.login_user(f'user{i}@example.com', f'password{i}') is not None
+
+    results['login_user'] = measure(login, args.repeat, number=10)
+
+    flask_app = app.create_app(in_memory=True, session_path=os.path.join(results_folder, 'sessions.sqlite3'))
+    test_client = flask_app.test_client()
+
+    def render():
+        response = test_client.get('/?product_in=yes&human_in=no')
+        assert response.status_code == 200
+
+    results['render index.html'] = measure(render, args.repeat)
+
+    etag = test_client.get('/?product_in=yes&human_in=no').headers['ETag']
+
+    def revalidate():
+        response = test_client.get('/?product_in=yes&human_in=no', headers={'If-None-Match': etag})
+        assert response.status_code == 304
+
+    results['revalidate index.html'] = measure(revalidate, args.repeat)
+    return results
+
+
+def revision() -> str or None:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: dict, previous: dict, threshold: float) -> bool:
+    """
+    Prints the ratio of each median timing to the previous one.
+
+    :return bool: Whether none of them regressed beyond the threshold.
+    """
+    ok = True
+    for name, timing in results.items():
+        before = previous.get(name)
+        if before is None:
+            continue
+        ratio = timing['median'] / before['median'] if before['median'] else float('inf')
+        regressed = ratio > threshold
+        ok = ok and not regressed
+        print(f'{name:<45} {before["median"]:10.3f} -> {timing["median"]:10.3f} ms  x{ratio:5.2f}'
+              f'{"  REGRESSION" if regressed else ""}')
+    return ok
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=10000, help='Number of images.')
+    parser.add_argument('--users', type=int, default=1000, help='Number of users.')
+    parser.add_argument('--uri', default=None,
+                        help='Connection string of a local server. Defaults to mongomock. '
+                             'Its PFIN database is replaced.')
+    parser.add_argument('--repeat', type=int, default=20, help='Number of measures per operation.')
+    parser.add_argument('--output', default=None, help='File in which to write the results.')
+    parser.add_argument('--compare', default=None, help='Results of a previous run to compare to.')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='Ratio to the previous median above which a timing is a regression.')
+    args = parser.parse_args()
+
+    logging.disable(logging.INFO)
+    results = run(args)
+
+    for name, timing in results.items():
+        print(f'{name:<45} {timing["median"]:10.3f} ms (min {timing["min"]:.3f})')
+
+    report = {
+        'revision': revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'stand_in': 'mongomock' if args.uri is None else 'server',
+        'images': args.images,
+        'users': args.users,
+        'results': results,
+    }
+    output = args.output or os.path.join(results_folder, f'results-{time.strftime("%Y%m%d-%H%M%S")}.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w') as fl:
+        json.dump(report, fl, indent=2)
+    print(f'Results written to {output!r}')
+
+    if args.compare is not None:
+        with open(args.compare) as fl:
+            previous = json.load(fl)
+        if (previous['images'], previous['users']) != (args.images, args.users):
+            print('Warning: the previous run used collections of different sizes')
+        if not compare(results, previous['results'], args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
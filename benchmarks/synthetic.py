@@ -0,0 +1,136 @@
+"""
+
+Synthetic `images` and `users` collections, following `image_structure` and `user_structure`,
+in a local MongoDB stand-in (mongomock) or in a local `mongod`.
+
+Usage: python -m benchmarks.synthetic [--images N] [--users N] [--uri URI]
+    Fills the `PFIN` database of a local server (by default `mongodb://localhost:27017/`).
+
+"""
+
+import random
+import argparse
+import logging
+
+from typing import Iterator
+
+from pfin import database
+from pfin.indexes import ensure_indexes, image_indexes, user_indexes
+from pfin.image import image_structure
+from pfin.user import user_structure
+from pfin.rights import is_usable
+from pfin.utils import hash_password
+
+
+types = ['PassionFroid', 'Fournisseur', 'Logo']
+authors = ['Studio Lumière', 'Jean Dupont', 'Amélie Martin', 'Agence Nord', 'Photothèque']
+vocabulary = ['glace', 'dessert', 'été', 'poisson', 'viande', 'fromage', 'café', 'pain', 'plage',
+              'restaurant', 'chef', 'cuisine', 'légumes', 'fruits', 'boisson', 'camion', 'entrepôt',
+              'équipe', 'produit', 'surgelé', 'chocolat', 'vanille', 'fraise', 'mer', 'montagne']
+groups = ['guest', 'regional', 'national']
+
+# Number of documents inserted per request.
+batch_size = 10000
+
+
+def make_image(i: int, rng: random.Random) -> dict:
+    """
+    Returns the document of the i-th synthetic image.
+    """
+    limited = rng.random() < 0.2
+    document = {
+        'id': f'{rng.getrandbits(256):064x}',
+        'extension': 'jpg' if rng.random() < 0.9 else 'png',
+        'type': rng.choice(types),
+        'product_in': rng.random() < 0.5,
+        'human_in': rng.random() < 0.3,
+        'institutional': rng.random() < 0.4,
+        'format': rng.random() < 0.35,
+        'credits': rng.choice(authors),
+        'limited_usage': limited,
+        'copyright': limited,
+        'usage_end': f'{rng.randint(2020, 2030)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}' if limited else '',
+        'tags': rng.sample(vocabulary, rng.randint(0, 5)),
+        'phash': f'{rng.getrandbits(64):016x}',
+    }
+    document['usable'] = is_usable(document)
+    assert document.keys() == image_structure.keys() - {'_id'}
+    return document
+
+
+def make_user(i: int) -> dict:
+    """
+    Returns the document of the i-th synthetic user.
+    Its address is `user<i>@example.com`, and its password `password<i>`.
+    """
+    document = {
+        'name': f'User {i}',
+        'email': f'user{i}@example.com',
+        'password': hash_password(f'password{i}'),
+        'group': groups[i % len(groups)],
+    }
+    assert document.keys() == user_structure.keys() - {'_id'}
+    return document
+
+
+def _batches(documents: Iterator[dict]) -> Iterator[list]:
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def populate(client, images: int = 10000, users: int = 1000, seed: int = 0) -> None:
+    """
+    Replaces the `PFIN.images` and `PFIN.users` collections of a client with synthetic documents.
+    """
+    rng = random.Random(seed)
+    db = client.get_database('PFIN')
+    db.drop_collection('images')
+    db.drop_collection('users')
+    for batch in _batches(make_image(i, rng) for i in range(images)):
+        db.images.insert_many(batch, ordered=False)
+    for batch in _batches(make_user(i) for i in range(users)):
+        db.users.insert_many(batch, ordered=False)
+    ensure_indexes(db.images, image_indexes)
+    ensure_indexes(db.users, user_indexes)
+    logging.info(f'Generated {images} images and {users} users')
+
+
+def connect(uri: str = None):
+    """
+    Returns a client of a local server, or a mongomock client if no URI is passed,
+    and makes it the client of all the `Database` instances.
+    """
+    if uri is None:
+        import mongomock
+
+        client = mongomock.MongoClient()
+        # mongomock doesn't support raw BSON documents.
+        database.ImageDatabase.raw_codec_options = None
+    else:
+        import pymongo
+
+        client = pymongo.MongoClient(uri)
+    database.close_clients()
+    database.Database.client_factory = lambda *args, **kwargs: client
+    return client
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=10000, help='Number of images.')
+    parser.add_argument('--users', type=int, default=1000, help='Number of users.')
+    parser.add_argument('--uri', default='mongodb://localhost:27017/', help='Connection string of the server.')
+    args = parser.parse_args()
+
+    populate(connect(args.uri), images=args.images, users=args.users)
+    print(f'Generated {args.images} images and {args.users} users')
+
+
+if __name__ == '__main__':
+    main()
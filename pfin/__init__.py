@@ -1,14 +1,55 @@
-import sys
-import logging
+"""
 
-from .utils import *
-from .config import *
-from .user import User
-from .image import Image
-from .filter import Filter
-from .database import ImageDatabase, UserDatabase
+The public names of the package are imported on first access,
+so that `import pfin` stays cheap: a tool needing only `Filter` or `User`
+doesn't load pymongo, NumPy or Pillow (see `benchmarks.import_time`).
 
-__all__ = ['User', 'Image', 'Filter', 'ImageDatabase', 'UserDatabase']
+Logging isn't configured on import: the entry points (the app, the CLIs)
+call `configure_logging`.
+
+"""
+
+import importlib
+
+__all__ = ['User', 'Image', 'Filter', 'ImageDatabase', 'UserDatabase', 'configure_logging']
+
+
+# Public name -> submodule defining it.
+_lazy_names = {
+    'User': 'user',
+    'Image': 'image',
+    'Filter': 'filter',
+    'ImageDatabase': 'database',
+    'UserDatabase': 'database',
+    # Formerly star-imported from `utils` and `config`.
+    **dict.fromkeys(['validation_counters', 'compile_validator', 'validate_batch', 'validate_fields',
+                     'hash_password', 'hash_file', 'encode_base64', 'encode_json', 'decode_json'], 'utils'),
+    **dict.fromkeys(['PFIN_SERVER', 'PFIN_SECRET', 'SALT', 'IMAGE_HOST_URL'], 'config'),
+}
+
+
+def __getattr__(name: str):
+    """
+    Imports a public name, or a submodule (e.g. `pfin.config`), on first access.
+    """
+    module_name = _lazy_names.get(name)
+    if module_name is not None:
+        value = getattr(importlib.import_module(f'.{module_name}', __name__), name)
+    else:
+        try:
+            value = importlib.import_module(f'.{name}', __name__)
+        except ModuleNotFoundError as e:
+            if e.name != f'{__name__}.{name}':
+                # A dependency of the submodule is missing.
+                raise
+            raise AttributeError(f'module {__name__!r} has no attribute {name!r}') from None
+    # Later accesses don't go through `__getattr__`.
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_lazy_names))
 
 
 ###########
@@ -16,21 +57,31 @@ __all__ = ['User', 'Image', 'Filter', 'ImageDatabase', 'UserDatabase']
 ###########
 
 
-logging_level = logging.DEBUG
+def configure_logging(level: int = None) -> None:
+    """
+    Logs the records of the root logger to the standard output.
+    Calling it again only changes the level.
+
+    :param int level: The logging level, `logging.DEBUG` by default.
+    """
+    import sys
+    import logging
 
-logger = logging.getLogger()
-logger.setLevel(logging_level)
+    level = logging.DEBUG if level is None else level
+    logger = logging.getLogger()
+    logger.setLevel(level)
 
-formatter = logging.Formatter('%(asctime)s - [%(levelname)s] %(message)s')
-formatter.datefmt = '%m/%d/%Y %H:%M:%S'
+    for handler in logger.handlers:
+        if getattr(handler, '_pfin', False):
+            handler.setLevel(level)
+            return
 
-# fh = logging.FileHandler(filename='C:/Temp/pfin.log', mode='w')
-# fh.setLevel(logging_level)
-# h.setFormatter(formatter)
+    formatter = logging.Formatter('%(asctime)s - [%(levelname)s] %(message)s')
+    formatter.datefmt = '%m/%d/%Y %H:%M:%S'
 
-sh = logging.StreamHandler(sys.stdout)
-sh.setLevel(logging_level)
-sh.setFormatter(formatter)
+    sh = logging.StreamHandler(sys.stdout)
+    sh.setLevel(level)
+    sh.setFormatter(formatter)
+    sh._pfin = True
 
-# logger.addHandler(fh)
-logger.addHandler(sh)
+    logger.addHandler(sh)
@@ -0,0 +1,53 @@
+import math
+
+from hashlib import blake2b
+from typing import Iterable
+
+
+class BloomFilter:
+
+    """
+
+    Probabilistic set: `x in bloom` is always True if `x` was added,
+    and False for most of the other values, with a rate of false positives
+    close to `error_rate` as long as at most `capacity` values are added.
+    Values can't be removed.
+
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        """
+        :param int capacity: The expected number of values.
+        :param float error_rate: The expected rate of false positives, at capacity.
+        """
+        capacity = max(capacity, 1)
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    @classmethod
+    def from_values(cls, values: Iterable[str], error_rate: float = 0.01, headroom: float = 2) -> 'BloomFilter':
+        """
+        Builds a filter holding values, sized for `headroom` times their number.
+        """
+        values = list(values)
+        bloom = cls(int(len(values) * headroom), error_rate)
+        for value in values:
+            bloom.add(value)
+        return bloom
+
+    def _positions(self, value: str) -> Iterable[int]:
+        # Double hashing: the k positions are derived from two 64-bit hashes.
+        digest = blake2b(value.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hashes))
+
+    def add(self, value: str) -> None:
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, value: str) -> bool:
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
@@ -0,0 +1,203 @@
+import os
+import time
+import shelve
+import logging
+import threading
+
+from hashlib import sha256
+from collections import OrderedDict
+
+
+class LRUCache:
+
+    """
+
+    Bounded, in-memory cache.
+    When full, the least recently used entry is evicted,
+    and entries older than `ttl` seconds are considered expired.
+
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300, clock=time.monotonic):
+        """
+        :param int max_size: The maximum number of entries.
+        :param float ttl: The time-to-live of an entry, in seconds. None for no expiration.
+        :param clock: Function returning the current time, in seconds.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()  # Key -> (expiration time, value).
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        """
+        Returns the value cached for a key, or `default` if there is none or if it expired.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expiration, value = entry
+            if expiration is not None and expiration <= self._clock():
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None) -> None:
+        """
+        Caches a value, evicting the least recently used entry if the cache is full.
+
+        :param ttl: Overrides the default time-to-live for this entry.
+        """
+        if self.max_size <= 0:
+            return
+        ttl = self.ttl if ttl is None else ttl
+        expiration = None if ttl is None else self._clock() + ttl
+        with self._lock:
+            self._entries[key] = (expiration, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations,
+        }
+
+
+class Cache:
+
+    """
+
+    Cache of query results, with two tiers:
+    - an in-memory LRU cache, with a time-to-live ;
+    - optionally, an on-disk cache (a shelve file), which survives restarts.
+      Its entries have the same time-to-live. The file isn't locked, so it is only
+      for a single process (e.g. a CLI): processes sharing it, such as the workers
+      of a WSGI server, could corrupt it.
+
+    Keys must have a stable `repr`, e.g. the plan of a `Filter`.
+    Values must be picklable when the disk tier is enabled.
+
+    """
+
+    cache_folder: str = '.cache/pfin/'
+
+    def __init__(self, name: str, max_size: int = 1024, ttl: float = 300, persistent: bool = False):
+        """
+        :param str name: Name of the cache, used for the on-disk file.
+        :param int max_size: The maximum number of entries kept in memory.
+        :param float ttl: The time-to-live of an entry, in seconds.
+        :param bool persistent: Whether to also store the entries on disk, from a single process.
+        """
+        self.name = name
+        self.ttl = ttl
+        self._memory = LRUCache(max_size=max_size, ttl=ttl)
+        self._disk = None
+        self._disk_lock = threading.Lock()
+        self.disk_hits = 0
+        self.disk_misses = 0
+        if persistent:
+            self.create_cache_dir()
+            self._disk = self._get_db(name)
+
+    def create_cache_dir(self) -> None:
+        """
+        Creates the cache directory.
+        """
+        try:
+            os.makedirs(self.cache_folder)
+        except FileExistsError:
+            pass
+
+    def _get_db(self, db_name: str) -> shelve.DbfilenameShelf:
+        """
+        Gets the database specified.
+        Creates it if not present.
+        Needs for the parent directory to exist.
+
+        :param str db_name: The database name (the file name).
+        :return shelve.DbfilenameShelf:
+        """
+        db_path = os.path.join(self.cache_folder, db_name)
+        db = shelve.open(db_path)
+        logging.info(f'Opened cache file {db_path!r}')
+        return db
+
+    @staticmethod
+    def _disk_key(key) -> str:
+        return sha256(repr(key).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the value cached for a key, None if there is none.
+        """
+        value = self._memory.get(key)
+        if value is not None or self._disk is None:
+            return value
+
+        disk_key = self._disk_key(key)
+        with self._disk_lock:
+            entry = self._disk.get(disk_key)
+            if entry is not None and entry[0] <= time.time():
+                del self._disk[disk_key]
+                entry = None
+        if entry is None:
+            self.disk_misses += 1
+            return None
+        self.disk_hits += 1
+        expiration, value = entry
+        # Promote it to the memory tier, for the time it has left.
+        self._memory.set(key, value, ttl=expiration - time.time())
+        return value
+
+    def set(self, key, value) -> None:
+        self._memory.set(key, value)
+        if self._disk is not None:
+            with self._disk_lock:
+                self._disk[self._disk_key(key)] = (time.time() + self.ttl, value)
+
+    def clear(self) -> None:
+        """
+        Invalidates all the entries, in both tiers.
+        """
+        self._memory.clear()
+        if self._disk is not None:
+            with self._disk_lock:
+                self._disk.clear()
+        logging.debug(f'Cleared cache {self.name!r}')
+
+    def stats(self) -> dict:
+        stats = self._memory.stats()
+        if self._disk is not None:
+            stats.update({'disk_hits': self.disk_hits, 'disk_misses': self.disk_misses})
+        return stats
@@ -0,0 +1,502 @@
+import re
+import logging
+import numpy as np
+
+from bisect import bisect_right
+from typing import Dict, List, Callable, Iterable
+
+from .image import image_structure
+
+
+# Fields stored as boolean columns.
+flag_fields = ('product_in', 'human_in', 'institutional', 'format', 'limited_usage', 'usable')
+# Fields stored as lists, encoded as offsets into a flat array.
+list_fields = ('tags',)
+
+regex_flags = {
+    'i': re.IGNORECASE,
+    'm': re.MULTILINE,
+    's': re.DOTALL,
+    'x': re.VERBOSE,
+}
+
+
+class UnsupportedQuery(ValueError):
+    """
+    Raised when a query uses an operator or a field the catalog can't evaluate.
+    The caller is expected to fall back to the database.
+    """
+
+
+def _as_flag(value) -> bool or None:
+    """
+    Normalizes a boolean field value.
+    Flags are stored either as booleans or as their string form ("true" / "false").
+    Returns None if the value is neither.
+    """
+    if value is True or value == 'true':
+        return True
+    if value is False or value == 'false':
+        return False
+    return None
+
+
+class _FlagColumn:
+
+    """
+    Boolean column.
+    `known` is False for the documents where the value is missing or invalid.
+    """
+
+    def __init__(self):
+        self.truth = np.zeros(0, dtype=bool)
+        self.known = np.zeros(0, dtype=bool)
+
+    @staticmethod
+    def normalize(value):
+        flag = _as_flag(value)
+        return value if flag is None else flag
+
+    def extend(self, values: list) -> None:
+        flags = [_as_flag(value) for value in values]
+        self.truth = np.concatenate([self.truth, np.array([flag is True for flag in flags], dtype=bool)])
+        self.known = np.concatenate([self.known, np.array([flag is not None for flag in flags], dtype=bool)])
+
+    def replace_rows(self, rows: np.ndarray, values: list) -> None:
+        flags = [_as_flag(value) for value in values]
+        truth, known = self.truth.copy(), self.known.copy()
+        truth[rows] = [flag is True for flag in flags]
+        known[rows] = [flag is not None for flag in flags]
+        self.truth, self.known = truth, known
+
+    def copy(self) -> '_FlagColumn':
+        column = _FlagColumn()
+        column.truth, column.known = self.truth, self.known
+        return column
+
+    def mask(self, predicate: Callable) -> np.ndarray:
+        mask = np.zeros(len(self.truth), dtype=bool)
+        if predicate(True):
+            mask |= self.known & self.truth
+        if predicate(False):
+            mask |= self.known & ~self.truth
+        if predicate(None):
+            mask |= ~self.known
+        return mask
+
+
+class _EncodedColumn:
+
+    """
+    Dictionary-encoded column.
+    Each row holds a code, which is the index of its value in `vocabulary`.
+    Predicates are therefore evaluated once per distinct value.
+    """
+
+    def __init__(self):
+        self.vocabulary = []
+        self.codes = np.zeros(0, dtype=np.int32)
+        self._lookup = {}
+
+    @staticmethod
+    def normalize(value):
+        return value
+
+    def copy(self) -> '_EncodedColumn':
+        # The vocabulary is only appended to: the copies share it.
+        column = object.__new__(type(self))
+        column.__dict__.update(self.__dict__)
+        return column
+
+    def _encode(self, value) -> int:
+        try:
+            code = self._lookup.get(value)
+        except TypeError:
+            # Unhashable values (e.g. sub-documents) each get their own code.
+            self.vocabulary.append(value)
+            return len(self.vocabulary) - 1
+        if code is None:
+            code = len(self.vocabulary)
+            self.vocabulary.append(value)
+            self._lookup[value] = code
+        return code
+
+    def extend(self, values: list) -> None:
+        codes = np.fromiter((self._encode(value) for value in values), dtype=np.int32, count=len(values))
+        self.codes = np.concatenate([self.codes, codes])
+
+    def replace_rows(self, rows: np.ndarray, values: list) -> None:
+        codes = self.codes.copy()
+        codes[rows] = np.fromiter((self._encode(value) for value in values), dtype=np.int32, count=len(values))
+        self.codes = codes
+
+    def matching_codes(self, predicate: Callable) -> np.ndarray:
+        return np.fromiter((code for code, value in enumerate(self.vocabulary) if predicate(value)),
+                           dtype=np.int32)
+
+    def mask(self, predicate: Callable) -> np.ndarray:
+        return np.isin(self.codes, self.matching_codes(predicate))
+
+
+class _ListColumn(_EncodedColumn):
+
+    """
+    Dictionary-encoded list column.
+    The elements of all rows are stored in a flat array of codes ;
+    the elements of row `i` are `codes[offsets[i]:offsets[i + 1]]`.
+    A row matches if any of its elements does, like MongoDB does for arrays.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.offsets = np.zeros(1, dtype=np.int64)
+
+    def extend(self, values: list) -> None:
+        values = [value if isinstance(value, list) else [value] for value in values]
+        lengths = np.fromiter((len(value) for value in values), dtype=np.int64, count=len(values))
+        self.offsets = np.concatenate([self.offsets, self.offsets[-1] + np.cumsum(lengths)])
+        super().extend([element for value in values for element in value])
+
+    def replace_rows(self, rows: np.ndarray, values: list) -> None:
+        values = [value if isinstance(value, list) else [value] for value in values]
+        replacements = dict(zip(rows.tolist(), values))
+        # The unchanged runs of rows are copied as slices of the flat array.
+        pieces, start = [], 0
+        for row in sorted(replacements):
+            pieces.append(self.codes[self.offsets[start]:self.offsets[row]])
+            pieces.append(np.fromiter((self._encode(element) for element in replacements[row]),
+                                      dtype=np.int32, count=len(replacements[row])))
+            start = row + 1
+        pieces.append(self.codes[self.offsets[start]:])
+        lengths = np.diff(self.offsets)
+        lengths[list(replacements)] = [len(value) for value in replacements.values()]
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        self.codes, self.offsets = np.concatenate(pieces).astype(np.int32, copy=False), offsets
+
+    def mask(self, predicate: Callable) -> np.ndarray:
+        hits = np.isin(self.codes, self.matching_codes(predicate))
+        # Number of matching elements per row, computed from the cumulative sum
+        # so that rows with an empty list are handled.
+        cumulative = np.concatenate([[0], np.cumsum(hits, dtype=np.int64)])
+        return cumulative[self.offsets[1:]] > cumulative[self.offsets[:-1]]
+
+
+class ColumnarCatalog:
+
+    """
+
+    In-memory, columnar copy of the images collection.
+    It evaluates the queries forged by `Filter` with vectorized mask operations,
+    without querying the database.
+
+    The catalog is read-mostly, and is never modified once built: `upsert` and `remove`
+    return an updated copy, which the readers see once its reference replaces the catalog's
+    (see `ImageDatabase._index_documents`), so that a search never sees half-updated columns.
+    The copies share the arrays of the columns, which are replaced rather than modified.
+    Replacing documents, or adding documents in increasing `_id` order (the case of
+    the MongoDB-generated ids) only copies the arrays ; other changes rebuild the columns.
+
+    """
+
+    def __init__(self, documents: Iterable[dict] = ()):
+        self._reset()
+        self.extend(documents)
+
+    def _reset(self) -> None:
+        self._documents = []
+        self._ids = []
+        self._positions = {}  # `_id` -> row.
+        self._columns = {}
+        for field in image_structure:
+            if field in flag_fields:
+                self._columns[field] = _FlagColumn()
+            elif field in list_fields:
+                self._columns[field] = _ListColumn()
+            else:
+                self._columns[field] = _EncodedColumn()
+
+    @classmethod
+    def from_collection(cls, collection) -> 'ColumnarCatalog':
+        """
+        Loads all the documents of a collection, ordered by `_id`.
+        """
+        catalog = cls(collection.find().sort('_id', 1))
+        logging.info(f'Loaded {len(catalog)} documents in the catalog')
+        return catalog
+
+    def __len__(self) -> int:
+        return len(self._documents)
+
+    def extend(self, documents: Iterable[dict]) -> None:
+        """
+        Appends documents to the catalog.
+        """
+        documents = list(documents)
+        if not documents:
+            return
+        for document in documents:
+            self._positions[document.get('_id')] = len(self._documents)
+            self._documents.append(document)
+            self._ids.append(document.get('_id'))
+        for field, column in self._columns.items():
+            column.extend([document.get(field) for document in documents])
+
+    def _copy(self) -> 'ColumnarCatalog':
+        catalog = object.__new__(type(self))
+        catalog._documents = list(self._documents)
+        catalog._ids = list(self._ids)
+        catalog._positions = dict(self._positions)
+        catalog._columns = {field: column.copy() for field, column in self._columns.items()}
+        return catalog
+
+    @classmethod
+    def _rebuilt(cls, documents: List[dict]) -> 'ColumnarCatalog':
+        try:
+            documents = sorted(documents, key=lambda document: document.get('_id'))
+        except TypeError:
+            # Incomparable ids, keep the current order.
+            pass
+        return cls(documents)
+
+    def upsert(self, documents: Iterable[dict]) -> 'ColumnarCatalog':
+        """
+        Returns a copy of the catalog with documents added, replacing the ones with the same `_id`.
+        This catalog is left untouched.
+        """
+        replaced = {}  # Row -> document.
+        new = {}  # `_id` -> document, the last one of each `_id` wins.
+        for document in documents:
+            position = self._positions.get(document.get('_id'))
+            if position is None:
+                new[document.get('_id')] = document
+            else:
+                replaced[position] = document
+        last_id = self._ids[-1] if self._ids else None
+        try:
+            in_order = all(last_id is None or key > last_id for key in new) and list(new) == sorted(new)
+        except TypeError:
+            in_order = False
+
+        catalog = self._copy()
+        if replaced:
+            rows = np.fromiter(replaced, dtype=np.intp, count=len(replaced))
+            for row, document in replaced.items():
+                catalog._documents[row] = document
+            for field, column in catalog._columns.items():
+                column.replace_rows(rows, [document.get(field) for document in replaced.values()])
+        if not new:
+            return catalog
+        if in_order:
+            catalog.extend(new.values())
+            return catalog
+        return self._rebuilt(catalog._documents + list(new.values()))
+
+    def remove(self, ids: Iterable) -> 'ColumnarCatalog':
+        """
+        Returns a copy of the catalog without the documents with the given `_id`s.
+        This catalog is left untouched.
+        """
+        rows = {self._positions[i] for i in ids if i in self._positions}
+        if not rows:
+            return self
+        return self._rebuilt([document for row, document in enumerate(self._documents) if row not in rows])
+
+    def find(self, query: dict, limit: int = 0, after=None) -> List[dict]:
+        """
+        Returns the documents matching a query, in the catalog's order.
+
+        :param dict query: A query, as forged by `Filter.forge_query`.
+        :param int limit: The maximum number of documents to return. 0 means no limit.
+        :param after: If passed, only the documents with an `_id` greater than this one are returned.
+        :raises UnsupportedQuery: If the query can't be evaluated by the catalog.
+        """
+        mask = self.evaluate(query)
+        start = 0
+        if after is not None:
+            try:
+                start = bisect_right(self._ids, after)
+            except TypeError:
+                raise UnsupportedQuery(f'Cannot compare {after!r} to the ids of the catalog')
+        indices = np.flatnonzero(mask[start:]) + start
+        if limit:
+            indices = indices[:limit]
+        return self.get(indices)
+
+    def find_ids(self, ids: list, query: dict, limit: int = 0) -> List[dict]:
+        """
+        Returns the documents with the given `_id`s matching a query, in the order of the ids.
+        Ids missing from the catalog are skipped.
+
+        :param list ids: The `_id`s, e.g. ranked by relevance.
+        :param dict query: A query, as forged by `Filter.forge_query`.
+        :param int limit: The maximum number of documents to return. 0 means no limit.
+        :raises UnsupportedQuery: If the query can't be evaluated by the catalog.
+        """
+        mask = self.evaluate(query)
+        documents = []
+        # Stop as soon as the limit is reached, the ids may be many.
+        for i in ids:
+            row = self._positions.get(i)
+            if row is not None and mask[row]:
+                documents.append(self._documents[row])
+                if len(documents) == limit:
+                    break
+        return documents
+
+    def facets(self, query: dict, fields: Iterable[str], ids: list = None) -> Dict[str, dict]:
+        """
+        Counts the values of fields among the documents matching a query, in a single evaluation.
+        Flags are counted as booleans, and missing values are not counted.
+
+        :param dict query: A query, as forged by `Filter.forge_query`.
+        :param fields: The fields whose values are counted.
+        :param list ids: If passed, only the documents with these `_id`s are counted.
+        :return dict: Field -> value -> number of matching documents.
+        :raises UnsupportedQuery: If the query can't be evaluated by the catalog.
+        """
+        mask = self.evaluate(query)
+        if ids is not None:
+            rows = np.fromiter((self._positions[i] for i in ids if i in self._positions), dtype=np.intp)
+            selected = np.zeros(len(self), dtype=bool)
+            selected[rows] = True
+            mask &= selected
+
+        counts = {}
+        for field in fields:
+            column = self._columns.get(field)
+            if column is None:
+                raise UnsupportedQuery(f'Field {field!r} is not in the catalog')
+            if isinstance(column, _FlagColumn):
+                known = mask & column.known
+                true = int(np.count_nonzero(known & column.truth))
+                false = int(np.count_nonzero(known)) - true
+                counts[field] = {value: count for value, count in ((True, true), (False, false)) if count}
+            elif isinstance(column, _ListColumn):
+                # Repeated elements of a row are counted once per element.
+                rows = np.repeat(mask, np.diff(column.offsets))
+                histogram = np.bincount(column.codes[rows], minlength=len(column.vocabulary))
+                counts[field] = _histogram_counts(histogram, column.vocabulary)
+            else:
+                histogram = np.bincount(column.codes[mask], minlength=len(column.vocabulary))
+                counts[field] = _histogram_counts(histogram, column.vocabulary)
+        return counts
+
+    def get(self, indices: Iterable[int]) -> List[dict]:
+        """
+        Returns the documents at the given positions.
+        """
+        return [self._documents[i] for i in indices]
+
+    def evaluate(self, query: dict) -> np.ndarray:
+        """
+        Evaluates a query, and returns the boolean mask of the matching documents.
+        """
+        mask = np.ones(len(self), dtype=bool)
+        for key, value in query.items():
+            if key == '$and':
+                for sub_query in value:
+                    mask &= self.evaluate(sub_query)
+            elif key == '$or':
+                any_mask = np.zeros(len(self), dtype=bool)
+                for sub_query in value:
+                    any_mask |= self.evaluate(sub_query)
+                mask &= any_mask
+            elif key.startswith('$'):
+                raise UnsupportedQuery(f'Unsupported operator {key!r}')
+            else:
+                mask &= self._evaluate_field(key, value)
+        return mask
+
+    def _evaluate_field(self, field: str, condition) -> np.ndarray:
+        column = self._columns.get(field)
+        if column is None:
+            raise UnsupportedQuery(f'Field {field!r} is not in the catalog')
+
+        if not (isinstance(condition, dict) and condition and all(k.startswith('$') for k in condition)):
+            # Plain equality.
+            condition = {'$eq': condition}
+
+        mask = np.ones(len(self), dtype=bool)
+        for operator, operand in condition.items():
+            if operator == '$options':
+                # Handled along with `$regex`.
+                continue
+            elif operator == '$regex':
+                flags = 0
+                for option in condition.get('$options', ''):
+                    flags |= regex_flags.get(option, 0)
+                pattern = re.compile(operand, flags)
+                mask &= column.mask(lambda v: isinstance(v, str) and pattern.search(v) is not None)
+            elif operator == '$eq':
+                operand = column.normalize(operand)
+                mask &= column.mask(lambda v: v == operand)
+            elif operator == '$ne':
+                operand = column.normalize(operand)
+                mask &= ~column.mask(lambda v: v == operand)
+            elif operator == '$in':
+                mask &= column.mask(_membership([column.normalize(o) for o in operand]))
+            elif operator == '$nin':
+                mask &= ~column.mask(_membership([column.normalize(o) for o in operand]))
+            elif operator in ('$gt', '$gte', '$lt', '$lte'):
+                mask &= column.mask(_comparison(operator, column.normalize(operand)))
+            else:
+                raise UnsupportedQuery(f'Unsupported operator {operator!r} on field {field!r}')
+        return mask
+
+
+def _histogram_counts(histogram: np.ndarray, vocabulary: list) -> dict:
+    """
+    Returns the non-zero counts of a histogram of codes, by value.
+    """
+    counts = {}
+    for code in np.flatnonzero(histogram):
+        value = vocabulary[code]
+        if value is not None:
+            try:
+                counts[value] = counts.get(value, 0) + int(histogram[code])
+            except TypeError:
+                # Unhashable values are not counted.
+                pass
+    return counts
+
+
+def _membership(operands: list) -> Callable:
+    """
+    Returns a predicate testing whether a value is one of the operands.
+    Hashable operands are looked up in a set, so that long `$in` lists stay cheap.
+    """
+    try:
+        operand_set = set(operands)
+    except TypeError:
+        return lambda v: any(v == o for o in operands)
+
+    def predicate(value) -> bool:
+        try:
+            return value in operand_set
+        except TypeError:
+            return False
+
+    return predicate
+
+
+def _comparison(operator: str, operand) -> Callable:
+    """
+    Returns a predicate comparing a value to the operand.
+    Values of incomparable types never match, like in MongoDB.
+    """
+    compare = {
+        '$gt': lambda v: v > operand,
+        '$gte': lambda v: v >= operand,
+        '$lt': lambda v: v < operand,
+        '$lte': lambda v: v <= operand,
+    }[operator]
+
+    def predicate(value) -> bool:
+        if value is None or type(value) is not type(operand):
+            return False
+        try:
+            return bool(compare(value))
+        except TypeError:
+            return False
+
+    return predicate
@@ -0,0 +1,4 @@
+PFIN_SERVER = "mongodb://localhost:27017/"
+PFIN_SECRET = "scratch"
+SALT = b"salt"
+IMAGE_HOST_URL = "http://images.local/"
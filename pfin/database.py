@@ -1,37 +1,151 @@
-import os
-import random
-import shelve
+import bson
+import time
+import hashlib
+import datetime
+import base64
 import pymongo
 import logging
+import threading
 
-from typing import List
+from bisect import bisect_right
+from typing import List, Tuple, Iterable, Iterator, Dict, Set
+from bson import json_util
+from pymongo import UpdateOne
+from pymongo.errors import PyMongoError
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
 
 from .user import User
-from .image import Image
+from .image import Image, ImageView, build_images, validate_projection
 from .filter import Filter
+from .catalog import ColumnarCatalog, UnsupportedQuery, flag_fields, _as_flag
+from .tag_index import TagIndex
+from .fulltext import FullTextIndex
+from .rights import ExpiryIndex, is_usable
+from .phash import PerceptualIndex, from_hex
+from .sampling import sample_catalog, sample_collection, matching_ids
+from .cache import Cache, LRUCache
+from .bloom import BloomFilter
+from .indexes import image_indexes, user_indexes, ensure_indexes
 from .config import PFIN_SERVER, IMAGE_HOST_URL
 from .utils import hash_password
 
 
+# Process-wide registry of the clients: (factory, URI, options) -> client.
+# A client holds a connection pool, and is safe to share between threads.
+_clients: Dict[tuple, pymongo.MongoClient] = {}
+_clients_lock = threading.Lock()
+
+# Namespaces (client, database, collection) which were checked to exist.
+_validated_namespaces: Set[tuple] = set()
+
+
+def get_client(uri: str, factory=pymongo.MongoClient, **options) -> pymongo.MongoClient:
+    """
+    Returns the client of the registry for a server and options, creating it on the first call.
+    With `connect=False`, creating the client doesn't wait for the server.
+
+    :param str uri: The connection string.
+    :param factory: The client class, e.g. `pymongo.MongoClient` or a stand-in for tests.
+    :param options: The options of the client, e.g. `maxPoolSize`.
+    """
+    key = (factory, uri, tuple(sorted(options.items())))
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = factory(uri, **options)
+            _clients[key] = client
+            logging.info(f'Created client with options {options}')
+    return client
+
+
+def close_clients() -> None:
+    """
+    Closes all the clients of the registry, e.g. before forking or when exiting.
+    """
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+        _validated_namespaces.clear()
+
+
 class Database:
 
     srv_args: str = '?retryWrites=true&w=majority'
 
+    # The clients are shared by all the instances, see `get_client`.
+    client_factory = pymongo.MongoClient
+    client_options: dict = {
+        'maxPoolSize': 50,
+        'minPoolSize': 0,
+        'maxIdleTimeMS': 60000,
+        'serverSelectionTimeoutMS': 10000,
+        # Don't block until the first operation.
+        'connect': False,
+    }
+
+    # Indexes of the collection, see `pfin.indexes`.
+    indexes: List[pymongo.IndexModel] = []
+    # Whether to create the missing indexes on the first access to the collection, once per process.
+    create_indexes: bool = True
+
+    # Settings of the result cache, see `Cache`.
+    cache_size: int = 1024
+    cache_ttl: float = 300
+    # Only for a single process, see `Cache`.
+    persistent_cache: bool = False
+
     def __init__(self, database_name: str, collection_name: str):
-        # Create client (connect to the server)
-        self._client = pymongo.MongoClient(f"{PFIN_SERVER}{self.srv_args}")
+        # Get the shared client. This doesn't connect to the server.
+        self._client = get_client(f"{PFIN_SERVER}{self.srv_args}", type(self).client_factory,
+                                  **self.client_options)
 
-        # Select database and collection
-        self._select_database(database_name)
-        self._select_collection(collection_name)
+        # Select database and collection. They are checked on the first access to the collection.
+        self._db: pymongo.database.Database = self._client.get_database(database_name)
+        self._unchecked_collection: pymongo.collection.Collection = self._db.get_collection(collection_name)
+        self._checked = False
 
         self._preprocess()
 
+    @property
+    def _collection(self) -> pymongo.collection.Collection:
+        if not self._checked:
+            self._check_namespace()
+        return self._unchecked_collection
+
     def _preprocess(self) -> None:
         """
         Is in charge of creating the cache, which will hold often-computed information.
         """
-        self.cache = Cache(self._db, self._collection)
+        self.cache = Cache(f'{self._db.name}.{self._unchecked_collection.name}',
+                           max_size=self.cache_size, ttl=self.cache_ttl,
+                           persistent=self.persistent_cache)
+
+    def _check_namespace(self) -> None:
+        """
+        Checks that the database and the collection exist, and creates the missing indexes.
+        Done once per process for each of them, whatever the number of instances.
+
+        :raises ValueError: If the database or the collection doesn't exist.
+        """
+        key = (id(self._client), self._db.name, self._unchecked_collection.name)
+        if key not in _validated_namespaces:
+            self._select_database(self._db.name)
+            self._select_collection(self._unchecked_collection.name)
+            _validated_namespaces.add(key)
+            if self.create_indexes:
+                ensure_indexes(self._unchecked_collection, self.indexes)
+        self._checked = True
+
+    def ensure_indexes(self) -> List[str]:
+        """
+        Creates the indexes of the collection which are missing.
+
+        :return list: The names of the indexes ensured, without those which couldn't be created,
+                      see `pfin.indexes.ensure_indexes`.
+        """
+        return ensure_indexes(self._collection, self.indexes)
 
     def _select_database(self, db_name: str) -> None:
         """
@@ -46,7 +160,7 @@ class Database:
                              f'Pick one from {available_databases}')
 
         logging.info(f'Selecting database {db_name!r}')
-        self._db: pymongo.database.Database = self._client.get_database(db_name)
+        self._db = self._client.get_database(db_name)
 
     def _select_collection(self, collection_name: str) -> None:
         """
@@ -61,17 +175,416 @@ class Database:
                              f'Pick one from {available_collections}')
 
         logging.info(f'Selecting collection {collection_name!r}')
-        self._collection: pymongo.collection.Collection = self._db.get_collection(collection_name)
+        self._unchecked_collection = self._db.get_collection(collection_name)
 
 
 class ImageDatabase(Database):
 
+    indexes = image_indexes
+
+    # Used for projected searches: documents are decoded lazily, on access.
+    # Set to None to get decoded documents, for clients not supporting raw BSON.
+    raw_codec_options: CodecOptions or None = CodecOptions(document_class=RawBSONDocument)
+
+    # Fields counted by `facet_counts`, and the number of values kept for each, the most frequent.
+    facet_fields: Tuple[str, ...] = ('type', 'product_in', 'human_in', 'institutional', 'format',
+                                     'limited_usage', 'credits')
+    max_facet_values: int = 20
+
+    # Whether the searches exclude the images whose rights ended, unless their filter sets `usable`.
+    exclude_unusable: bool = True
+
+    # Without a change stream, seconds between the checks of the images' `data_version`, see `watch_changes`.
+    poll_interval: float = 30
+    # Name of the collection holding the revision of each collection, see `mark_modified`.
+    revisions_collection: str = 'revisions'
+    # Maximum number of the pending change events applied at once, see `follow_changes`.
+    change_batch_size: int = 1000
+
+    def __init__(self, database_name: str, collection_name: str,
+                 in_memory: bool = False, index_tags: bool = False, index_text: bool = False,
+                 track_rights: bool = False):
+        """
+        :param bool in_memory: Whether to load the collection in an in-process catalog,
+                               which will then be used to evaluate the searches.
+        :param bool index_tags: Whether to build an inverted index of the tags,
+                                used to resolve the tags criteria of the searches.
+        :param bool index_text: Whether to build a full-text index of the ids, credits and tags,
+                                used to resolve the text filter of the searches by relevance.
+        :param bool track_rights: Whether to keep the upcoming ends of rights in memory,
+                                  so that the images are flagged as unusable when their rights end,
+                                  see `expire_rights` and `watch_changes`.
+        """
+        super().__init__(database_name, collection_name)
+        # The `data_version` of the loaded structures, and the changes applied since, see `version`.
+        self._data_version: str or None = None
+        self._generation = 0
+        # Resume token of the last change followed, see `follow_changes`.
+        self._stream_position: str or None = None
+        # Serializes the changes of the in-memory structures, made by the requests and the change stream.
+        self._write_lock = threading.RLock()
+        self.catalog: ColumnarCatalog or None = None
+        self.tag_index: TagIndex or None = None
+        self.text_index: FullTextIndex or None = None
+        self.phash_index: PerceptualIndex or None = None
+        self.expiry_index: ExpiryIndex or None = None
+        if in_memory:
+            self.load_catalog()
+        if index_tags:
+            self.load_tag_index()
+        if index_text:
+            self.load_text_index()
+        if track_rights:
+            self.load_expiry_index()
+        if self._has_structures():
+            self._data_version = self.data_version()
+
+    @property
+    def version(self) -> str:
+        """
+        Identifies the state of the images seen by this instance, to key what is derived from them.
+
+        When following a change stream (see `watch_changes`), it is the position in the stream,
+        shared by all the processes having applied the same changes, and the number of changes
+        made through this instance since. Otherwise, it is the `data_version` of the images
+        when they were (re)loaded, and the number of changes made through this instance since ;
+        without a catalog, the changes made by other processes are only seen once the cached results expire,
+        so it also changes every `cache_ttl` seconds.
+        """
+        if self._stream_position is not None:
+            return f'{self._stream_position}.{self._generation}'
+        if self.catalog is not None:
+            return f'{self._data_version}.{self._generation}'
+        return f'{self._data_version}.{self._generation}.{int(time.time() // max(self.cache_ttl, 1))}'
+
+    def data_version(self) -> str:
+        """
+        Returns a fingerprint of the images, read with three cheap queries:
+        their estimated number, the greatest `_id`, and the revision recorded by `mark_modified`.
+        It changes with the insertions, the deletions, and the modifications made by this package
+        (through `ImageDatabase`, `pfin.rights sync`...), but not with the other modifications.
+        """
+        count = self._collection.estimated_document_count()
+        last = next(iter(self._collection.find({}, {'_id': 1}).sort('_id', -1).limit(1)), {}).get('_id')
+        revision = self._db[self.revisions_collection].find_one({'_id': self._collection.name}) or {}
+        return hashlib.sha256(repr((count, last, revision.get('revision', 0))).encode()).hexdigest()[:16]
+
+    def mark_modified(self) -> None:
+        """
+        Records that the images were modified, by incrementing their revision,
+        so that the other processes see it in `data_version`.
+        Called by the methods modifying the images ; to call after modifying them by other means.
+        """
+        self._db[self.revisions_collection].update_one({'_id': self._collection.name},
+                                                       {'$inc': {'revision': 1}}, upsert=True)
+
+    def _has_structures(self) -> bool:
+        return any(structure is not None for structure in (self.catalog, self.tag_index, self.text_index,
+                                                           self.expiry_index, self.phash_index))
+
+    def _changed(self) -> None:
+        """
+        Invalidates the cached results, and changes the version.
+        """
+        self._generation += 1
+        self.cache.clear()
+
+    def load_catalog(self) -> None:
+        """
+        Loads (or reloads) the whole collection in memory.
+        Searches are then evaluated locally, without querying the database.
+        """
+        self.catalog = ColumnarCatalog.from_collection(self._collection)
+
+    def load_tag_index(self) -> None:
+        """
+        Builds (or rebuilds) the inverted index of the tags.
+        """
+        self.tag_index = TagIndex.from_collection(self._collection)
+
+    def load_text_index(self) -> None:
+        """
+        Builds (or rebuilds) the full-text index of the ids, credits and tags.
+        """
+        self.text_index = FullTextIndex.from_collection(self._collection)
+
+    def load_expiry_index(self) -> None:
+        """
+        Builds (or rebuilds) the index of the ends of the rights.
+        """
+        self.expiry_index = ExpiryIndex.from_collection(self._collection)
+
+    def load_phash_index(self) -> None:
+        """
+        Builds (or rebuilds) the index of the perceptual hashes, used to find near duplicates.
+        """
+        self.phash_index = PerceptualIndex.from_collection(self._collection)
+
+    def reload(self) -> None:
+        """
+        Reloads the in-memory structures that are loaded, e.g. to see the changes made by other processes,
+        and changes the version.
+        """
+        with self._write_lock:
+            data_version = self.data_version()
+            if self.catalog is not None:
+                self.load_catalog()
+            if self.tag_index is not None:
+                self.load_tag_index()
+            if self.text_index is not None:
+                self.load_text_index()
+            if self.expiry_index is not None:
+                self.load_expiry_index()
+            if self.phash_index is not None:
+                self.load_phash_index()
+            self._data_version = data_version
+            self._changed()
+
+    def _index_documents(self, documents: List[dict], today: datetime.date = None) -> None:
+        """
+        Updates the `usable` flag of new or modified documents (see `_update_usable`),
+        adds them to the in-memory structures that are loaded, and invalidates the cached results.
+        """
+        with self._write_lock:
+            self._update_usable(documents, today)
+            if self.tag_index is not None:
+                for info in documents:
+                    self.tag_index.add(info['_id'], info.get('tags', []))
+            if self.text_index is not None:
+                for info in documents:
+                    self.text_index.add(info['_id'], info)
+            if self.expiry_index is not None:
+                for info in documents:
+                    self.expiry_index.add_document(info['_id'], info)
+            if self.phash_index is not None:
+                for info in documents:
+                    if info.get('phash'):
+                        self.phash_index.add(info['_id'], from_hex(info['phash']))
+                    else:
+                        self.phash_index.remove(info['_id'])
+            if self.catalog is not None:
+                # Replaced at once: the searches running meanwhile keep using the previous one.
+                self.catalog = self.catalog.upsert(documents)
+            self._changed()
+
+    def _update_usable(self, documents: List[dict], today: datetime.date = None) -> None:
+        """
+        Sets the `usable` flag of documents from their current rights, in both directions:
+        an image whose `usage_end` was extended, or whose `limited_usage` was cleared, can be used again.
+        The flags which changed are written to the database.
+        Images without the flag are left so while they can be used.
+        """
+        changed = {True: [], False: []}
+        for info in documents:
+            flag = is_usable(info, today)
+            if (info.get('usable') not in (False, 'false')) is not flag:
+                info['usable'] = flag
+                changed[flag].append(info['_id'])
+        for flag, ids in changed.items():
+            if ids:
+                self._collection.update_many({'_id': {'$in': ids}}, {'$set': {'usable': flag}})
+        if changed[True] or changed[False]:
+            self.mark_modified()
+
+    def _unindex_documents(self, ids: list) -> None:
+        """
+        Removes documents from the in-memory structures that are loaded,
+        and invalidates the cached results.
+        """
+        with self._write_lock:
+            if self.tag_index is not None:
+                for i in ids:
+                    self.tag_index.remove(i)
+            if self.text_index is not None:
+                for i in ids:
+                    self.text_index.remove(i)
+            if self.expiry_index is not None:
+                for i in ids:
+                    self.expiry_index.remove(i)
+            if self.phash_index is not None:
+                for i in ids:
+                    self.phash_index.remove(i)
+            if self.catalog is not None:
+                self.catalog = self.catalog.remove(ids)
+            self._changed()
+
+    def insert_images(self, images_info: List[dict]) -> None:
+        """
+        Inserts new images in the database,
+        and adds them to the in-memory structures that are loaded.
+
+        :param list images_info: The documents to insert.
+        """
+        if not images_info:
+            return
+        self._collection.insert_many(images_info)
+        self.mark_modified()
+        # `insert_many` sets the `_id` of the documents.
+        self._index_documents(images_info)
+
+    def upsert_images(self, images_info: List[dict]) -> int:
+        """
+        Inserts the images which are not in the database yet, identified by their `id`,
+        with a single unordered bulk request.
+        Images already present are left untouched, so this operation is idempotent.
+
+        :param list images_info: The documents to insert, without `_id`.
+        :return int: The number of images inserted.
+        """
+        unique = {info['id']: info for info in images_info}
+        if not unique:
+            return 0
+        documents = list(unique.values())
+        requests = [UpdateOne({'id': info['id']}, {'$setOnInsert': info}, upsert=True) for info in documents]
+        result = self._collection.bulk_write(requests, ordered=False)
+        inserted = []
+        for index, _id in result.upserted_ids.items():
+            info = dict(documents[index])
+            info['_id'] = _id
+            inserted.append(info)
+        if inserted:
+            self.mark_modified()
+            self._index_documents(inserted)
+        return len(inserted)
+
+    def update_images(self, query: dict, update: dict) -> int:
+        """
+        Updates the images matching a query, and their `usable` flag if their rights changed,
+        and refreshes them in the in-memory structures that are loaded.
+
+        :param dict query: The images to update.
+        :param dict update: The update to apply, e.g. `{'$set': {'tags': []}}`.
+        :return int: The number of images modified.
+        """
+        ids = matching_ids(self._collection, query)
+        if not ids:
+            return 0
+        result = self._collection.update_many({'_id': {'$in': ids}}, update)
+        self.mark_modified()
+        self._index_documents(list(self._collection.find({'_id': {'$in': ids}})))
+        return result.modified_count
+
+    def set_image_fields(self, values: Dict[object, dict]) -> int:
+        """
+        Sets fields of images to values specific to each one, with a single unordered bulk request,
+        and refreshes them in the in-memory structures that are loaded.
+
+        :param dict values: The fields to set, by `_id`, e.g. `{_id: {'phash': '...'}}`.
+        :return int: The number of images modified.
+        """
+        if not values:
+            return 0
+        requests = [UpdateOne({'_id': _id}, {'$set': fields}) for _id, fields in values.items()]
+        result = self._collection.bulk_write(requests, ordered=False)
+        self.mark_modified()
+        self._index_documents(list(self._collection.find({'_id': {'$in': list(values)}})))
+        return result.modified_count
+
+    def follow_changes(self, events: Iterable[dict] = None) -> None:
+        """
+        Consumes a change stream of the collection, keeping the in-memory structures
+        and the cached results up to date with the changes made by other processes.
+        Blocks until the stream ends ; see `watch_changes` to run it in the background.
+
+        :param events: The change events. Defaults to a change stream of the collection,
+                       which requires a replica set. Any iterable of events can be passed instead.
+        """
+        if events is None:
+            events = self._collection.watch(full_document='updateLookup')
+        for batch in _event_batches(events, self.change_batch_size):
+            # Only the last state of each document is applied, in a single update of the structures.
+            documents = {}  # `_id` -> document, or None if deleted.
+            for event in batch:
+                operation = event.get('operationType')
+                if operation in ('insert', 'update', 'replace', 'delete'):
+                    # `fullDocument` is None if the document was deleted since.
+                    documents[event['documentKey']['_id']] = event.get('fullDocument')
+                elif operation in ('drop', 'rename', 'dropDatabase', 'invalidate'):
+                    logging.warning(f'Collection changed ({operation!r}), reloading')
+                    documents = {}
+                    self.reload()
+            upserted = [document for document in documents.values() if document is not None]
+            deleted = [key for key, document in documents.items() if document is None]
+            if upserted:
+                self._index_documents(upserted)
+            if deleted:
+                self._unindex_documents(deleted)
+            position = _stream_position(batch[-1])
+            if position is not None:
+                # The changes made through this instance are now part of the position.
+                self._stream_position = position
+                self._generation = 0
+
+    def watch_changes(self) -> threading.Thread:
+        """
+        Keeps the in-memory structures and the version up to date with the changes made by other processes,
+        in a daemon thread: with `follow_changes` if the server has change streams (replica sets),
+        or otherwise by checking the `data_version` every `poll_interval` seconds,
+        and reloading the structures when it changed.
+        With `track_rights`, a second thread flags the images whose rights ended, see `expire_rights`.
+        """
+        if self.expiry_index is not None:
+            threading.Thread(target=self._expire, name='pfin-rights', daemon=True).start()
+        thread = threading.Thread(target=self._watch, name='pfin-change-stream', daemon=True)
+        thread.start()
+        return thread
+
+    def _expire(self) -> None:
+        while True:
+            try:
+                self._check_rights()
+            except PyMongoError as e:
+                logging.error(f'Could not flag the images whose rights ended: {e}')
+            time.sleep(self.poll_interval)
+
+    def _watch(self) -> None:
+        try:
+            stream = self._collection.watch(full_document='updateLookup')
+        except (PyMongoError, TypeError, NotImplementedError) as e:
+            # Standalone servers have no change streams, nor do stand-ins such as mongomock.
+            logging.warning(f'No change stream ({e}), checking the images every {self.poll_interval} seconds')
+        else:
+            try:
+                with stream:
+                    # The changes made before the stream was opened are not in it.
+                    if self._data_version != self.data_version():
+                        self.reload()
+                    self._stream_position = _stream_position({'_id': stream.resume_token})
+                    self._generation = 0
+                    self.follow_changes(stream)
+            except PyMongoError as e:
+                logging.error(f'The change stream failed ({e}), '
+                              f'checking the images every {self.poll_interval} seconds')
+            self._stream_position = None
+
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                if self._data_version != self.data_version():
+                    self.reload()
+            except PyMongoError as e:
+                logging.error(f'Could not reload the images: {e}')
+
     def get_x_random_images(self, limit: int = 10, additional_filter: dict = None) -> List[Image]:
-        if additional_filter is None:
-            additional_filter = {}
-        images = list(self._collection.find(additional_filter, limit=limit * 5))
-        random.shuffle(images)
-        return [Image(info) for info in images[:limit]]
+        """
+        Returns images drawn uniformly at random.
+
+        :param int limit: The number of images to draw.
+        :param dict additional_filter: A query the images must match.
+                                       The images whose rights ended are excluded, see `exclude_unusable`.
+        :return list: The images, fewer than `limit` if not enough match.
+        """
+        additional_filter = self._restrict_query(additional_filter or {})
+        if self.catalog is not None:
+            try:
+                documents = sample_catalog(self.catalog, additional_filter, limit)
+            except UnsupportedQuery as e:
+                logging.warning(f'Catalog could not evaluate the query, falling back to the database: {e}')
+            else:
+                return build_images([dict(info) for info in documents])
+
+        # Drawn by the server: only the drawn images are read, whatever the number of candidates.
+        return build_images(sample_collection(self._collection, additional_filter, limit))
 
     def create_filter_from_args(self, args: dict) -> Filter:
         """
@@ -112,38 +625,557 @@ class ImageDatabase(Database):
         if "tags" in keys:
             value = args.get('tags')
             if value != "":
-                filter_args.update({"limited_usage": value.split(';')})
+                filter_args.update({"tags": value.split(';')})
 
         f = Filter(**filter_args)
         return f
 
-    def search(self, f: Filter, limit: int = 0) -> List[Image]:
+    def expire_rights(self, today: datetime.date = None) -> int:
+        """
+        Flags the images whose rights ended as unusable, in bulk.
+        Called by the thread of `watch_changes` when the nearest end of rights has passed.
+
+        :return int: The number of images flagged.
+        """
+        if self.expiry_index is None:
+            self.load_expiry_index()
+        expired = self.expiry_index.pop_expired(today)
+        if not expired:
+            return 0
+        self._collection.update_many({'_id': {'$in': expired}}, {'$set': {'usable': False}})
+        self.mark_modified()
+        self._index_documents(list(self._collection.find({'_id': {'$in': expired}})), today)
+        logging.info(f'The rights of {len(expired)} images ended')
+        return len(expired)
+
+    def _check_rights(self) -> None:
+        """
+        Updates the flags of the images if the nearest end of rights has passed.
+        """
+        if self.expiry_index is not None:
+            end = self.expiry_index.next_end()
+            if end is not None and end < datetime.date.today():
+                self.expire_rights()
+
+    def _restrict(self, f: Filter) -> Filter:
+        """
+        Returns the filter restricted to the usable images, if they are excluded
+        and the filter doesn't set `usable` itself.
+        """
+        if not self.exclude_unusable or 'usable' in f.criteria():
+            return f
+        return f.replace(usable=True)
+
+    def _restrict_query(self, query: dict) -> dict:
+        """
+        Like `_restrict`, for the lookups taking a query rather than a filter.
+        The query is not modified.
+        """
+        if not self.exclude_unusable or 'usable' in query:
+            return query
+        return _combine(query, Filter(usable=True).forge_query())
+
+    def expiring_images(self, days: int = 30) -> List[Tuple[Image, datetime.date]]:
+        """
+        Returns the images whose rights end in the next days, with the last day of their rights.
+
+        :param int days: The number of days, 0 for the ones ending today.
+        """
+        if self.expiry_index is None:
+            self.load_expiry_index()
+        expiring = self.expiry_index.expiring(days)
+        documents = {info['_id']: info for info in self._collection.find({'_id': {'$in': [k for k, _ in expiring]}})}
+        expiring = [(documents[key], end) for key, end in expiring if key in documents]
+        return list(zip(build_images([info for info, _ in expiring]), [end for _, end in expiring]))
+
+    def _find_documents(self, f: Filter, limit: int = 0, after=None, projection: frozenset = None,
+                        use_cache: bool = True, ranked: bool = False) -> list:
+        """
+        Returns the documents matching a filter,
+        using the in-memory structures that are loaded.
+
+        :param Filter f: The Filter instance to use.
+        :param int limit: The maximum number of documents to return. 0 means no limit.
+        :param after: If passed, only the documents with an `_id` greater than this one
+                      are returned, ordered by `_id`.
+        :param frozenset projection: If passed, only these fields are fetched,
+                                     and the documents are returned as read-only raw BSON documents.
+        :param bool use_cache: Whether to use the result cache.
+        :param bool ranked: Whether to order the documents by relevance to the text filter,
+                            when it is resolved by the full-text index. Ignored with `after`.
+        """
+        f = self._restrict(f)
+        query = f.forge_query()
+        criteria = f.criteria()
+        # The `_id`s the documents are restricted to, in the order of the results.
+        ids = None
+        if self.text_index is not None and criteria.get('text_filter'):
+            # Resolve the text with the index instead of scanning the collection with a regex.
+            ids = [key for key, _ in self.text_index.search(criteria.pop('text_filter'))]
+            if not ranked or after is not None:
+                ids = _ordered_ids(ids, after)
+            if not ids:
+                return []
+            query = Filter(**criteria).forge_query()
+
+        if self.catalog is not None:
+            try:
+                if ids is not None:
+                    documents = self.catalog.find_ids(ids, query, limit=limit)
+                else:
+                    documents = self.catalog.find(query, limit=limit, after=after)
+            except UnsupportedQuery as e:
+                logging.warning(f'Catalog could not evaluate the query, falling back to the database: {e}')
+            else:
+                if projection is not None:
+                    # Read-only, no need to copy.
+                    return documents
+                # Copy them, as the catalog's documents are shared.
+                return [dict(info) for info in documents]
+
+        if self.tag_index is not None and criteria.get('tags'):
+            # Resolve the tags with the index instead of scanning the collection with regexes.
+            tagged = self.tag_index.match(criteria.pop('tags'))
+            if not tagged:
+                return []
+            query = Filter(**criteria).forge_query()
+            if ids is None:
+                query = _combine(query, {'_id': {'$in': tagged}})
+            else:
+                tagged = set(tagged)
+                ids = [i for i in ids if i in tagged]
+                if not ids:
+                    return []
+
+        key = ('search', f.plan(), limit, after, ranked,
+               None if projection is None else tuple(sorted(projection)))
+        cached = self.cache.get(key) if use_cache else None
+        if cached is not None:
+            return [_decode_document(data, raw=projection is not None) for data in cached]
+
+        collection = self._collection
+        if projection is not None:
+            if self.raw_codec_options is not None:
+                collection = collection.with_options(codec_options=self.raw_codec_options)
+            projection = {field: 1 for field in projection}
+
+        if ids is not None:
+            documents = _find_in_order(collection, query, ids, limit, projection)
+        elif after is not None:
+            cursor = collection.find(_combine(query, {'_id': {'$gt': after}}), projection).sort('_id', 1)
+            documents = list(cursor.limit(limit))
+        else:
+            documents = list(collection.find(query, projection).limit(limit))
+        if use_cache:
+            # Documents are cached as BSON: compact, picklable, and each hit gets its own copy.
+            self.cache.set(key, [_encode_document(document) for document in documents])
+        return documents
+
+    def search(self, f: Filter, limit: int = 0, fields: List[str] = None) -> List[Image or ImageView]:
         """
         Searches the database using a filter.
+        With a full-text index, the images matching the text filter come by decreasing relevance.
+        The images whose rights ended are excluded, see `exclude_unusable`.
 
         :param Filter f: The Filter instance to use.
         :param int limit: The maximum number of items we want to return.
+        :param list fields: If passed, only these fields are fetched,
+                            and lightweight `ImageView` objects are returned.
         :return list: List of images if some were found, empty otherwise.
         """
+        if fields is not None:
+            projection = validate_projection(fields)
+            documents = self._find_documents(f, limit=limit, projection=projection, ranked=True)
+            return [ImageView(info, projection) for info in documents]
+        return build_images(self._find_documents(f, limit=limit, ranked=True))
+
+    def search_page(self, f: Filter, cursor: str = None, page_size: int = 12,
+                    fields: List[str] = None) -> Tuple[List[Image or ImageView], str or None]:
+        """
+        Returns a page of the images matching a filter.
+        Pages are ordered by `_id`, and the cursor holds the last `_id` of the previous page,
+        so getting a page costs the same whatever its depth.
+
+        :param Filter f: The Filter instance to use.
+        :param str cursor: The cursor returned with the previous page, None for the first one.
+        :param int page_size: The number of images per page.
+        :param list fields: If passed, only these fields are fetched,
+                            and lightweight `ImageView` objects are returned.
+        :return: The images of the page, and the cursor of the next page (None if it is the last one).
+        :raises ValueError: If the cursor, the page size or the fields are invalid.
+        """
+        if page_size < 1:
+            # A limit of 0 would mean no limit to MongoDB.
+            raise ValueError(f'Invalid page size {page_size}, it must be at least 1')
+        after = decode_cursor(cursor) if cursor else None
+        projection = validate_projection(fields) if fields is not None else None
+        # Fetch one more document to know whether there is a next page.
+        documents = self._find_documents(f, limit=page_size + 1, after=after, projection=projection)
+        next_cursor = None
+        if len(documents) > page_size:
+            documents = documents[:page_size]
+            next_cursor = encode_cursor(documents[-1]['_id'])
+        if projection is not None:
+            return [ImageView(info, projection) for info in documents], next_cursor
+        return build_images(documents), next_cursor
+
+    def iter_search(self, f: Filter, fields: List[str] = None, batch_size: int = 500) -> Iterator[Image or ImageView]:
+        """
+        Yields all the images matching a filter, ordered by `_id`.
+        They are fetched by batches, each one starting after the last `_id` of the previous one,
+        so that the memory used doesn't depend on the number of results,
+        and no cursor stays open on the server while the images are consumed.
+        The results are not cached.
+
+        :param Filter f: The Filter instance to use.
+        :param list fields: If passed, only these fields are fetched,
+                            and lightweight `ImageView` objects are yielded.
+        :param int batch_size: The number of images fetched at once.
+        """
+        projection = validate_projection(fields) if fields is not None else None
+        after = None
+        while True:
+            documents = self._find_documents(f, limit=batch_size, after=after, projection=projection,
+                                             use_cache=False)
+            if not documents:
+                return
+            after = documents[-1]['_id']
+            if projection is not None:
+                yield from (ImageView(info, projection) for info in documents)
+            else:
+                yield from build_images(documents)
+            if len(documents) < batch_size:
+                return
+
+    def facet_counts(self, f: Filter) -> Dict[str, dict]:
+        """
+        Counts the images matching a filter by value of each of the `facet_fields`, in a single pass:
+        over the columns of the catalog if it is loaded, or with a single `$facet` aggregation.
+        Results are cached by plan, so the returned dictionary is shared and must not be modified.
+
+        :param Filter f: The Filter instance to use.
+        :return dict: Field -> value -> number of images. Flags are counted as booleans.
+        """
+        f = self._restrict(f)
+        key = ('facets', f.plan())
+        counts = self.cache.get(key)
+        if counts is not None:
+            return counts
+
         query = f.forge_query()
-        returned_events = self._collection.find(query).limit(limit)
-        return [Image(info) for info in returned_events]
+        criteria = f.criteria()
+        ids = None
+        if self.text_index is not None and criteria.get('text_filter'):
+            ids = [i for i, _ in self.text_index.search(criteria.pop('text_filter'))]
+            query = Filter(**criteria).forge_query()
+
+        counts = None
+        if self.catalog is not None:
+            try:
+                counts = self.catalog.facets(query, self.facet_fields, ids=ids)
+            except UnsupportedQuery as e:
+                logging.warning(f'Catalog could not count the facets, falling back to the database: {e}')
+        if counts is None:
+            if ids is not None:
+                query = _combine(query, {'_id': {'$in': ids}})
+            counts = _facet_aggregation(self._collection, query, self.facet_fields)
+
+        counts = {field: dict(sorted(values.items(), key=lambda item: -item[1])[:self.max_facet_values])
+                  for field, values in counts.items()}
+        self.cache.set(key, counts)
+        return counts
+
+    def get_images(self, image_ids: List[str], fields: List[str] = None) -> List[Image or ImageView]:
+        """
+        Returns images from their `id`, in the same order.
+        Unknown `id`s are ignored, as are the images whose rights ended, see `exclude_unusable`.
+
+        :param list image_ids: The `id`s of the images.
+        :param list fields: If passed, only these fields are fetched,
+                            and lightweight `ImageView` objects are returned.
+        """
+        if not image_ids:
+            return []
+        projection = validate_projection(set(fields) | {'id'}) if fields is not None else None
+        collection = self._collection
+        if projection is not None and self.raw_codec_options is not None:
+            collection = collection.with_options(codec_options=self.raw_codec_options)
+        query = self._restrict_query({'id': {'$in': list(image_ids)}})
+        documents = {info['id']: info for info in collection.find(query, projection)}
+        found = [documents[i] for i in image_ids if i in documents]
+        if projection is not None:
+            return [ImageView(info, projection) for info in found]
+        return build_images(found)
+
+    def find_near_duplicates(self, image_id: str, radius: int = 8) -> List[Tuple[Image, int]]:
+        """
+        Returns the images looking like a given one (resized, recompressed, re-exported...),
+        according to their perceptual hash.
+        The index of the hashes is built on the first call.
+
+        :param str image_id: The `id` of the image.
+        :param int radius: The maximum Hamming distance between the hashes, out of 64 bits.
+        :return list: Tuples `(image, distance)`, closest first, without the image itself
+                      nor the images whose rights ended (see `exclude_unusable`).
+        :raises ValueError: If the image doesn't exist or has no perceptual hash.
+        """
+        document = self._collection.find_one({'id': image_id}, {'phash': 1})
+        if document is None or not document.get('phash'):
+            raise ValueError(f'Image {image_id!r} does not exist or has no perceptual hash')
+        if self.phash_index is None:
+            self.load_phash_index()
+        matches = [(key, distance)
+                   for key, distance in self.phash_index.query(from_hex(document['phash']), radius)
+                   if key != document['_id']]
+        if not matches:
+            return []
+        query = self._restrict_query({'_id': {'$in': [key for key, _ in matches]}})
+        documents = {info['_id']: info for info in self._collection.find(query)}
+        found = [(documents[key], distance) for key, distance in matches if key in documents]
+        images = build_images([info for info, _ in found])
+        return [(image, distance) for image, (_, distance) in zip(images, found)]
+
+
+def _event_batches(events: Iterable[dict], size: int) -> Iterator[List[dict]]:
+    """
+    Groups the change events which are already available, without waiting for the next ones.
+    Only change streams (having `try_next`) are grouped: other iterables give batches of one event.
+    """
+    try_next = getattr(events, 'try_next', None)
+    for event in events:
+        batch = [event]
+        while try_next is not None and len(batch) < size:
+            following = try_next()
+            if following is None:
+                break
+            batch.append(following)
+        yield batch
+
+
+def _stream_position(event: dict) -> str or None:
+    """
+    Returns the position of a change event in its stream, from its resume token, if it has one.
+    """
+    token = event.get('_id')
+    if isinstance(token, dict) and isinstance(token.get('_data'), str):
+        return token['_data']
+    return None
+
+
+def _encode_document(document) -> bytes:
+    if isinstance(document, RawBSONDocument):
+        return document.raw
+    return bson.encode(document)
+
+
+def _decode_document(data: bytes, raw: bool):
+    return RawBSONDocument(data) if raw else bson.decode(data)
+
+
+def _combine(query: dict, clause: dict) -> dict:
+    """
+    Adds a clause to a query, with an "and" operator.
+    The query is not modified.
+    """
+    return {'$and': [query, clause]} if query else clause
+
+
+def _facet_aggregation(collection, query: dict, fields: Iterable[str]) -> Dict[str, dict]:
+    """
+    Counts the values of fields among the documents matching a query, with a single aggregation.
+    Flags are counted as booleans, and missing values are not counted.
+    """
+    pipeline = [
+        {'$match': query},
+        {'$facet': {field: [{'$group': {'_id': f'${field}', 'count': {'$sum': 1}}}] for field in fields}},
+    ]
+    result = next(iter(collection.aggregate(pipeline)), {})
+    counts = {}
+    for field in fields:
+        values = counts[field] = {}
+        for group in result.get(field, []):
+            value = _as_flag(group['_id']) if field in flag_fields else group['_id']
+            if value is None or isinstance(value, (list, dict)):
+                continue
+            values[value] = values.get(value, 0) + group['count']
+    return counts
+
+
+def _ordered_ids(ids: list, after=None) -> list:
+    """
+    Sorts `_id`s, keeping only the ones greater than `after` if it is passed.
+    """
+    try:
+        ids = sorted(ids)
+        if after is not None:
+            ids = ids[bisect_right(ids, after):]
+    except TypeError:
+        # Incomparable ids, keep their order.
+        if after is not None:
+            raise ValueError(f'Cannot compare {after!r} to the ids')
+    return ids
+
+
+def _find_in_order(collection, query: dict, ids: list, limit: int = 0, projection: dict = None) -> list:
+    """
+    Returns the documents with the given `_id`s matching a query, in the order of the ids.
+    They are fetched by chunks of ids, until the limit is reached.
+    """
+    documents = []
+    chunk_size = max(4 * limit, 1000) if limit else len(ids)
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        found = {info['_id']: info for info in collection.find(_combine(query, {'_id': {'$in': chunk}}), projection)}
+        documents += [found[i] for i in chunk if i in found]
+        if limit and len(documents) >= limit:
+            return documents[:limit]
+    return documents
+
+
+# Types of the `_id` a cursor may hold. Others (lists, documents) can't be used as cache keys.
+_cursor_id_types = (bson.ObjectId, str, int, float, datetime.datetime)
+
+
+def encode_cursor(last_id) -> str:
+    """
+    Takes the `_id` of the last document of a page, and returns an opaque, URL-safe cursor.
+    """
+    return base64.urlsafe_b64encode(json_util.dumps({'_id': last_id}).encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    """
+    Takes a cursor created by `encode_cursor` and returns the `_id` it holds.
+
+    :raises ValueError: If the cursor is invalid.
+    """
+    try:
+        last_id = json_util.loads(base64.urlsafe_b64decode(cursor.encode()))['_id']
+    except (ValueError, TypeError, KeyError) as e:
+        raise ValueError(f'Invalid cursor {cursor!r}') from e
+    if not isinstance(last_id, _cursor_id_types):
+        raise ValueError(f'Invalid cursor {cursor!r}: unexpected _id {last_id!r}')
+    return last_id
 
 
 class UserDatabase(Database):
 
+    """
+
+    The users, looked up by email address through two caches:
+    - the users found, in an LRU cache ;
+    - the addresses not found, in a negative cache, with a shorter time-to-live.
+    Optionally, a Bloom filter of all the addresses answers for most unknown ones
+    (typos, credential stuffing) without querying the database at all.
+
+    Users modified outside of this instance must be invalidated with `invalidate_user`,
+    or the changes are seen once the cached entries expire.
+
+    """
+
+    indexes = user_indexes
+
+    # Settings of the caches, see `LRUCache`.
+    user_cache_size: int = 1024
+    user_cache_ttl: float = 300
+    negative_cache_size: int = 4096
+    negative_cache_ttl: float = 60
+
+    # Whether to build a Bloom filter of the addresses.
+    # It is rebuilt after `bloom_filter_ttl` seconds, to include the users added by other processes.
+    use_bloom_filter: bool = False
+    bloom_filter_ttl: float = 300
+
+    def _preprocess(self) -> None:
+        super()._preprocess()
+        self._users = LRUCache(max_size=self.user_cache_size, ttl=self.user_cache_ttl)
+        self._unknown_users = LRUCache(max_size=self.negative_cache_size, ttl=self.negative_cache_ttl)
+        self.bloom_filter: BloomFilter or None = None
+        self._bloom_filter_expiration = 0
+
+    def load_bloom_filter(self) -> None:
+        """
+        Builds (or rebuilds) the Bloom filter of the addresses of all the users.
+        """
+        emails = [info['email'] for info in self._collection.find({}, {'email': 1, '_id': 0}) if 'email' in info]
+        self.bloom_filter = BloomFilter.from_values(emails)
+        self._bloom_filter_expiration = time.monotonic() + self.bloom_filter_ttl
+        logging.info(f'Built the Bloom filter of {len(emails)} users')
+
+    def _might_exist(self, email_address: str) -> bool:
+        if not self.use_bloom_filter:
+            return True
+        if self.bloom_filter is None or self._bloom_filter_expiration <= time.monotonic():
+            self.load_bloom_filter()
+        return email_address in self.bloom_filter
+
+    def invalidate_user(self, email_address: str = None) -> None:
+        """
+        Hook to call when a user is added, modified or removed,
+        so that the next lookup gets it from the database.
+
+        :param str email_address: The user's address. None to invalidate all the users.
+        """
+        if email_address is None:
+            self._users.clear()
+            self._unknown_users.clear()
+            self.bloom_filter = None
+            return
+        self._users.invalidate(email_address)
+        self._unknown_users.invalidate(email_address)
+        if self.bloom_filter is not None:
+            self.bloom_filter.add(email_address)
+
+    def insert_user(self, info: dict) -> None:
+        """
+        Inserts a new user.
+
+        :param dict info: The user document, with a hashed password (see `hash_password`).
+        """
+        self._collection.insert_one(info)
+        self.invalidate_user(info['email'])
+
+    def update_user(self, email_address: str, update: dict) -> bool:
+        """
+        Updates a user.
+
+        :param str email_address: The user's address.
+        :param dict update: The update to apply, e.g. `{'$set': {'group': 'national'}}`.
+        :return bool: Whether the user was found.
+        """
+        result = self._collection.update_one({'email': email_address}, update)
+        self.invalidate_user(email_address)
+        # The address itself might have changed.
+        new_address = update.get('$set', {}).get('email')
+        if new_address is not None:
+            self.invalidate_user(new_address)
+        return result.matched_count == 1
+
     def does_user_exist(self, email_address: str) -> bool:
         """
         Takes an email address, and returns a boolean indicating whether
         the user exists in the database (True if it does, False otherwise).
         """
-        search = {'email': email_address}
-        result = self._collection.find(search)
-        return True if result.retrieved == 1 else False
+        return self.get_user_information(email_address) is not None
+
+    def get_user_information(self, email_address: str) -> dict or None:
+        """
+        Returns the document of a user, None if there is none with this address.
+        """
+        info = self._users.get(email_address)
+        if info is not None:
+            # A copy: the caller may modify it (e.g. `User` validates it in place).
+            return dict(info)
+        if email_address in self._unknown_users or not self._might_exist(email_address):
+            return None
 
-    def get_user_information(self, email_address: str):
         search = {'email': email_address}
-        return self._collection.find_one(search)
+        info = self._collection.find_one(search)
+        if info is None:
+            self._unknown_users.set(email_address, True)
+            return None
+        self._users.set(email_address, info)
+        return dict(info)
 
     def login_user(self, email: str, password: str) -> User or None:
         """
@@ -164,43 +1196,3 @@ class UserDatabase(Database):
 
         user = User(requested_user_info)
         return user
-
-
-class Cache:
-
-    cache_folder: str = '.cache/pfin/'
-
-    def __init__(self, db, collection):
-        self.create_cache_dir()
-        self._empty_cache()
-
-        self._db = db
-        self._collection = collection
-
-    def create_cache_dir(self) -> None:
-        """
-        Creates the cache directory.
-        """
-        try:
-            os.makedirs(self.cache_folder)
-        except FileExistsError:
-            pass
-
-    def _empty_cache(self) -> None:
-        # Removes all the files contained in the cache folder
-        for fl in os.listdir(self.cache_folder):
-            os.remove(os.path.join(self.cache_folder, fl))
-
-    def _get_db(self, db_name: str) -> shelve.DbfilenameShelf:
-        """
-        Gets the database specified.
-        Creates it if not present.
-        Needs for the parent directory to exist.
-
-        :param str db_name: The database name (the file name).
-        :return shelve.DbfilenameShelf:
-        """
-        db_path = os.path.join(self.cache_folder, db_name)
-        db = shelve.open(db_path)
-        logging.info(f'Opened cache file {db_path!r}')
-        return db
@@ -0,0 +1,219 @@
+"""
+
+Generates the thumbnails and the responsive sizes of the images in `static/images/fulls`.
+
+Each source image is identified by the hash of its content.
+Derivatives are rendered in a content-addressed cache,
+`<cache>/<source hash>/<size>.<format>`, and then published
+in `static/images/<size>/`, with the file name of the source.
+Sources which didn't change since the last run are neither hashed again nor rendered again.
+Rendering is spread over a pool of processes.
+
+Usage: python -m pfin.derivatives [--source DIR] [--output DIR] [--workers N] [--force]
+
+"""
+
+import os
+import json
+import shutil
+import logging
+import argparse
+
+from typing import List, Dict, Tuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from . import configure_logging
+from .utils import hash_file
+from .image import thumbnail_name
+
+
+# Name of the size -> maximum width, in pixels.
+sizes: Dict[str, int] = {
+    'thumbs': 360,
+    'small': 640,
+    'medium': 1280,
+    'large': 1920,
+}
+
+# Format -> (file extension, Pillow save options).
+formats: Dict[str, Tuple[str, dict]] = {
+    'JPEG': ('jpg', {'quality': 85, 'optimize': True, 'progressive': True}),
+    'WEBP': ('webp', {'quality': 80, 'method': 4}),
+}
+
+source_extensions = ('.jpg', '.jpeg', '.png', '.webp')
+
+cache_folder: str = '.cache/pfin/derivatives/'
+manifest_name: str = 'manifest.json'
+
+
+def derivative_names(digest: str) -> List[Tuple[str, str, str]]:
+    """
+    Returns the derivatives of a source, as tuples `(size name, format, path in the cache)`.
+    """
+    names = []
+    for size_name in sizes:
+        for image_format, (extension, _) in formats.items():
+            path = os.path.join(cache_folder, digest[:2], digest, f'{size_name}.{extension}')
+            names.append((size_name, image_format, path))
+    return names
+
+
+def render(source: str, digest: str) -> str:
+    """
+    Renders all the derivatives of a source image in the cache.
+    Runs in a worker process.
+
+    :param str source: Path of the source image.
+    :param str digest: Hash of the source image.
+    :return str: The source path.
+    """
+    from PIL import Image, ImageOps
+
+    with Image.open(source) as original:
+        largest = max(sizes.values())
+        if original.format == 'JPEG':
+            # Let the decoder downscale by a power of two while decoding, which is much faster.
+            original.draft('RGB', (largest, largest))
+        image = ImageOps.exif_transpose(original)
+        if image.mode in ('RGBA', 'LA', 'PA', 'RGBa', 'La') or 'transparency' in image.info:
+            # JPEG has no alpha channel: the transparent areas are shown on white, rather than black.
+            image = Image.alpha_composite(Image.new('RGBA', image.size, 'white'), image.convert('RGBA'))
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+
+        # From the largest to the smallest, each one being resized from the previous one.
+        current = image
+        for size_name, width in sorted(sizes.items(), key=lambda item: item[1], reverse=True):
+            if current.width > width:
+                current = current.resize((width, max(1, round(current.height * width / current.width))),
+                                         Image.LANCZOS)
+            for image_format, (extension, options) in formats.items():
+                path = os.path.join(cache_folder, digest[:2], digest, f'{size_name}.{extension}')
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Write to a temporary file, so that an interrupted run doesn't leave broken files.
+                temporary = f'{path}.tmp'
+                current.save(temporary, image_format, **options)
+                os.replace(temporary, path)
+    return source
+
+
+def publish(source: str, digest: str, output: str) -> None:
+    """
+    Links (or copies, if linking is not possible) the derivatives of a source
+    from the cache to the output directory.
+    The JPEG derivatives are named after the source, see `pfin.image.thumbnail_name`.
+    """
+    stem, extension = os.path.splitext(os.path.basename(source))
+    for size_name, image_format, path in derivative_names(digest):
+        if image_format == 'JPEG':
+            name = thumbnail_name(stem, extension[1:])
+        else:
+            name = f'{stem}.{formats[image_format][0]}'
+        destination = os.path.join(output, size_name, name)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        if os.path.exists(destination):
+            if os.path.samefile(path, destination):
+                continue
+            os.remove(destination)
+        try:
+            os.link(path, destination)
+        except OSError:
+            shutil.copyfile(path, destination)
+
+
+def load_manifest() -> dict:
+    """
+    Loads the manifest, which maps a source path to its size, modification time and hash.
+    """
+    try:
+        with open(os.path.join(cache_folder, manifest_name)) as fl:
+            return json.load(fl)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def save_manifest(manifest: dict) -> None:
+    os.makedirs(cache_folder, exist_ok=True)
+    temporary = os.path.join(cache_folder, f'{manifest_name}.tmp')
+    with open(temporary, 'w') as fl:
+        json.dump(manifest, fl)
+    os.replace(temporary, os.path.join(cache_folder, manifest_name))
+
+
+def generate(source_dir: str, output_dir: str, workers: int = None, force: bool = False) -> dict:
+    """
+    Generates the derivatives of all the images of a directory.
+
+    :param str source_dir: The directory holding the full-size images.
+    :param str output_dir: The directory in which the sizes' directories are created.
+    :param int workers: Number of worker processes. Defaults to the number of CPUs.
+    :param bool force: Render everything again, ignoring the cache.
+    :return dict: Statistics of the run.
+    """
+    manifest = {} if force else load_manifest()
+    stats = {'sources': 0, 'hashed': 0, 'rendered': 0, 'failed': 0}
+
+    to_render = []
+    to_publish = []
+    for entry in sorted(os.scandir(source_dir), key=lambda e: e.name):
+        if not entry.is_file() or not entry.name.lower().endswith(source_extensions):
+            continue
+        stats['sources'] += 1
+        stat = entry.stat()
+        signature = [stat.st_size, stat.st_mtime_ns]
+        known = manifest.get(entry.path)
+        if known is not None and known[:2] == signature:
+            # Unchanged since the last run: no need to read it.
+            digest = known[2]
+        else:
+            digest = hash_file(entry.path)
+            stats['hashed'] += 1
+            manifest[entry.path] = signature + [digest]
+        if force or not all(os.path.exists(path) for _, _, path in derivative_names(digest)):
+            to_render.append((entry.path, digest))
+        else:
+            to_publish.append((entry.path, digest))
+
+    if to_render:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(render, source, digest): (source, digest) for source, digest in to_render}
+            for future in as_completed(futures):
+                source, digest = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logging.error(f'Could not render {source!r}: {e}')
+                    manifest.pop(source, None)
+                    stats['failed'] += 1
+                else:
+                    to_publish.append((source, digest))
+                    stats['rendered'] += 1
+
+    for source, digest in to_publish:
+        publish(source, digest, output_dir)
+
+    # Forget the sources which were removed.
+    for path in list(manifest):
+        if not os.path.exists(path):
+            del manifest[path]
+    save_manifest(manifest)
+    return stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--source', default='static/images/fulls', help='Directory of the full-size images.')
+    parser.add_argument('--output', default='static/images', help='Directory in which to publish the sizes.')
+    parser.add_argument('--workers', type=int, default=None, help='Number of worker processes.')
+    parser.add_argument('--force', action='store_true', help='Render everything again.')
+    args = parser.parse_args()
+    configure_logging()
+
+    stats = generate(args.source, args.output, workers=args.workers, force=args.force)
+    print(f"{stats['sources']} sources, {stats['hashed']} hashed, "
+          f"{stats['rendered']} rendered, {stats['failed']} failed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+"""
+
+Streaming exports of search results, built on the fly, in constant memory:
+- NDJSON: one JSON object per line, holding the metadata of an image ;
+- ZIP: the original files, stored without compression (they are already compressed),
+  written to an unseekable stream: the sizes and checksums of each entry
+  follow its data, in a data descriptor.
+
+Each function returns a generator of byte chunks, meant to be passed to a streaming HTTP response.
+
+"""
+
+import os
+import json
+import logging
+import zipfile
+
+from typing import Iterable, Iterator, List
+
+from .image import Image, ImageView
+
+
+# Size of the chunks yielded, in bytes.
+chunk_size: int = 64 * 1024
+
+# Size of the blocks read from the files, in bytes.
+read_size: int = 1024 * 1024
+
+
+def iter_ndjson(images: Iterable[Image or ImageView], fields: List[str]) -> Iterator[bytes]:
+    """
+    Yields the metadata of images as NDJSON, with their URLs.
+
+    :param images: The images, e.g. from `ImageDatabase.iter_search`.
+    :param list fields: The fields to export. `_id` is not serializable as JSON, and is skipped.
+    """
+    fields = [field for field in fields if field != '_id']
+    buffer = []
+    size = 0
+    # The first record is sent on its own, so that the response starts right away.
+    threshold = 1
+    for image in images:
+        record = {field: getattr(image, field) for field in fields}
+        record['full'], record['thumb'] = image.get_url()
+        line = json.dumps(record, ensure_ascii=False).encode() + b'\n'
+        buffer.append(line)
+        size += len(line)
+        if size >= threshold:
+            yield b''.join(buffer)
+            buffer.clear()
+            size = 0
+            threshold = chunk_size
+    if buffer:
+        yield b''.join(buffer)
+
+
+class _StreamBuffer:
+
+    """
+    Unseekable file-like object collecting what `zipfile` writes,
+    until it is taken by the generator.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        self.size = 0
+        return data
+
+
+def iter_zip(images: Iterable[Image or ImageView], images_dir: str) -> Iterator[bytes]:
+    """
+    Yields a ZIP archive of the original files of images.
+    Missing files are skipped.
+
+    :param images: The images, e.g. from `ImageDatabase.iter_search`. Only `id` and `extension` are used.
+    :param str images_dir: The directory holding the original files, named after the `id`s.
+    """
+    stream = _StreamBuffer()
+    with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for image in images:
+            file_name = f'{image.id}.{image.extension}'
+            path = os.path.join(images_dir, file_name)
+            try:
+                info = zipfile.ZipInfo.from_file(path, file_name)
+                source = open(path, 'rb')
+            except OSError as e:
+                logging.warning(f'Skipping {path!r} in the export: {e}')
+                continue
+            with source, archive.open(info, 'w') as entry:
+                while True:
+                    block = source.read(read_size)
+                    if not block:
+                        break
+                    entry.write(block)
+                    if stream.size >= chunk_size:
+                        yield stream.take()
+            yield stream.take()
+    # The central directory, written when the archive is closed.
+    yield stream.take()
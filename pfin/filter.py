@@ -1,9 +1,30 @@
+import re
 import logging
 
-from .utils import decode_json
-
+from functools import lru_cache
 from typing import List
 
+from .rights import parse_usage_end
+
+
+# Maximum number of compiled queries kept in memory.
+plan_cache_size: int = 512
+
+# Criteria stored in a plan, after the global operator.
+plan_criteria = (
+    'text_filter',
+    'image_type',
+    'product_in',
+    'human_in',
+    'institutional',
+    'picture_format',
+    'author_credits',
+    'limited_usage',
+    'usage_end',
+    'tags',
+    'usable',
+)
+
 
 class Filter:
 
@@ -23,11 +44,14 @@ class Filter:
                  picture_format: str = None,
                  author_credits: str = None,
                  limited_usage: str = None,
-                 usage_end: int = None,
+                 usage_end: str = None,
                  tags: list = None,
+                 usable: bool = None,
                  ):
         """
-        :param str text_filter: A search to apply on the file name. Hint: it's useless.
+        :param str text_filter: A search to apply on the file name.
+                                With a full-text index (see `ImageDatabase`), a ranked search
+                                on the file name, the credits and the tags.
         :param str image_type: Type of image. Can be any of {'PassionFroid', 'Fournisseur', 'Logo'}
         :param bool product_in: Whether a product is in the picture
         :param bool human_in: Whether a human is in the picture
@@ -35,7 +59,11 @@ class Filter:
         :param bool picture_format: Which format is the picture. True for vertical, False for horizontal.
         :param str author_credits: Similar to the text filter, for author credits.
         :param bool limited_usage: Whether the picture's usage is limited.
+        :param str usage_end: A date, as "YYYY-MM-DD" or "DD/MM/YYYY" (see `rights.parse_usage_end`).
+                              Only the pictures which can be used at least until then are kept.
         :param list tags: A list of tags. An "and" operator is used.
+        :param bool usable: Whether the picture's rights currently allow its use, see `pfin.rights`.
+                            Pictures without the flag are considered usable.
         """
         self._global_operator = True
         self._text_filter = text_filter
@@ -46,109 +74,156 @@ class Filter:
         self._picture_format = picture_format
         self._author_credits = author_credits
         self._limited_usage = limited_usage
+        self._usage_end = usage_end
         self._tags = tags
+        self._usable = usable
 
-    def text_filter(self) -> str:
+    def criteria(self) -> dict:
+        """
+        Returns the criteria of this filter that are set,
+        as keyword arguments of the constructor.
+        Can be used to create a modified copy of the filter.
+        """
+        criteria = {
+            'text_filter': self._text_filter,
+            'image_type': self._image_type,
+            'product_in': self._product_in,
+            'human_in': self._human_in,
+            'institutional': self._institutional,
+            'picture_format': self._picture_format,
+            'author_credits': self._author_credits,
+            'limited_usage': self._limited_usage,
+            'usage_end': self._usage_end,
+            'tags': self._tags,
+            'usable': self._usable,
+        }
+        return {key: value for key, value in criteria.items() if value is not None}
+
+    def replace(self, **criteria) -> 'Filter':
+        """
+        Returns a copy of this filter, with some criteria changed.
+        """
+        f = Filter(**{**self.criteria(), **criteria})
+        f._global_operator = self._global_operator
+        return f
+
+    def text_filter(self) -> dict:
         field = 'id'
         value = self._text_filter
-        query = '{'
-        query += f'"{field}": ' + '{"$regex": ' + f'"{value}"' + '}'
-        query += '}'
-        return query
+        return {field: {'$regex': re.escape(value)}}
 
-    def image_type(self) -> str:
-        field = 'image_type'
+    def image_type(self) -> dict:
+        field = 'type'
         value = self._image_type
-        query = '{'
-        query += f'"{field}": "{value}"'
-        query += '}'
-        return query
+        return {field: value}
 
-    def product_in(self) -> str:
+    def product_in(self) -> dict:
         field = 'product_in'
         value = self._product_in
-        query = '{'
-        query += f'"{field}": "{value}"'
-        query += '}'
-        return query
+        return flag_clause(field, value)
 
-    def human_in(self) -> str:
+    def human_in(self) -> dict:
         field = 'human_in'
         value = self._human_in
-        query = '{'
-        query += f'"{field}": "{value}"'
-        query += '}'
-        return query
+        return flag_clause(field, value)
 
-    def institutional(self) -> str:
+    def institutional(self) -> dict:
         field = 'institutional'
         value = self._institutional
-        query = '{'
-        query += f'"{field}": "{value}"'
-        query += '}'
-        return query
+        return flag_clause(field, value)
 
-    def picture_format(self) -> str:
+    def picture_format(self) -> dict:
         field = 'format'
         value = self._picture_format
-        query = '{'
-        query += f'"{field}": "{value}"'
-        query += '}'
-        return query
+        return flag_clause(field, value)
 
-    def author_credits(self) -> str:
-        field = 'id'
-        value = self._text_filter
-        query = '{'
-        query += f'"{field}": ' + '{"$regex": ' + f'"{value}"' + '}'
-        query += '}'
-        return query
+    def author_credits(self) -> dict:
+        field = 'credits'
+        value = self._author_credits
+        return {field: {'$regex': re.escape(value)}}
 
-    def limited_usage(self) -> str:
+    def limited_usage(self) -> dict:
         field = 'limited_usage'
         value = self._limited_usage
-        query = '{'
-        query += f'"{field}": "{value}"'
-        query += '}'
-        return query
+        return flag_clause(field, value)
+
+    def usage_end(self) -> dict:
+        # Parsed like the stored dates, which `rights.sync` rewrites as ISO dates, ordered like the strings.
+        end = parse_usage_end(self._usage_end)
+        if end is None:
+            return {}
+        # Images without the flag aren't limited.
+        not_limited = {'limited_usage': {'$nin': [True, 'true']}}
+        return {'$or': [not_limited, {'usage_end': {'$gte': end.isoformat()}}]}
+
+    def usable(self) -> dict:
+        field = 'usable'
+        value = self._usable
+        # The flag is only ever stored as a boolean. Images without it (e.g. inserted by other means)
+        # are kept: the ones whose rights ended are flagged by `ImageDatabase.expire_rights`.
+        if value in (True, 'true'):
+            return {field: {'$ne': False}}
+        if value in (False, 'false'):
+            return {field: False}
+        return {field: value}
 
-    def tags(self) -> str:
+    def tags(self) -> dict:
         field = 'tags'
-        query = '{'
-        if len(self._tags) > 1:
-            operator = '$and'
-            query += f'"{operator}": '
-            query += '['
-            for tag in self._tags:
-                query += '{'
-                query += f'"{field}": ' + '{"$regex": ' + f'".*{tag}.*' + '"}'
-                query += '},'
-            else:
-                query = query[:-1]  # Remove the trailing comma.
-            query += ']'
-        elif len(self._tags) == 1:
-            tag = self._tags[0]
-            query += f'"{field}": ' + '{"$regex": ' + f'".*{tag}.*' + '"}'
-        query += '}'
-        return query
+        # The tags are searched anywhere in the tag, hence the unanchored regex.
+        clauses = [{field: {'$regex': re.escape(tag)}} for tag in self._tags]
+        if len(clauses) > 1:
+            return {'$and': clauses}
+        elif len(clauses) == 1:
+            return clauses[0]
+        else:
+            return {}
 
-    def aggregate_all_queries(self, queries: List[str]) -> str or None:
+    def aggregate_all_queries(self, queries: List[dict]) -> dict:
         if len(queries) > 1:
             operator = "$and" if self._global_operator else "$or"
-            query = '{'
-            query += f'"{operator}": ['
-            for q in queries:
-                query += f'{q},'
-            else:
-                query = query[:-1]
-            query += ']}'
+            query = {operator: queries}
         elif len(queries) == 1:
             query = queries[0]
         else:
-            query = None
+            query = {}
         return query
 
-    def forge_query(self) -> dict:
+    def plan(self) -> tuple:
+        """
+        Returns the normalized form of this filter.
+        It is hashable, and two filters selecting the same images have the same plan,
+        whatever the order of their tags.
+        """
+        tags = self._tags
+        if tags is not None:
+            tags = tuple(sorted(set(tags)))
+        return (
+            self._global_operator,
+            self._text_filter,
+            self._image_type,
+            self._product_in,
+            self._human_in,
+            self._institutional,
+            self._picture_format,
+            self._author_credits,
+            self._limited_usage,
+            self._usage_end,
+            tags,
+            self._usable,
+        )
+
+    @classmethod
+    def from_plan(cls, plan: tuple) -> 'Filter':
+        global_operator, *criteria = plan
+        f = cls(**dict(zip(plan_criteria, criteria)))
+        f._global_operator = global_operator
+        return f
+
+    def compile(self) -> dict:
+        """
+        Builds the MongoDB query corresponding to this filter.
+        Prefer `forge_query`, which caches the result.
+        """
         queries = []
 
         # We explicit "is not None" because some values are boolean.
@@ -177,12 +252,46 @@ class Filter:
         if self._limited_usage is not None:
             queries.append(self.limited_usage())
 
+        if self._usage_end is not None:
+            queries.append(self.usage_end())
+
         if self._tags is not None:
             queries.append(self.tags())
 
-        query = self.aggregate_all_queries(queries)
-        if query is not None:
-            logging.debug(f'{query=}')
-            return decode_json(query)
-        else:
-            return {}
+        if self._usable is not None:
+            queries.append(self.usable())
+
+        return self.aggregate_all_queries(queries)
+
+    def forge_query(self) -> dict:
+        """
+        Returns the MongoDB query corresponding to this filter.
+        Queries are cached by plan, so the returned dictionary is shared
+        and must not be modified.
+        """
+        return compile_plan(self.plan())
+
+
+def flag_clause(field: str, value) -> dict:
+    """
+    Returns the clause matching a boolean field.
+    Flags are stored either as booleans or as their string form ("true" / "false"),
+    so both are matched.
+    """
+    if value in (True, 'true'):
+        return {field: {'$in': [True, 'true']}}
+    if value in (False, 'false'):
+        return {field: {'$in': [False, 'false']}}
+    return {field: value}
+
+
+@lru_cache(maxsize=plan_cache_size)
+def compile_plan(plan: tuple) -> dict:
+    """
+    Compiles a filter plan (see `Filter.plan`) into a MongoDB query.
+    Results are kept in a bounded LRU cache.
+    """
+    query = Filter.from_plan(plan).compile()
+    # Formatted only if debug messages are shown.
+    logging.debug('query=%s', query)
+    return query
@@ -0,0 +1,219 @@
+"""
+
+Ranked full-text search over the images' `id`, `credits` and `tags`.
+
+Texts are split into tokens, folded to lower case and stripped of their accents,
+so that "Été" and "ete" match. Documents are ranked with BM25,
+and the last token of a query is a prefix, for search-as-you-type.
+
+"""
+
+import re
+import math
+import heapq
+import logging
+import unicodedata
+import numpy as np
+
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+
+
+_token_pattern = re.compile(r'[a-z0-9]+')
+
+# Fields of the images which are indexed.
+text_fields = ('id', 'credits', 'tags')
+
+
+def fold(text: str) -> str:
+    """
+    Returns a text in lower case, without accents, e.g. "Crème Brûlée" -> "creme brulee".
+    """
+    decomposed = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(c for c in decomposed if not unicodedata.combining(c))
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Returns the folded tokens of a text, in order.
+    """
+    return _token_pattern.findall(fold(text))
+
+
+def document_tokens(document: dict) -> List[str]:
+    """
+    Returns the tokens of the indexed fields of an image document.
+    """
+    tokens = []
+    for field in text_fields:
+        value = document.get(field)
+        values = value if isinstance(value, list) else [value]
+        for text in values:
+            if isinstance(text, str):
+                tokens += tokenize(text)
+    return tokens
+
+
+class FullTextIndex:
+
+    """
+
+    Inverted index of the tokens of the images, scored with BM25.
+
+    Like `TagIndex`, each indexed document is given a number, in insertion order.
+    We keep, for each token, the number of occurrences in each document having it,
+    and the sorted vocabulary, which is used to expand the prefixes.
+    The postings are converted to arrays when they are first searched after a change,
+    so that the scores are computed with vectorized operations.
+
+    """
+
+    # Parameters of BM25: saturation of the term frequency, and normalization by the length.
+    k1: float = 1.2
+    b: float = 0.75
+
+    # Maximum number of tokens a prefix expands to. The most frequent ones are kept.
+    max_expansions: int = 64
+
+    def __init__(self):
+        self._keys = []  # Document number -> key (the MongoDB `_id`).
+        self._numbers = {}  # Key -> document number.
+        self._counts: Dict[int, Dict[str, int]] = {}  # Document number -> token -> occurrences.
+        self._lengths: List[int] = []  # Document number -> number of tokens (0 once removed).
+        self._total_length = 0
+        self._postings: Dict[str, Dict[int, int]] = {}  # Token -> document number -> occurrences.
+        # Caches, invalidated when the documents change.
+        self._vocabulary: List[str] or None = None  # Sorted tokens.
+        self._arrays: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}  # Token -> (numbers, occurrences).
+        self._length_array: np.ndarray or None = None
+
+    @classmethod
+    def from_collection(cls, collection) -> 'FullTextIndex':
+        """
+        Builds the index from all the documents of a collection.
+        Only the indexed fields are fetched.
+        """
+        index = cls()
+        for document in collection.find({}, {field: 1 for field in text_fields}):
+            index.add(document['_id'], document)
+        logging.info(f'Indexed the text of {len(index)} documents')
+        return index
+
+    def __len__(self) -> int:
+        return len(self._numbers)
+
+    def add(self, key, document: dict) -> None:
+        """
+        Indexes the text of a document.
+        If the document was already indexed, its text is replaced.
+        """
+        if key in self._numbers:
+            self.remove(key)
+        number = len(self._keys)
+        self._keys.append(key)
+        self._numbers[key] = number
+        counts = {}
+        tokens = document_tokens(document)
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        self._counts[number] = counts
+        self._lengths.append(len(tokens))
+        self._total_length += len(tokens)
+        self._length_array = None
+        for token, count in counts.items():
+            postings = self._postings.get(token)
+            if postings is None:
+                postings = self._postings[token] = {}
+                self._vocabulary = None
+            postings[number] = count
+            self._arrays.pop(token, None)
+
+    def remove(self, key) -> None:
+        """
+        Removes a document from the index.
+        """
+        number = self._numbers.pop(key, None)
+        if number is None:
+            return
+        self._total_length -= self._lengths[number]
+        self._lengths[number] = 0
+        self._length_array = None
+        for token in self._counts.pop(number):
+            postings = self._postings[token]
+            del postings[number]
+            self._arrays.pop(token, None)
+            if not postings:
+                del self._postings[token]
+                self._vocabulary = None
+
+    def expand(self, prefix: str) -> List[str]:
+        """
+        Returns the indexed tokens starting with a prefix,
+        limited to the `max_expansions` most frequent ones.
+        """
+        if self._vocabulary is None:
+            self._vocabulary = sorted(self._postings)
+        start = bisect_left(self._vocabulary, prefix)
+        end = bisect_left(self._vocabulary, prefix + chr(0x10FFFF), start)
+        tokens = self._vocabulary[start:end]
+        if len(tokens) > self.max_expansions:
+            tokens = heapq.nlargest(self.max_expansions, tokens, key=lambda token: len(self._postings[token]))
+        return tokens
+
+    def _scores(self, token: str) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the numbers of the documents having a token, and its BM25 score in each of them.
+        """
+        arrays = self._arrays.get(token)
+        if arrays is None:
+            postings = self._postings.get(token, {})
+            arrays = (np.fromiter(postings.keys(), dtype=np.int64, count=len(postings)),
+                      np.fromiter(postings.values(), dtype=np.float64, count=len(postings)))
+            self._arrays[token] = arrays
+        if self._length_array is None:
+            self._length_array = np.array(self._lengths, dtype=np.float64)
+
+        numbers, counts = arrays
+        n = len(self._numbers)
+        idf = math.log(1 + (n - len(numbers) + 0.5) / (len(numbers) + 0.5))
+        average_length = self._total_length / n if self._total_length else 1
+        norms = self.k1 * (1 - self.b + self.b * self._length_array[numbers] / average_length)
+        return numbers, idf * counts * (self.k1 + 1) / (counts + norms)
+
+    def search(self, text: str, prefix: bool = True, limit: int = 0) -> List[Tuple[object, float]]:
+        """
+        Returns the documents having all the tokens of a text, by decreasing relevance.
+
+        :param str text: The searched text.
+        :param bool prefix: Whether the last token is a prefix, e.g. "gla" matching "glace".
+                            A document having several tokens starting with it is scored on the best one.
+        :param int limit: The maximum number of documents to return. 0 means no limit.
+        :return list: The keys of the documents, with their scores.
+        """
+        tokens = tokenize(text)
+        if not tokens or not self._numbers:
+            return []
+
+        # Each group of tokens must be matched: a token, or the expansions of the prefix.
+        groups = [[token] for token in dict.fromkeys(tokens[:-1] if prefix else tokens)]
+        if prefix:
+            groups.append(self.expand(tokens[-1]))
+
+        size = len(self._keys)
+        scores = np.zeros(size)
+        matched = np.zeros(size, dtype=np.int32)
+        for group in groups:
+            best = np.zeros(size)
+            for token in group:
+                numbers, token_scores = self._scores(token)
+                best[numbers] = np.maximum(best[numbers], token_scores)
+            scores += best
+            matched += best > 0
+        candidates = np.flatnonzero(matched == len(groups))
+
+        # Ties are broken by insertion order.
+        if limit and len(candidates) > limit:
+            candidates = candidates[np.argpartition(-scores[candidates], limit - 1)[:limit]]
+        candidates = candidates[np.lexsort((candidates, -scores[candidates]))]
+        keys = self._keys
+        return [(keys[number], score) for number, score in zip(candidates.tolist(), scores[candidates].tolist())]
@@ -1,8 +1,10 @@
 import os
+import bson
 
-from typing import Tuple
+from functools import wraps
+from typing import List, Tuple, Iterable, Mapping
 
-from .utils import validate_fields
+from .utils import compile_validator, validate_batch
 from .config import IMAGE_HOST_URL
 
 
@@ -21,14 +23,21 @@ image_structure = {
     'copyright': bool,  # If the usage is limited, True, False otherwise.
     'usage_end': str,  # Date of end of rights.
     'tags': list,  # A list of tags.
+    'phash': str,  # Perceptual hash, see `pfin.phash`.
+    'usable': bool,  # Whether its rights currently allow its use, see `pfin.rights`.
 }
 
 
+validate_image = compile_validator(image_structure)
+
+
 def validate_info(func):
     """
     Decorator used to validate the image information passed.
     That way, we can be assured all images have exactly the same information.
+    The undecorated class is available as `__wrapped__`.
     """
+    @wraps(func, updated=())
     def wrapper(*args, **kwargs):
         if len(args) > 0:
             dictionary = args[0]
@@ -36,10 +45,20 @@ def validate_info(func):
             dictionary = kwargs['info']
         else:
             raise ValueError(f"Missing required argument 'info'. ({args}, {kwargs})")
-        return func(validate_fields(dictionary, image_structure))
+        return func(validate_image(dictionary))
     return wrapper
 
 
+def thumbnail_name(name: str, extension: str) -> str:
+    """
+    Returns the file name of the thumbnail (and of the other JPEG sizes) of an image, see `pfin.derivatives`.
+    They are JPEG files: the images of other types get a "jpg" extension.
+    """
+    if extension.lower() not in ('jpg', 'jpeg'):
+        extension = 'jpg'
+    return f'{name}.{extension}'
+
+
 @validate_info
 class Image:
 
@@ -53,5 +72,76 @@ class Image:
     def get_url(self) -> Tuple[str, str]:
         file_name = f'{self.id}.{self.extension}'
         full = f'{os.path.join(IMAGE_HOST_URL, "fulls/", file_name)}'
-        thumb = f'{os.path.join(IMAGE_HOST_URL, "thumbs/", file_name)}'
+        thumb = f'{os.path.join(IMAGE_HOST_URL, "thumbs/", thumbnail_name(self.id, self.extension))}'
+        return full, thumb
+
+
+def build_images(documents: List[dict]) -> List[Image]:
+    """
+    Validates a whole result set in one pass, and builds the images.
+    """
+    return [Image.__wrapped__(info) for info in validate_batch(documents, validate_image)]
+
+
+def validate_projection(fields: Iterable[str]) -> frozenset:
+    """
+    Checks that the fields of a projection are part of the image structure.
+    Done once per result set, instead of validating each document.
+
+    :param fields: The names of the fields to project.
+    :return frozenset: The fields, along with `_id`, which is always returned by MongoDB.
+    :raises ValueError: If a field is unknown.
+    """
+    fields = frozenset(fields) | {'_id'}
+    unknown = fields.difference(image_structure)
+    if unknown:
+        raise ValueError(f'Unknown image fields {sorted(unknown)}. Pick from {list(image_structure)}')
+    return fields
+
+
+class ImageView:
+
+    """
+
+    Compact, read-only view over an image document restricted to a projection.
+
+    The document is kept as is (usually a raw BSON document) until a field is accessed.
+    It is then decoded once, its projected fields are stored in slots,
+    and the document is released.
+    Projected fields missing from the document take their default value.
+
+    """
+
+    __slots__ = ('_document', '_fields') + tuple(image_structure)
+
+    def __init__(self, document: Mapping, fields: frozenset):
+        """
+        :param Mapping document: The image document, e.g. a `bson.raw_bson.RawBSONDocument`.
+        :param frozenset fields: The projected fields, as returned by `validate_projection`.
+        """
+        self._document = document
+        self._fields = fields
+
+    def _decode(self) -> None:
+        document = self._document
+        if hasattr(document, 'raw'):
+            # Raw BSON document: decode it directly instead of going through its mapping interface.
+            document = bson.decode(document.raw)
+        for field in self._fields:
+            value = document.get(field)
+            setattr(self, field, image_structure[field]() if value is None else value)
+        self._document = None
+
+    def __getattr__(self, name: str):
+        # Only called when the attribute is not set, i.e. before decoding,
+        # or for names outside the projection.
+        if name not in self._fields or self._document is None:
+            raise AttributeError(f'Field {name!r} is not part of the projection {sorted(self._fields)}')
+        self._decode()
+        return getattr(self, name)
+
+    def get_url(self) -> Tuple[str, str]:
+        file_name = f'{self.id}.{self.extension}'
+        full = f'{os.path.join(IMAGE_HOST_URL, "fulls/", file_name)}'
+        thumb = f'{os.path.join(IMAGE_HOST_URL, "thumbs/", thumbnail_name(self.id, self.extension))}'
         return full, thumb
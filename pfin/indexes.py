@@ -0,0 +1,141 @@
+"""
+
+Indexes of the collections, and verification of the plans of the searches.
+
+The indexes are declared here, and created by `Database.ensure_indexes`,
+on the first access to a collection (see `Database.create_indexes`), or with the command:
+
+    python -m pfin.indexes create
+
+`check` explains representative queries forged by `Filter`, and reports
+those which scan the whole collection:
+
+    python -m pfin.indexes check
+
+"""
+
+import logging
+import argparse
+
+from typing import Dict, List
+
+from pymongo import ASCENDING, IndexModel
+from pymongo.collection import Collection
+from pymongo.errors import OperationFailure
+
+from . import configure_logging
+from .filter import Filter
+
+
+# Most searches are paginated on `_id` (see `ImageDatabase.search_page`),
+# so `_id` follows the equality criteria, for the results to be read in order.
+image_indexes: List[IndexModel] = [
+    # Looked up by `get_images`, and matched by the text filter.
+    IndexModel([('id', ASCENDING)], name='id', unique=True),
+    # Multikey: one entry per tag.
+    IndexModel([('tags', ASCENDING)], name='tags'),
+    IndexModel([('type', ASCENDING), ('_id', ASCENDING)], name='type__id'),
+    IndexModel([('credits', ASCENDING), ('_id', ASCENDING)], name='credits__id'),
+    # The flags are combined freely, so each one has its own index,
+    # rather than a compound one usable only through its prefix.
+    *(IndexModel([(field, ASCENDING), ('_id', ASCENDING)], name=f'{field}__id')
+      for field in ('product_in', 'human_in', 'institutional', 'format', 'limited_usage', 'usable')),
+]
+
+user_indexes: List[IndexModel] = [
+    # Users are looked up by address, which must be unique.
+    IndexModel([('email', ASCENDING)], name='email', unique=True),
+]
+
+# Filters whose queries are explained by `check`, one per criterion, and the form's defaults.
+# Like the searches, they are restricted to the usable images (see `ImageDatabase.exclude_unusable`).
+representative_filters: Dict[str, Filter] = {name: f.replace(usable=True) for name, f in {
+    'default': Filter(),
+    'text': Filter(text_filter='a'),
+    'type': Filter(image_type='PassionFroid'),
+    'product_in': Filter(product_in='true'),
+    'human_in': Filter(human_in='true'),
+    'institutional': Filter(institutional='true'),
+    'format': Filter(picture_format='true'),
+    'limited_usage': Filter(limited_usage='true'),
+    'tags': Filter(tags=['glace']),
+    'form': Filter(product_in='true', human_in='false', institutional='true', tags=['été']),
+}.items()}
+
+
+def ensure_indexes(collection: Collection, indexes: List[IndexModel]) -> List[str]:
+    """
+    Creates the indexes missing from a collection. Existing ones are left untouched.
+    They are created one by one, so that an index which can't be created,
+    e.g. a unique one violated by duplicates, doesn't prevent the others from being built.
+
+    :return list: The names of the indexes ensured, without those which couldn't be created.
+    """
+    names = []
+    for index in indexes:
+        try:
+            names += collection.create_indexes([index])
+        except OperationFailure as e:
+            logging.error(f'Could not create the index {index.document["name"]!r} '
+                          f'of {collection.full_name!r}: {e}')
+    if names:
+        logging.info(f'Ensured the indexes {names} of {collection.full_name!r}')
+    return names
+
+
+def _stages(plan: dict) -> List[str]:
+    """
+    Returns the stages of a query plan, from the root to the leaves.
+    """
+    stages = [plan.get('stage', '')]
+    for key in ('inputStage', 'queryPlan'):
+        if key in plan:
+            stages += _stages(plan[key])
+    for child in plan.get('inputStages', []):
+        stages += _stages(child)
+    return stages
+
+
+def collection_scans(collection: Collection, filters: Dict[str, Filter] = None) -> Dict[str, List[str]]:
+    """
+    Explains the queries of filters, and returns those whose plan scans the whole collection.
+
+    :param dict filters: The filters to check, by name. Defaults to `representative_filters`.
+    :return dict: The stages of the plans containing a collection scan, by filter name.
+    """
+    scans = {}
+    for name, f in (filters or representative_filters).items():
+        query = f.forge_query()
+        plan = collection.find(query).explain()['queryPlanner']['winningPlan']
+        stages = _stages(plan)
+        if 'COLLSCAN' in stages:
+            logging.warning(f'The {name!r} search scans {collection.full_name!r}: {query} ; plan: {stages}')
+            scans[name] = stages
+    return scans
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('action', choices=['create', 'check'])
+    parser.add_argument('--database', default='PFIN')
+    args = parser.parse_args()
+    configure_logging()
+
+    from .database import ImageDatabase, UserDatabase
+
+    image_db = ImageDatabase(args.database, 'images')
+    user_db = UserDatabase(args.database, 'users')
+    if args.action == 'create':
+        # Every collection is processed, then the command fails if an index is missing.
+        missing = [db for db in (image_db, user_db) if len(db.ensure_indexes()) < len(db.indexes)]
+        if missing:
+            raise SystemExit(1)
+    else:
+        scans = collection_scans(image_db._collection)
+        print(f'{len(scans)} of {len(representative_filters)} searches scan the collection')
+        if scans:
+            raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
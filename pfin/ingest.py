@@ -0,0 +1,324 @@
+"""
+
+Ingests a directory of images in the catalog.
+
+The files are hashed in parallel (the hash being the image's `id`),
+their dimensions are read from their header only, and the documents
+are written with batched, unordered upserts keyed on the `id`:
+ingesting the same file twice is a no-op.
+A checkpoint of the committed files lets an interrupted ingestion resume
+without reading them again.
+With `--skip-near-duplicates`, the perceptual hash of each image is computed as well,
+and images looking like one already in the catalog (or earlier in the run) are not inserted.
+Otherwise, the images are not decoded: their hashes are computed later with `python -m pfin.phash backfill`.
+
+Usage: python -m pfin.ingest DIRECTORY [--destination DIR] [--batch-size N] [--workers N]
+                                       [--type TYPE] [--credits CREDITS] [--tags TAG;TAG]
+                                       [--skip-near-duplicates RADIUS]
+
+"""
+
+import os
+import json
+import shutil
+import struct
+import logging
+import argparse
+
+from hashlib import sha256
+from typing import List, Tuple, Iterator
+from concurrent.futures import ThreadPoolExecutor
+
+from . import configure_logging
+from .utils import hash_file
+from .image import validate_image
+from .phash import PerceptualIndex, phash_file, from_hex
+from .rights import is_usable
+
+
+image_extensions = ('.jpg', '.jpeg', '.png')
+
+cache_folder: str = '.cache/pfin/'
+
+# JPEG start-of-frame markers, which hold the dimensions.
+# 0xC4 (DHT), 0xC8 (JPG) and 0xCC (DAC) are in the range, but are not frames.
+_sof_markers = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Markers without a length field.
+_standalone_markers = set(range(0xD0, 0xDA)) | {0x01}
+# EXIF orientations for which the image is rotated by 90 degrees.
+_transposed_orientations = {5, 6, 7, 8}
+
+
+def _read_exif_orientation(data: bytes) -> int:
+    """
+    Reads the orientation from the content of an APP1 EXIF segment.
+    Returns 1 (the default orientation) if it is absent.
+    """
+    if not data.startswith(b'Exif\x00\x00'):
+        return 1
+    tiff = data[6:]
+    if tiff[:2] == b'II':
+        endian = '<'
+    elif tiff[:2] == b'MM':
+        endian = '>'
+    else:
+        return 1
+    try:
+        (ifd_offset,) = struct.unpack(f'{endian}I', tiff[4:8])
+        (entries,) = struct.unpack(f'{endian}H', tiff[ifd_offset:ifd_offset + 2])
+        for i in range(entries):
+            entry = ifd_offset + 2 + i * 12
+            tag, = struct.unpack(f'{endian}H', tiff[entry:entry + 2])
+            if tag == 0x0112:
+                orientation, = struct.unpack(f'{endian}H', tiff[entry + 8:entry + 10])
+                return orientation
+    except struct.error:
+        pass
+    return 1
+
+
+def _read_jpeg_header(fl) -> Tuple[int, int, int]:
+    orientation = 1
+    fl.seek(2)
+    while True:
+        byte = fl.read(1)
+        if not byte:
+            break
+        if byte != b'\xff':
+            continue
+        marker = fl.read(1)
+        # Skip the fill bytes.
+        while marker == b'\xff':
+            marker = fl.read(1)
+        if not marker:
+            break
+        marker = marker[0]
+        if marker in _standalone_markers or marker == 0x00:
+            continue
+        length, = struct.unpack('>H', fl.read(2))
+        if marker in _sof_markers:
+            _, height, width = struct.unpack('>BHH', fl.read(5))
+            return width, height, orientation
+        if marker == 0xE1:
+            orientation = _read_exif_orientation(fl.read(length - 2))
+        elif marker == 0xDA:
+            # Start of scan: the frame header should have come before.
+            break
+        else:
+            fl.seek(length - 2, os.SEEK_CUR)
+    raise ValueError('No frame header found')
+
+
+def read_dimensions(path: str) -> Tuple[int, int, int]:
+    """
+    Reads the dimensions of an image from its header, without decoding it.
+    Supports JPEG and PNG, and falls back to Pillow (which also only reads the header) for other formats.
+
+    :param str path: Path of the image.
+    :return: The width, the height, and the EXIF orientation (1 if absent).
+    """
+    with open(path, 'rb') as fl:
+        signature = fl.read(24)
+        if signature.startswith(b'\x89PNG\r\n\x1a\n') and signature[12:16] == b'IHDR':
+            width, height = struct.unpack('>II', signature[16:24])
+            return width, height, 1
+        if signature.startswith(b'\xff\xd8'):
+            return _read_jpeg_header(fl)
+
+    from PIL import Image
+    with Image.open(path) as image:
+        return image.width, image.height, image.getexif().get(0x0112, 1)
+
+
+def is_vertical(width: int, height: int, orientation: int) -> bool:
+    """
+    Returns whether an image is displayed vertically, taking its orientation into account.
+    """
+    if orientation in _transposed_orientations:
+        width, height = height, width
+    return height > width
+
+
+def walk(directory: str) -> Iterator[str]:
+    """
+    Yields the paths of the images found in a directory, recursively.
+    """
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if name.lower().endswith(image_extensions):
+                yield os.path.join(root, name)
+
+
+def describe(path: str, defaults: dict, perceptual_hash: bool = False) -> dict:
+    """
+    Hashes an image and reads its header, and returns its document.
+    Runs in a worker thread: hashing and decoding release the GIL.
+
+    :param str path: Path of the image.
+    :param dict defaults: Values of the fields which can't be deduced from the file.
+    :param bool perceptual_hash: Whether to compute the perceptual hash, which decodes the whole image.
+                                 Otherwise, it is left empty, for `python -m pfin.phash backfill`.
+    """
+    width, height, orientation = read_dimensions(path)
+    extension = os.path.splitext(path)[1][1:].lower()
+    # The lists (e.g. `tags`) are copied, so that the documents don't share them.
+    document = {field: list(value) if isinstance(value, list) else value for field, value in defaults.items()}
+    document.update({
+        'id': hash_file(path),
+        'extension': 'jpg' if extension == 'jpeg' else extension,
+        'format': is_vertical(width, height, orientation),
+        'phash': phash_file(path) if perceptual_hash else '',
+    })
+    document['usable'] = is_usable(document)
+    document = validate_image(document)
+    # The default `_id` would be an empty string: let the database create it.
+    del document['_id']
+    return document
+
+
+class Checkpoint:
+
+    """
+
+    Records the files which were committed to the database,
+    along with their size and modification time, so that they are not read again.
+
+    """
+
+    def __init__(self, directory: str):
+        name = sha256(os.path.abspath(directory).encode()).hexdigest()[:16]
+        self.path = os.path.join(cache_folder, f'ingest-{name}.json')
+        try:
+            with open(self.path) as fl:
+                self._files = json.load(fl)
+        except (FileNotFoundError, json.JSONDecodeError):
+            self._files = {}
+
+    @staticmethod
+    def _signature(path: str) -> list:
+        stat = os.stat(path)
+        return [stat.st_size, stat.st_mtime_ns]
+
+    def is_done(self, path: str) -> bool:
+        return self._files.get(path) == self._signature(path)
+
+    def mark_done(self, paths: List[str]) -> None:
+        for path in paths:
+            self._files[path] = self._signature(path)
+        os.makedirs(cache_folder, exist_ok=True)
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w') as fl:
+            json.dump(self._files, fl)
+        os.replace(temporary, self.path)
+
+
+def ingest(image_db, directory: str, destination: str = None, defaults: dict = None,
+           batch_size: int = 1000, workers: int = 8, near_duplicate_radius: int = None) -> dict:
+    """
+    Ingests all the images of a directory.
+
+    :param ImageDatabase image_db: The database to write to.
+    :param str directory: The directory to ingest.
+    :param str destination: If passed, the images are copied there, named after their `id`,
+                            as expected by `Image.get_url`.
+    :param dict defaults: Values of the fields which can't be deduced from the files (e.g. `credits`).
+    :param int batch_size: Number of documents written per request.
+    :param int workers: Number of threads hashing the files.
+    :param int near_duplicate_radius: If passed, images whose perceptual hash is within this
+                                      Hamming distance of an existing one are not inserted.
+    :return dict: Statistics of the run.
+    """
+    defaults = defaults or {}
+    checkpoint = Checkpoint(directory)
+    stats = {'found': 0, 'skipped': 0, 'inserted': 0, 'failed': 0, 'near_duplicates': 0}
+    if near_duplicate_radius is not None and image_db.phash_index is None:
+        image_db.load_phash_index()
+    # Images of the current batch, which are not in the database's index yet.
+    pending = PerceptualIndex()
+
+    paths = []
+    for path in walk(directory):
+        stats['found'] += 1
+        if checkpoint.is_done(path):
+            stats['skipped'] += 1
+        else:
+            paths.append(path)
+
+    def safe_describe(path: str) -> dict or None:
+        try:
+            return describe(path, defaults, perceptual_hash=near_duplicate_radius is not None)
+        except (OSError, ValueError, struct.error) as e:
+            logging.error(f'Could not read {path!r}: {e}')
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(paths), batch_size):
+            batch = paths[start:start + batch_size]
+            documents = []
+            done = []
+            for path, document in zip(batch, executor.map(safe_describe, batch)):
+                if document is None:
+                    stats['failed'] += 1
+                    continue
+                if near_duplicate_radius is not None:
+                    value = from_hex(document['phash'])
+                    matches = (image_db.phash_index.query(value, near_duplicate_radius)
+                               or pending.query(value, near_duplicate_radius))
+                    if matches:
+                        logging.info(f'Skipping {path!r}, near duplicate of {matches[0][0]!r}')
+                        stats['near_duplicates'] += 1
+                        done.append(path)
+                        continue
+                    pending.add(document['id'], value)
+                if destination is not None:
+                    target = os.path.join(destination, f"{document['id']}.{document['extension']}")
+                    if not os.path.exists(target):
+                        os.makedirs(destination, exist_ok=True)
+                        shutil.copyfile(path, target)
+                documents.append(document)
+                done.append(path)
+            stats['inserted'] += image_db.upsert_images(documents)
+            # They are now in the database's index.
+            pending = PerceptualIndex()
+            # Only once the batch is committed: an interrupted run resumes from there.
+            checkpoint.mark_done(done)
+            logging.info(f'Ingested {start + len(batch)}/{len(paths)} files')
+
+    return stats
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', help='Directory holding the images to ingest.')
+    parser.add_argument('--destination', default='static/images/fulls',
+                        help='Directory in which the images are copied. Empty to not copy them.')
+    parser.add_argument('--batch-size', type=int, default=1000, help='Number of documents written per request.')
+    parser.add_argument('--workers', type=int, default=8, help='Number of threads hashing the files.')
+    parser.add_argument('--type', dest='image_type', default=None, help="Type of the images, e.g. 'PassionFroid'.")
+    parser.add_argument('--credits', default=None, help='Name of the author of the images.')
+    parser.add_argument('--tags', default=None, help='Tags of the images, separated by semicolons.')
+    parser.add_argument('--skip-near-duplicates', type=int, default=None, metavar='RADIUS',
+                        help='Do not insert images within this Hamming distance of an existing one, e.g. 8.')
+    args = parser.parse_args()
+    configure_logging()
+
+    from .database import ImageDatabase
+
+    defaults = {}
+    if args.image_type is not None:
+        defaults['type'] = args.image_type
+    if args.credits is not None:
+        defaults['credits'] = args.credits
+    if args.tags is not None:
+        defaults['tags'] = args.tags.split(';')
+
+    image_db = ImageDatabase('PFIN', 'images')
+    stats = ingest(image_db, args.directory, destination=args.destination or None, defaults=defaults,
+                   batch_size=args.batch_size, workers=args.workers,
+                   near_duplicate_radius=args.skip_near_duplicates)
+    print(f"{stats['found']} found, {stats['skipped']} already ingested, "
+          f"{stats['inserted']} inserted, {stats['near_duplicates']} near duplicates, {stats['failed']} failed")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,232 @@
+"""
+
+Instrumentation of the database commands and of the HTTP requests,
+exposed in the Prometheus text format.
+
+- `CommandMetrics` is a pymongo command listener, recording the latency of each command,
+  and logging the commands slower than a threshold, along with their query plan ;
+- `instrument_app` times the requests of a Flask app, and adds the `/metrics` endpoint.
+
+Nothing is recorded until `enable_command_metrics` or `instrument_app` are called,
+so that disabled metrics cost nothing.
+
+"""
+
+import time
+import logging
+import threading
+
+from bisect import bisect_left
+from typing import Dict, Tuple, Callable
+from concurrent.futures import ThreadPoolExecutor
+
+from pymongo import monitoring
+
+
+# Upper bounds of the buckets of the histograms, in seconds.
+default_buckets: Tuple[float, ...] = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                                      0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Commands whose plan is logged when they are slow.
+explainable_commands = frozenset({'find', 'aggregate', 'count', 'distinct', 'update', 'delete', 'findAndModify'})
+
+# Fields added by the driver to the commands, which `explain` refuses.
+_driver_fields = frozenset({'lsid', '$clusterTime', '$db', '$readPreference', 'txnNumber',
+                            'autocommit', 'startTransaction', 'readConcern', 'writeConcern'})
+
+
+class Histogram:
+
+    """
+    Distribution of observed values, counted in fixed buckets.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = default_buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # The last one is +Inf.
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+
+class Registry:
+
+    """
+    Set of metrics, identified by their name and labels.
+    """
+
+    def __init__(self):
+        self._histograms: Dict[Tuple[str, tuple], Histogram] = {}
+        self._counters: Dict[Tuple[str, tuple], float] = {}
+        self._help: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, description: str) -> None:
+        self._help[name] = description
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram())
+        return histogram
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @staticmethod
+    def _labels(labels: tuple, extra: tuple = ()) -> str:
+        pairs = labels + extra
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n') for _, value in pairs)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self) -> str:
+        """
+        Returns the metrics in the Prometheus text format.
+        """
+        lines = []
+        described = set()
+
+        def header(name: str, kind: str) -> None:
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append(f'# HELP {name} {self._help[name]}')
+                lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in sorted(self._counters.items()):
+            header(name, 'counter')
+            lines.append(f'{name}{self._labels(labels)} {value}')
+
+        for (name, labels), histogram in sorted(self._histograms.items(), key=lambda item: item[0]):
+            header(name, 'histogram')
+            with histogram._lock:
+                counts, total, count = list(histogram.counts), histogram.sum, histogram.count
+            cumulative = 0
+            for bound, bucket_count in zip(histogram.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append(f'{name}_bucket{self._labels(labels, (("le", le),))} {cumulative}')
+            lines.append(f'{name}_sum{self._labels(labels)} {total}')
+            lines.append(f'{name}_count{self._labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+registry.describe('pfin_mongodb_command_duration_seconds', 'Duration of the MongoDB commands.')
+registry.describe('pfin_mongodb_command_failures_total', 'Number of failed MongoDB commands.')
+registry.describe('pfin_mongodb_slow_commands_total', 'Number of MongoDB commands slower than the threshold.')
+registry.describe('pfin_http_request_duration_seconds', 'Duration of the HTTP requests.')
+
+
+class CommandMetrics(monitoring.CommandListener):
+
+    """
+
+    Records the duration of the MongoDB commands in a registry.
+
+    Commands slower than `slow_threshold` seconds are logged, with their query plan:
+    it is obtained with `explain`, in a background thread, not to block the driver.
+
+    """
+
+    def __init__(self, metrics: Registry = registry, slow_threshold: float or None = 0.1,
+                 explain: Callable[[str, dict], dict] = None):
+        """
+        :param Registry metrics: The registry in which to record the durations.
+        :param float slow_threshold: The duration, in seconds, above which a command is logged.
+                                     None to not log the slow commands.
+        :param explain: Function taking a database name and a command, and returning its plan,
+                        e.g. `lambda db, command: client[db].command('explain', command)`.
+                        None to log the slow commands without their plan.
+        """
+        self.metrics = metrics
+        self.slow_threshold = slow_threshold
+        self.explain = explain
+        # Request id -> (database name, command), for the commands which may be explained.
+        self._pending: Dict[int, Tuple[str, dict]] = {}
+        self._explainer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pfin-explain')
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        if self.slow_threshold is not None and event.command_name in explainable_commands:
+            self._pending[event.request_id] = (event.database_name, event.command)
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._record(event)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self.metrics.increment('pfin_mongodb_command_failures_total', command=event.command_name)
+        self._record(event)
+
+    def _record(self, event) -> None:
+        duration = event.duration_micros / 1e6
+        started = self._pending.pop(event.request_id, None)
+        self.metrics.histogram('pfin_mongodb_command_duration_seconds', command=event.command_name).observe(duration)
+        if self.slow_threshold is None or duration < self.slow_threshold or started is None:
+            return
+        self.metrics.increment('pfin_mongodb_slow_commands_total', command=event.command_name)
+        database_name, command = started
+        self._explainer.submit(self._log_slow_command, database_name, command, duration)
+
+    def _log_slow_command(self, database_name: str, command: dict, duration: float) -> None:
+        command = {key: value for key, value in command.items() if key not in _driver_fields}
+        plan = None
+        if self.explain is not None:
+            try:
+                plan = self.explain(database_name, command).get('queryPlanner', {}).get('winningPlan')
+            except Exception as e:
+                plan = f'could not explain: {e}'
+        logging.warning(f'Slow command ({duration * 1e3:.1f} ms) on {database_name!r}: {command} ; plan: {plan}')
+
+
+_command_metrics: CommandMetrics or None = None
+
+
+def enable_command_metrics(slow_threshold: float or None = 0.1) -> CommandMetrics:
+    """
+    Registers the listener of the database commands, once per process,
+    and returns it. Only the clients created afterwards are instrumented.
+    """
+    global _command_metrics
+    if _command_metrics is None:
+        _command_metrics = CommandMetrics(slow_threshold=slow_threshold)
+        monitoring.register(_command_metrics)
+    _command_metrics.slow_threshold = slow_threshold
+    return _command_metrics
+
+
+def instrument_app(app, metrics: Registry = registry) -> None:
+    """
+    Times the requests of a Flask app, by endpoint, and adds the `/metrics` endpoint.
+    """
+    from flask import g, request, Response
+
+    @app.before_request
+    def start_timer():
+        g.pfin_request_start = time.perf_counter()
+
+    @app.after_request
+    def stop_timer(response):
+        start = g.pop('pfin_request_start', None)
+        if start is not None:
+            metrics.histogram('pfin_http_request_duration_seconds', method=request.method,
+                              endpoint=request.endpoint or 'unknown',
+                              status=response.status_code).observe(time.perf_counter() - start)
+        return response
+
+    def render_metrics():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    app.add_url_rule('/metrics', 'metrics', render_metrics)
@@ -0,0 +1,251 @@
+"""
+
+Perceptual hashes of the images, used to find near duplicates
+(re-exports, resizes, recompressions of the same picture),
+which have different contents, and therefore different `id`s.
+
+Hashes are 64-bit integers, stored in the documents as 16 hexadecimal characters.
+Two images are near duplicates if the Hamming distance between their hashes is small.
+
+Usage: python -m pfin.phash backfill [--images DIR]
+    Computes the hash of the images of the catalog which don't have one yet.
+
+"""
+
+import logging
+import argparse
+import numpy as np
+
+from itertools import combinations
+from typing import List, Tuple, Iterable
+
+from . import configure_logging
+
+
+hash_bits = 64
+
+# Size of the image the DCT is computed on.
+_dct_size = 32
+# Size of the low-frequencies block kept from the DCT.
+_low_size = 8
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    """
+    Returns the orthonormal DCT-II matrix of size n.
+    """
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+_dct = _dct_matrix(_dct_size)
+
+
+def _to_int(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.astype(np.uint8)).tobytes(), 'big')
+
+
+def _grayscale(image, size: Tuple[int, int]) -> np.ndarray:
+    from PIL import Image
+
+    if image.format == 'JPEG':
+        # Decode at a reduced scale, we only need a few pixels.
+        image.draft('L', (size[0] * 4, size[1] * 4))
+    return np.asarray(image.convert('L').resize(size, Image.BILINEAR), dtype=np.float32)
+
+
+def phash(image) -> int:
+    """
+    Computes the DCT-based perceptual hash of a Pillow image.
+    The bits tell whether each of the 64 lowest frequencies is above their median.
+    """
+    pixels = _grayscale(image, (_dct_size, _dct_size))
+    low = (_dct @ pixels @ _dct.T)[:_low_size, :_low_size]
+    # The DC coefficient is left out of the median, it is much larger than the others.
+    median = np.median(low.ravel()[1:])
+    return _to_int(low.ravel() > median)
+
+
+def dhash(image) -> int:
+    """
+    Computes the difference hash of a Pillow image.
+    The bits tell whether each pixel is brighter than its right neighbour, on a 9x8 thumbnail.
+    """
+    pixels = _grayscale(image, (9, 8))
+    return _to_int((pixels[:, :-1] > pixels[:, 1:]).ravel())
+
+
+def phash_file(path: str) -> str:
+    """
+    Returns the perceptual hash of an image file, as stored in the documents.
+    """
+    from PIL import Image
+
+    with Image.open(path) as image:
+        return to_hex(phash(image))
+
+
+def to_hex(value: int) -> str:
+    return f'{value:016x}'
+
+
+def from_hex(value: str) -> int:
+    return int(value, 16)
+
+
+def _popcount(values: np.ndarray) -> np.ndarray:
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(values)
+    return np.unpackbits(values.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class PerceptualIndex:
+
+    """
+
+    Multi-index hash table over 64-bit perceptual hashes,
+    answering Hamming-radius queries.
+
+    The hashes are split in `chunks` chunks, each one indexed in its own table.
+    If two hashes are within a distance `r`, at least one of their chunks
+    is within a distance `r // chunks` (pigeonhole principle):
+    we only look up the chunk values close to the query's,
+    and compute the exact distance of these candidates only, in a vectorized way.
+
+    """
+
+    def __init__(self, chunks: int = 4):
+        self.chunks = chunks
+        self._chunk_bits = hash_bits // chunks
+        self._keys = []  # Position -> key (the MongoDB `_id`).
+        self._hashes = []  # Position -> hash.
+        self._positions = {}  # Key -> position.
+        self._tables = [{} for _ in range(chunks)]  # Chunk value -> set of positions.
+        self._array = None  # `_hashes` as an array, built on demand.
+        self._alive = None  # Mask of the positions which were not removed, built along.
+
+    @classmethod
+    def from_collection(cls, collection) -> 'PerceptualIndex':
+        """
+        Builds the index from the documents of a collection having a hash.
+        Only the hashes are fetched.
+        """
+        index = cls()
+        for document in collection.find({'phash': {'$nin': [None, '']}}, {'phash': 1}):
+            index.add(document['_id'], from_hex(document['phash']))
+        logging.info(f'Indexed the perceptual hashes of {len(index)} documents')
+        return index
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def _split(self, value: int) -> List[int]:
+        mask = (1 << self._chunk_bits) - 1
+        return [(value >> (i * self._chunk_bits)) & mask for i in range(self.chunks)]
+
+    def add(self, key, value: int) -> None:
+        """
+        Indexes the hash of a document, replacing its previous one.
+        """
+        self.remove(key)
+        position = len(self._hashes)
+        self._keys.append(key)
+        self._hashes.append(value)
+        self._positions[key] = position
+        for table, chunk in zip(self._tables, self._split(value)):
+            table.setdefault(chunk, set()).add(position)
+        self._array = None
+
+    def remove(self, key) -> None:
+        position = self._positions.pop(key, None)
+        if position is None:
+            return
+        for table, chunk in zip(self._tables, self._split(self._hashes[position])):
+            table[chunk].discard(position)
+        self._array = None
+
+    def _variants(self, chunk: int, radius: int) -> Iterable[int]:
+        """
+        Yields the chunk values within `radius` bits of `chunk`.
+        """
+        for distance in range(radius + 1):
+            for bits in combinations(range(self._chunk_bits), distance):
+                variant = chunk
+                for bit in bits:
+                    variant ^= 1 << bit
+                yield variant
+
+    def query(self, value: int, radius: int) -> List[Tuple[object, int]]:
+        """
+        Returns the documents whose hash is within a Hamming distance of the given one.
+
+        :param int value: The hash to look for.
+        :param int radius: The maximum distance, in bits.
+        :return list: Tuples `(key, distance)`, closest first.
+        """
+        if self._array is None:
+            self._array = np.array(self._hashes, dtype=np.uint64)
+            self._alive = np.zeros(len(self._hashes), dtype=bool)
+            self._alive[list(self._positions.values())] = True
+
+        chunk_radius = radius // self.chunks
+        if chunk_radius > 1:
+            # Enumerating the variants would cost more than a vectorized scan of everything.
+            distances = _popcount(self._array ^ np.uint64(value))
+            candidates = np.flatnonzero((distances <= radius) & self._alive)
+            distances = distances[candidates]
+        else:
+            positions = set()
+            for table, chunk in zip(self._tables, self._split(value)):
+                for variant in self._variants(chunk, chunk_radius):
+                    positions.update(table.get(variant, ()))
+            candidates = np.fromiter(positions, dtype=np.int64, count=len(positions))
+            distances = _popcount(self._array[candidates] ^ np.uint64(value))
+            close = distances <= radius
+            candidates, distances = candidates[close], distances[close]
+
+        matches = sorted(zip(distances.tolist(), candidates.tolist()))
+        return [(self._keys[position], distance) for distance, position in matches]
+
+
+def backfill(image_db, images_dir: str, batch_size: int = 1000) -> int:
+    """
+    Computes the hash of the images which don't have one, from their file in `images_dir`.
+    They are written through `ImageDatabase.set_image_fields`, so that the loaded structures
+    and the version of the database are updated.
+
+    :return int: The number of images updated.
+    """
+    import os
+
+    values = {}
+    for document in image_db._collection.find({'phash': {'$in': [None, '']}}, {'id': 1, 'extension': 1}):
+        path = os.path.join(images_dir, f"{document['id']}.{document['extension']}")
+        try:
+            values[document['_id']] = {'phash': phash_file(path)}
+        except OSError as e:
+            logging.warning(f'Could not hash {path!r}: {e}')
+    ids = list(values)
+    for start in range(0, len(ids), batch_size):
+        image_db.set_image_fields({_id: values[_id] for _id in ids[start:start + batch_size]})
+    return len(values)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['backfill'])
+    parser.add_argument('--images', default='static/images/fulls', help='Directory of the full-size images.')
+    args = parser.parse_args()
+    configure_logging()
+
+    from .database import ImageDatabase
+
+    image_db = ImageDatabase('PFIN', 'images')
+    print(f'{backfill(image_db, args.images)} images hashed')
+
+
+if __name__ == '__main__':
+    main()
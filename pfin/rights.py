@@ -0,0 +1,234 @@
+"""
+
+Expiration of the usage rights of the images.
+
+The images with a limited usage have an end date, `usage_end`.
+Rather than comparing the dates of all the images on each search,
+each one stores whether it can currently be used, in the `usable` flag,
+and the searches exclude the images which can't (see `Filter`).
+
+`ExpiryIndex` keeps the upcoming end dates in a min-heap, so that finding the rights
+which ended is a look at its top: `ImageDatabase.expire_rights` then flips their flags in bulk.
+
+Usage: python -m pfin.rights sync
+           Sets the `usable` flag of all the images, e.g. after importing them.
+       python -m pfin.rights report [--days N]
+           Lists the images whose rights end in the next N days (30 by default).
+
+"""
+
+import heapq
+import logging
+import argparse
+import datetime
+
+from typing import Dict, List, Tuple
+
+from . import configure_logging
+
+
+# Formats of `usage_end`, tried in order.
+date_formats = ('%Y-%m-%d', '%d/%m/%Y')
+
+
+def parse_usage_end(value) -> datetime.date or None:
+    """
+    Returns the end date of the rights of an image, or None if there is none or it is invalid.
+    """
+    if isinstance(value, datetime.datetime):
+        return value.date()
+    if isinstance(value, datetime.date):
+        return value
+    if not isinstance(value, str) or not value.strip():
+        return None
+    for date_format in date_formats:
+        try:
+            return datetime.datetime.strptime(value.strip(), date_format).date()
+        except ValueError:
+            pass
+    logging.warning(f'Invalid end of usage {value!r}, ignored')
+    return None
+
+
+def _as_flag(value) -> bool:
+    return value is True or value == 'true'
+
+
+def usage_end_of(document: dict) -> datetime.date or None:
+    """
+    Returns the date after which an image can't be used, or None if its usage isn't limited in time.
+    """
+    if not _as_flag(document.get('limited_usage')):
+        return None
+    return parse_usage_end(document.get('usage_end'))
+
+
+def is_usable(document: dict, today: datetime.date = None) -> bool:
+    """
+    Returns whether an image can be used today. Its rights last until the end of its `usage_end` day.
+    """
+    end = usage_end_of(document)
+    return end is None or (today or datetime.date.today()) <= end
+
+
+class ExpiryIndex:
+
+    """
+
+    Min-heap of the end dates of the rights of the images.
+
+    Updated entries aren't removed from the heap: the current end date of each image is kept aside,
+    and the outdated entries are skipped when they reach the top.
+
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[datetime.date, int, object]] = []  # (end, insertion number, key)
+        self._ends: Dict[object, datetime.date] = {}  # Key -> current end date.
+        self._counter = 0
+
+    @classmethod
+    def from_collection(cls, collection, today: datetime.date = None) -> 'ExpiryIndex':
+        """
+        Builds the index from the images of a collection, see `add_document`.
+        """
+        index = cls()
+        fields = {'limited_usage': 1, 'usage_end': 1, 'usable': 1}
+        for document in collection.find({'limited_usage': {'$in': [True, 'true']}}, fields):
+            index.add_document(document['_id'], document, today)
+        logging.info(f'Indexed the end of the rights of {len(index)} images')
+        return index
+
+    def __len__(self) -> int:
+        return len(self._ends)
+
+    def add(self, key, end: datetime.date or None) -> None:
+        """
+        Sets the end date of the rights of an image. None removes it.
+        """
+        if end is None:
+            self._ends.pop(key, None)
+            return
+        if self._ends.get(key) == end:
+            return
+        self._ends[key] = end
+        # The counter breaks the ties, so that the keys are never compared.
+        heapq.heappush(self._heap, (end, self._counter, key))
+        self._counter += 1
+
+    def add_document(self, key, document: dict, today: datetime.date = None) -> None:
+        """
+        Adds an image whose rights will end, or ended but which isn't flagged as unusable yet.
+        Other images are removed from the index.
+        """
+        end = usage_end_of(document)
+        flagged = document.get('usable') in (False, 'false')
+        if end is not None and end < (today or datetime.date.today()) and flagged:
+            end = None
+        self.add(key, end)
+
+    def remove(self, key) -> None:
+        self._ends.pop(key, None)
+
+    def _discard_outdated(self) -> None:
+        while self._heap and self._ends.get(self._heap[0][2]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def next_end(self) -> datetime.date or None:
+        """
+        Returns the nearest end date, or None if there is none.
+        """
+        self._discard_outdated()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_expired(self, today: datetime.date = None) -> list:
+        """
+        Removes the images whose rights ended before today, and returns their keys.
+        """
+        today = today or datetime.date.today()
+        expired = []
+        while True:
+            self._discard_outdated()
+            if not self._heap or self._heap[0][0] >= today:
+                return expired
+            _, _, key = heapq.heappop(self._heap)
+            del self._ends[key]
+            expired.append(key)
+
+    def expiring(self, days: int, today: datetime.date = None) -> List[Tuple[object, datetime.date]]:
+        """
+        Returns the images whose rights end in the next days, by end date.
+
+        :param int days: The number of days, 0 for the ones ending today.
+        :return list: The keys of the images, with the last day of their rights.
+        """
+        today = today or datetime.date.today()
+        limit = today + datetime.timedelta(days=days)
+        return sorted(((key, end) for key, end in self._ends.items() if end <= limit),
+                      key=lambda item: item[1])
+
+
+def normalized_usage_end(value) -> str or None:
+    """
+    Returns the ISO form ("YYYY-MM-DD") of a stored end date, if it isn't already in this form,
+    so that the searches can compare the dates as strings (see `Filter.usage_end`). None otherwise.
+    """
+    end = parse_usage_end(value)
+    if end is None or value == end.isoformat():
+        return None
+    return end.isoformat()
+
+
+def sync(collection, today: datetime.date = None, batch_size: int = 1000) -> Tuple[int, int]:
+    """
+    Sets the `usable` flag of all the images of a collection, from their rights.
+    The end dates which aren't ISO dates are rewritten as such.
+
+    :return: The number of images flagged as usable, and as unusable.
+    """
+    # Not imported with the module, which `Filter` uses.
+    from pymongo import UpdateOne
+
+    usable, unusable = [], []
+    dates = []
+    fields = {'limited_usage': 1, 'usage_end': 1, 'usable': 1}
+    for document in collection.find({}, fields):
+        flag = is_usable(document, today)
+        if document.get('usable') is not flag:
+            (usable if flag else unusable).append(document['_id'])
+        end = normalized_usage_end(document.get('usage_end'))
+        if end is not None:
+            dates.append(UpdateOne({'_id': document['_id']}, {'$set': {'usage_end': end}}))
+    for ids, flag in ((usable, True), (unusable, False)):
+        for start in range(0, len(ids), batch_size):
+            collection.update_many({'_id': {'$in': ids[start:start + batch_size]}}, {'$set': {'usable': flag}})
+    for start in range(0, len(dates), batch_size):
+        collection.bulk_write(dates[start:start + batch_size], ordered=False)
+    logging.info(f'Flagged {len(usable)} images as usable, and {len(unusable)} as unusable ; '
+                 f'rewrote {len(dates)} end dates')
+    return len(usable), len(unusable)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('action', choices=['sync', 'report'])
+    parser.add_argument('--days', type=int, default=30, help='Number of days of the report.')
+    parser.add_argument('--database', default='PFIN')
+    args = parser.parse_args()
+    configure_logging()
+
+    from .database import ImageDatabase
+
+    image_db = ImageDatabase(args.database, 'images')
+    if args.action == 'sync':
+        usable, unusable = sync(image_db._collection)
+        # Seen by the processes following the images, see `ImageDatabase.watch_changes`.
+        image_db.mark_modified()
+        print(f'{usable} images flagged as usable, {unusable} as unusable')
+    else:
+        for image, end in image_db.expiring_images(args.days):
+            print(f'{end.isoformat()}  {image.id}.{image.extension}  {image.credits}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import random
+import logging
+import numpy as np
+
+from typing import List
+from pymongo.errors import OperationFailure
+
+from .catalog import ColumnarCatalog
+
+
+def sample_catalog(catalog: ColumnarCatalog, query: dict, size: int,
+                   rng: np.random.Generator = None) -> List[dict]:
+    """
+    Draws documents uniformly at random, without replacement, among the ones matching a query.
+    The query is evaluated in memory, and only the drawn documents are read.
+
+    :param ColumnarCatalog catalog: The catalog to sample from.
+    :param dict query: The query the documents must match.
+    :param int size: The number of documents to draw.
+    :param rng: The random generator to use.
+    :raises UnsupportedQuery: If the query can't be evaluated by the catalog.
+    """
+    if rng is None:
+        rng = np.random.default_rng()
+    candidates = np.flatnonzero(catalog.evaluate(query))
+    size = min(size, len(candidates))
+    drawn = rng.choice(candidates, size=size, replace=False, shuffle=True)
+    return catalog.get(drawn)
+
+
+def sample_collection(collection, query: dict, size: int, rng: random.Random = None) -> List[dict]:
+    """
+    Draws documents uniformly at random, without replacement, among the ones matching a query.
+
+    The sampling is done by the server, with a `$sample` stage, so only the drawn documents are transferred.
+    If the server refuses it, we fall back to drawing locally among the ids of the matching documents,
+    and only the drawn documents are then fetched.
+
+    :param collection: The collection to sample from.
+    :param dict query: The query the documents must match.
+    :param int size: The number of documents to draw.
+    :param random.Random rng: The random generator used by the local fallback.
+    """
+    if size <= 0:
+        return []
+    pipeline = [{'$sample': {'size': size}}]
+    if query:
+        pipeline.insert(0, {'$match': query})
+    try:
+        return list(collection.aggregate(pipeline))
+    except OperationFailure as e:
+        logging.warning(f'Server-side sampling failed, sampling locally: {e}')
+
+    return sample_ids(collection, matching_ids(collection, query), size, rng)
+
+
+def matching_ids(collection, query: dict) -> list:
+    """
+    Returns the `_id`s of the documents matching a query.
+    """
+    return [document['_id'] for document in collection.find(query, {'_id': 1})]
+
+
+def sample_ids(collection, ids: list, size: int, rng: random.Random = None) -> List[dict]:
+    """
+    Draws `_id`s uniformly at random, without replacement, and fetches the corresponding documents.
+    Only the drawn documents are transferred.
+
+    :param collection: The collection holding the documents.
+    :param list ids: The `_id`s to draw from.
+    :param int size: The number of documents to draw.
+    :param random.Random rng: The random generator to use.
+    """
+    if rng is None:
+        rng = random.Random()
+    drawn = rng.sample(ids, min(size, len(ids)))
+    documents = {document['_id']: document for document in collection.find({'_id': {'$in': drawn}})}
+    # Keep the drawing order.
+    return [documents[i] for i in drawn if i in documents]
@@ -0,0 +1,202 @@
+"""
+
+Serving of the image files by the app, when it hosts them itself
+(set `IMAGE_HOST_URL` to `/images/`).
+
+The images are named after the hash of their content (see `ingest`),
+and their derivatives after the hash of their source (see `derivatives`),
+so such a URL always designates the same bytes: the responses are cached by the clients
+for a year, without revalidation, and carry a strong ETag for the others.
+Files with other names (e.g. `01.jpg`) may change: they are revalidated on each use,
+with an ETag derived from their modification time and size.
+Range requests are supported, for the large originals.
+
+The files are memory-mapped, and the maps are kept in a bounded LRU cache,
+so that the most requested thumbnails are served from the page cache
+without opening them again.
+
+"""
+
+import os
+import re
+import mmap
+import mimetypes
+import threading
+
+from collections import OrderedDict
+from typing import Iterator, Tuple
+
+from werkzeug.http import parse_range_header, is_resource_modified
+from werkzeug.security import safe_join
+from werkzeug.wrappers import Request, Response
+
+
+# Size of the chunks of the response bodies, in bytes.
+chunk_size: int = 256 * 1024
+
+# Clients may keep the images named after a hash as long as they want: their URLs change with their content.
+cache_control: str = 'public, max-age=31536000, immutable'
+
+# The other files are revalidated on each use.
+mutable_cache_control: str = 'public, no-cache'
+
+# Stem of the names of the files named after a SHA-256, see `is_content_hash`.
+_hash_pattern = re.compile(r'[0-9a-f]{64}')
+
+
+class MappedFiles:
+
+    """
+    Bounded LRU cache of memory-mapped, read-only files.
+    The maps are shared between threads: they are only sliced, never read with a position.
+    """
+
+    def __init__(self, max_files: int = 256):
+        """
+        :param int max_files: The maximum number of files kept mapped.
+        """
+        self.max_files = max_files
+        self._maps = OrderedDict()  # Path -> (map, or empty bytes for empty files ; (mtime, size)).
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._maps)
+
+    def get(self, path: str, check: bool = False) -> Tuple[mmap.mmap or bytes, Tuple[int, int]]:
+        """
+        Returns the map of a file, mapping it if needed.
+
+        :param bool check: Whether to map the file again if it changed since it was mapped.
+                           Not needed for the files named after their content.
+        :return: The map, and the modification time (in ns) and size of the file when it was mapped.
+        :raises OSError: If the file can't be opened.
+        """
+        with self._lock:
+            entry = self._maps.get(path)
+        if entry is not None and check:
+            stat = os.stat(path)
+            if entry[1] != (stat.st_mtime_ns, stat.st_size):
+                entry = None
+        if entry is not None:
+            with self._lock:
+                if path in self._maps:
+                    self._maps.move_to_end(path)
+            return entry
+
+        with open(path, 'rb') as fl:
+            stat = os.fstat(fl.fileno())
+            # Empty files can't be mapped. The map stays valid once the file is closed.
+            data = mmap.mmap(fl.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b''
+        entry = (data, (stat.st_mtime_ns, stat.st_size))
+
+        with self._lock:
+            current = self._maps.get(path)
+            if current is not None and current[1] == entry[1]:
+                # Mapped by another thread meanwhile.
+                entry = current
+            else:
+                self._maps[path] = entry
+                self._maps.move_to_end(path)
+                while len(self._maps) > self.max_files:
+                    # Evicted maps are closed when the last response using them is done.
+                    self._maps.popitem(last=False)
+        return entry
+
+    def clear(self) -> None:
+        with self._lock:
+            self._maps.clear()
+
+
+def is_content_hash(file_name: str) -> bool:
+    """
+    Returns whether a file is named after a hash, e.g. `<sha256>.jpg`, rather than e.g. `01.jpg`.
+    """
+    return _hash_pattern.fullmatch(os.path.splitext(file_name)[0]) is not None
+
+
+def _iter_slices(data, start: int, stop: int) -> Iterator[bytes]:
+    # WSGI servers only accept bytes: each chunk is copied out of the map.
+    view = memoryview(data)
+    for offset in range(start, stop, chunk_size):
+        yield bytes(view[offset:min(offset + chunk_size, stop)])
+
+
+def _byte_range(request: Request, etag: str, length: int) -> Tuple[int, int] or None:
+    """
+    Returns the range of bytes requested, as `(start, stop)`,
+    or None if the whole file must be sent.
+
+    :raises ValueError: If the range can't be satisfied.
+    """
+    if 'Range' not in request.headers:
+        return None
+    # With If-Range, the range is only sent if the client has the current version.
+    if_range = request.if_range
+    if if_range.etag is not None and if_range.etag != etag:
+        return None
+    if if_range.date is not None:
+        return None
+    byte_range = parse_range_header(request.headers['Range'])
+    if byte_range is None:
+        # Invalid header, ignored.
+        return None
+    if len(byte_range.ranges) != 1:
+        # Multipart responses are not supported: the whole file is sent.
+        return None
+    bounds = byte_range.range_for_length(length)
+    if bounds is None:
+        raise ValueError(f'Cannot satisfy the range {request.headers["Range"]!r} of {length} bytes')
+    return bounds
+
+
+def image_response(request: Request, files: MappedFiles, images_dir: str,
+                   size: str, file_name: str) -> Response or None:
+    """
+    Returns the response to a request for an image file.
+
+    :param Request request: The request.
+    :param MappedFiles files: The cache of the mapped files.
+    :param str images_dir: The directory holding a directory of images per size (`fulls`, `thumbs`...).
+    :param str size: The size of the image, i.e. the name of its directory.
+    :param str file_name: The name of the file.
+    :return: The response, or None if there is no such file.
+    """
+    path = safe_join(images_dir, size, file_name)
+    if path is None:
+        return None
+    immutable = is_content_hash(file_name)
+    try:
+        data, (mtime, length) = files.get(path, check=not immutable)
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
+        return None
+
+    if immutable:
+        # The name of the file is the hash of its content, or of the content of its source.
+        etag = f'{size}-{file_name}'
+    else:
+        etag = f'{size}-{file_name}-{mtime:x}-{length:x}'
+
+    headers = {
+        'Cache-Control': cache_control if immutable else mutable_cache_control,
+        'Accept-Ranges': 'bytes',
+    }
+    if not is_resource_modified(request.environ, etag=etag):
+        response = Response(status=304, headers=headers)
+        response.set_etag(etag)
+        return response
+
+    try:
+        bounds = _byte_range(request, etag, length)
+    except ValueError:
+        headers['Content-Range'] = f'bytes */{length}'
+        return Response(status=416, headers=headers)
+
+    start, stop = (0, length) if bounds is None else bounds
+    if bounds is not None:
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{length}'
+    mimetype = mimetypes.guess_type(file_name)[0] or 'application/octet-stream'
+    response = Response(_iter_slices(data, start, stop), status=200 if bounds is None else 206,
+                        headers=headers, mimetype=mimetype, direct_passthrough=True)
+    response.content_length = stop - start
+    response.set_etag(etag)
+    return response
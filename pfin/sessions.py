@@ -0,0 +1,151 @@
+import os
+import time
+import sqlite3
+import logging
+import threading
+
+from bson import json_util
+
+from .user import User, user_structure
+from .cache import LRUCache
+
+
+class SQLiteBackend:
+
+    """
+
+    Session backend stored in a local SQLite file,
+    shared by all the processes (e.g. the WSGI workers) of the machine.
+
+    Each thread gets its own connection. The database is in WAL mode,
+    so that readers don't wait for writers.
+
+    """
+
+    def __init__(self, path: str):
+        """
+        :param str path: Path of the database file. Its directory is created if needed.
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._local = threading.local()
+        self._connection().execute('CREATE TABLE IF NOT EXISTS sessions '
+                                   '(key TEXT PRIMARY KEY, expiration REAL NOT NULL, info TEXT NOT NULL)')
+        logging.info(f'Opened session store {path!r}')
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            # Autocommit: each statement is its own transaction.
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def get(self, key: str) -> dict or None:
+        """
+        Returns the information stored for a key, None if there is none or if it expired.
+        """
+        row = self._connection().execute('SELECT expiration, info FROM sessions WHERE key = ?', (key,)).fetchone()
+        if row is None or row[0] <= time.time():
+            return None
+        return json_util.loads(row[1])
+
+    def set(self, key: str, info: dict, ttl: float) -> None:
+        self._connection().execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)',
+                                   (key, time.time() + ttl, json_util.dumps(info)))
+
+    def delete(self, key: str) -> None:
+        self._connection().execute('DELETE FROM sessions WHERE key = ?', (key,))
+
+    def purge(self) -> int:
+        """
+        Removes the expired entries.
+
+        :return int: The number of entries removed.
+        """
+        return self._connection().execute('DELETE FROM sessions WHERE expiration <= ?', (time.time(),)).rowcount
+
+
+class SessionStore:
+
+    """
+
+    Store of the logged-in users, used by Flask-Login to load the user of a request.
+
+    It has two tiers:
+    - a bounded in-memory LRU cache, local to the process, with a short time-to-live ;
+    - optionally, a backend shared by all the processes, e.g. `SQLiteBackend`,
+      holding the sessions for their whole lifetime.
+
+    A user logged in by one process can then be loaded by any of them.
+    A logout in one process is seen by the others once their in-memory entry expires,
+    hence the short time-to-live of the memory tier.
+    Passwords are never stored.
+
+    """
+
+    # Number of writes between two purges of the expired entries of the backend.
+    purge_interval: int = 1000
+
+    def __init__(self, backend: SQLiteBackend = None, ttl: float = 12 * 3600,
+                 max_size: int = 10000, memory_ttl: float = 30):
+        """
+        :param backend: The shared backend. None to keep the sessions in memory only.
+        :param float ttl: The lifetime of a session, in seconds.
+        :param int max_size: The maximum number of users kept in memory.
+        :param float memory_ttl: The time-to-live of the users in memory, in seconds.
+                                 Without a backend, the lifetime of a session.
+        """
+        self.backend = backend
+        self.ttl = ttl
+        self._memory = LRUCache(max_size=max_size, ttl=ttl if backend is None else min(memory_ttl, ttl))
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str) -> User or None:
+        """
+        Returns the logged-in user with this identifier, None if there is none.
+        """
+        user = self._memory.get(user_id)
+        if user is not None or self.backend is None:
+            return user
+        info = self.backend.get(user_id)
+        if info is None:
+            return None
+        # Stored validated: skip the validation.
+        user = User.__wrapped__(info)
+        self._memory.set(user_id, user)
+        return user
+
+    def set(self, user: User) -> None:
+        """
+        Records a logged-in user.
+        """
+        user_id = user.get_id()
+        self._memory.set(user_id, user)
+        if self.backend is None:
+            return
+        info = {key: getattr(user, key) for key in user_structure}
+        info['password'] = ''
+        self.backend.set(user_id, info, self.ttl)
+        with self._lock:
+            self._writes += 1
+            purge = self._writes % self.purge_interval == 0
+        if purge:
+            removed = self.backend.purge()
+            logging.debug(f'Purged {removed} expired sessions')
+
+    def delete(self, user_id: str) -> None:
+        """
+        Forgets a user, e.g. when it logs out.
+        """
+        self._memory.invalidate(user_id)
+        if self.backend is not None:
+            self.backend.delete(user_id)
+
+    def stats(self) -> dict:
+        return self._memory.stats()
@@ -0,0 +1,328 @@
+"""
+
+Visual similarity search ("more like this") over the images in `static/images/fulls`.
+
+Each image is described by a color histogram (hue, saturation, value),
+square-rooted and normalized, so that the dot product of two vectors
+is their similarity (the Bhattacharyya coefficient of the histograms).
+The vectors are stored in a contiguous float32 matrix, saved as `.npy`
+and memory-mapped when loaded, along with the `id`s of the images.
+
+Queries are answered with batched dot products and `argpartition`.
+Optionally, a coarse quantizer (spherical k-means) splits the vectors in lists,
+and a query only scans the lists whose centroids are the closest.
+
+Usage: python -m pfin.similarity build [--images DIR] [--lists N] [--workers N]
+
+"""
+
+import os
+import json
+import logging
+import argparse
+import numpy as np
+
+from typing import List, Tuple, Dict
+from concurrent.futures import ThreadPoolExecutor
+
+from . import configure_logging
+
+
+# Bins of the histogram, per channel (hue, saturation, value).
+bins: Tuple[int, int, int] = (8, 4, 4)
+dimensions: int = bins[0] * bins[1] * bins[2]
+
+# Side of the thumbnail the histogram is computed on.
+_thumbnail_size = 64
+
+index_folder: str = '.cache/pfin/similarity/'
+source_extensions = ('.jpg', '.jpeg', '.png', '.webp')
+
+# Number of rows multiplied at once, to bound the memory used by the scores.
+block_size: int = 65536
+
+# Number of vectors per list used to train the coarse quantizer.
+training_ratio: int = 64
+
+
+def describe(image) -> np.ndarray:
+    """
+    Computes the vector of a Pillow image.
+
+    :return np.ndarray: A normalized float32 vector of `dimensions` values.
+    """
+    if image.format == 'JPEG':
+        # Decode at a reduced scale, we only need a few pixels.
+        image.draft('RGB', (_thumbnail_size * 2, _thumbnail_size * 2))
+    image = image.convert('RGB')
+    image.thumbnail((_thumbnail_size, _thumbnail_size))
+    pixels = np.asarray(image.convert('HSV'), dtype=np.uint16).reshape(-1, 3)
+    # Quantize each channel, and combine them in a single bin number.
+    h = pixels[:, 0] * bins[0] >> 8
+    s = pixels[:, 1] * bins[1] >> 8
+    v = pixels[:, 2] * bins[2] >> 8
+    histogram = np.bincount((h * bins[1] + s) * bins[2] + v, minlength=dimensions).astype(np.float32)
+    vector = np.sqrt(histogram / max(len(pixels), 1))
+    return vector / max(np.linalg.norm(vector), np.finfo(np.float32).tiny)
+
+
+def describe_file(path: str) -> np.ndarray:
+    from PIL import Image
+
+    with Image.open(path) as image:
+        return describe(image)
+
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """
+    Returns the positions of the `k` highest scores, highest first.
+    """
+    if k < len(scores):
+        positions = np.argpartition(-scores, k)[:k]
+    else:
+        positions = np.arange(len(scores))
+    return positions[np.argsort(-scores[positions], kind='stable')]
+
+
+class SimilarityIndex:
+
+    """
+
+    Index of the vectors of the images, answering top-k similarity queries.
+
+    Without a coarse quantizer, every vector is scored (exact search).
+    With one, vectors are grouped by closest centroid, in lists stored contiguously
+    (list `i` being the rows `list_offsets[i]` to `list_offsets[i + 1]`), and only the `probes` closest lists are scored.
+
+    """
+
+    # Number of lists scanned per query, when the index has a coarse quantizer.
+    probes: int = 16
+
+    def __init__(self, ids: List[str], vectors: np.ndarray,
+                 centroids: np.ndarray = None, list_offsets: np.ndarray = None):
+        """
+        :param list ids: The `id` of the image of each row.
+        :param np.ndarray vectors: The vectors, one row per image.
+        :param np.ndarray centroids: The centroids of the coarse quantizer, if any.
+        :param np.ndarray list_offsets: First row of each list, plus the end of the last one.
+        """
+        self.ids = ids
+        self.vectors = vectors
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self._rows: Dict[str, int] = {image_id: row for row, image_id in enumerate(ids)}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, images_dir: str, workers: int = 8, previous: 'SimilarityIndex' = None) -> 'SimilarityIndex':
+        """
+        Computes the vectors of the images of a directory, named after their `id`.
+
+        :param str images_dir: The directory of the full-size images.
+        :param int workers: Number of threads decoding the images.
+        :param SimilarityIndex previous: An index whose vectors are reused for the images it contains.
+        """
+        paths = {}
+        for entry in sorted(os.scandir(images_dir), key=lambda e: e.name):
+            if entry.is_file() and entry.name.lower().endswith(source_extensions):
+                paths[os.path.splitext(entry.name)[0]] = entry.path
+
+        ids = list(paths)
+        vectors = np.zeros((len(ids), dimensions), dtype=np.float32)
+        to_describe = []
+        for row, image_id in enumerate(ids):
+            if previous is not None and image_id in previous._rows:
+                vectors[row] = previous.vectors[previous._rows[image_id]]
+            else:
+                to_describe.append(row)
+
+        def safe_describe(row: int) -> np.ndarray or None:
+            try:
+                return describe_file(paths[ids[row]])
+            except (OSError, ValueError) as e:
+                logging.error(f'Could not read {paths[ids[row]]!r}: {e}')
+                return None
+
+        failed = set()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for row, vector in zip(to_describe, executor.map(safe_describe, to_describe)):
+                if vector is None:
+                    failed.add(row)
+                else:
+                    vectors[row] = vector
+        logging.info(f'Described {len(to_describe) - len(failed)} images, '
+                     f'reused {len(ids) - len(to_describe)} vectors')
+        if failed:
+            keep = [row for row in range(len(ids)) if row not in failed]
+            ids = [ids[row] for row in keep]
+            vectors = vectors[keep]
+        return cls(ids, vectors)
+
+    def train_coarse(self, lists: int = None, iterations: int = 10, seed: int = 0) -> None:
+        """
+        Trains the coarse quantizer with spherical k-means,
+        and reorders the vectors so that each list is contiguous.
+
+        :param int lists: The number of lists. Defaults to the square root of the number of vectors.
+        :param int iterations: The number of k-means iterations.
+        :param int seed: Seed of the initialization.
+        """
+        vectors = np.asarray(self.vectors)
+        if lists is None:
+            lists = max(1, int(np.sqrt(len(vectors))))
+        lists = min(lists, len(vectors))
+        rng = np.random.default_rng(seed)
+        # The centroids are trained on a sample, large enough for each list to get many vectors.
+        sample = vectors
+        if len(vectors) > lists * training_ratio:
+            sample = vectors[np.sort(rng.choice(len(vectors), size=lists * training_ratio, replace=False))]
+        centroids = sample[rng.choice(len(sample), size=lists, replace=False)].copy()
+        for _ in range(iterations):
+            assignments = self._assign(sample, centroids)
+            # Sum the vectors of each list, from the vectors sorted by list.
+            order = np.argsort(assignments, kind='stable')
+            counts = np.bincount(assignments, minlength=lists)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            sums = np.zeros_like(centroids)
+            filled = counts > 0
+            sums[filled] = np.add.reduceat(sample[order], starts[filled], axis=0)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            # Empty lists keep their centroid.
+            filled = norms[:, 0] > 0
+            centroids[filled] = sums[filled] / norms[filled]
+        assignments = self._assign(vectors, centroids)
+
+        order = np.argsort(assignments, kind='stable')
+        self.ids = [self.ids[row] for row in order]
+        self.vectors = vectors[order]
+        self._rows = {image_id: row for row, image_id in enumerate(self.ids)}
+        self.centroids = centroids
+        self.list_offsets = np.zeros(lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=lists), out=self.list_offsets[1:])
+
+    @staticmethod
+    def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        assignments = np.empty(len(vectors), dtype=np.int64)
+        for start in range(0, len(vectors), block_size):
+            block = vectors[start:start + block_size]
+            assignments[start:start + len(block)] = np.argmax(block @ centroids.T, axis=1)
+        return assignments
+
+    def _closest_lists(self, queries: np.ndarray) -> np.ndarray:
+        """
+        Returns the lists to scan for each query, in increasing order (i.e. by row).
+        """
+        probes = min(self.probes, len(self.centroids))
+        closest = np.argpartition(-(queries @ self.centroids.T), probes - 1, axis=1)[:, :probes]
+        return np.sort(closest, axis=1)
+
+    def search(self, queries: np.ndarray, k: int = 10) -> List[List[Tuple[str, float]]]:
+        """
+        Returns the most similar images to each of the query vectors.
+
+        :param np.ndarray queries: The query vectors, one per row (or a single vector).
+        :param int k: The number of images returned per query.
+        :return list: For each query, tuples `(id, similarity)`, most similar first.
+        :raises ValueError: If `k` is lower than 1.
+        """
+        if k < 1:
+            raise ValueError(f'Invalid number of images {k}, it must be at least 1')
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        results = []
+        if self.centroids is not None:
+            for query, lists in zip(queries, self._closest_lists(queries)):
+                # Each list is a contiguous slice of the matrix: no gathering, sequential reads.
+                slices = [slice(self.list_offsets[i], self.list_offsets[i + 1]) for i in lists]
+                rows = np.concatenate([np.arange(s.start, s.stop) for s in slices])
+                scores = np.concatenate([self.vectors[s] @ query for s in slices])
+                best = _top_k(scores, k)
+                results.append([(self.ids[row], float(score)) for row, score in zip(rows[best], scores[best])])
+            return results
+
+        # Exact search: score all the vectors, block by block, keeping the best k of each block.
+        best_rows = [np.empty(0, dtype=np.int64) for _ in queries]
+        best_scores = [np.empty(0, dtype=np.float32) for _ in queries]
+        for start in range(0, len(self.vectors), block_size):
+            scores = np.asarray(self.vectors[start:start + block_size]) @ queries.T
+            for i in range(len(queries)):
+                top = _top_k(scores[:, i], k)
+                rows = np.concatenate([best_rows[i], top + start])
+                merged = np.concatenate([best_scores[i], scores[top, i]])
+                keep = _top_k(merged, k)
+                best_rows[i], best_scores[i] = rows[keep], merged[keep]
+        for rows, scores in zip(best_rows, best_scores):
+            results.append([(self.ids[row], float(score)) for row, score in zip(rows, scores)])
+        return results
+
+    def similar(self, image_id: str, k: int = 10) -> List[Tuple[str, float]]:
+        """
+        Returns the images most similar to an indexed one, without itself.
+
+        :raises KeyError: If the image is not in the index.
+        :raises ValueError: If `k` is lower than 1.
+        """
+        if k < 1:
+            raise ValueError(f'Invalid number of images {k}, it must be at least 1')
+        query = self.vectors[self._rows[image_id]]
+        return [(i, score) for i, score in self.search(query, k + 1)[0] if i != image_id][:k]
+
+    def save(self, folder: str = index_folder) -> None:
+        os.makedirs(folder, exist_ok=True)
+        arrays = {'vectors': self.vectors, 'centroids': self.centroids,
+                  'list_offsets': self.list_offsets}
+        for name, array in arrays.items():
+            path = os.path.join(folder, f'{name}.npy')
+            if array is None:
+                if os.path.exists(path):
+                    os.remove(path)
+                continue
+            # `np.save` adds the extension to the temporary name.
+            np.save(f'{path}.tmp', np.asarray(array))
+            os.replace(f'{path}.tmp.npy', path)
+        with open(os.path.join(folder, 'ids.json'), 'w') as fl:
+            json.dump(self.ids, fl)
+
+    @classmethod
+    def load(cls, folder: str = index_folder) -> 'SimilarityIndex':
+        """
+        Loads a saved index. The vectors are memory-mapped, not read.
+
+        :raises FileNotFoundError: If there is no index in the folder.
+        """
+        with open(os.path.join(folder, 'ids.json')) as fl:
+            ids = json.load(fl)
+        arrays = {}
+        for name in ('centroids', 'list_offsets'):
+            path = os.path.join(folder, f'{name}.npy')
+            arrays[name] = np.load(path) if os.path.exists(path) else None
+        vectors = np.load(os.path.join(folder, 'vectors.npy'), mmap_mode='r')
+        return cls(ids, vectors, **arrays)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('command', choices=['build'])
+    parser.add_argument('--images', default='static/images/fulls', help='Directory of the full-size images.')
+    parser.add_argument('--output', default=index_folder, help='Directory in which the index is saved.')
+    parser.add_argument('--lists', type=int, default=0,
+                        help='Number of lists of the coarse quantizer. 0 for an exact search, -1 for automatic.')
+    parser.add_argument('--workers', type=int, default=8, help='Number of threads decoding the images.')
+    args = parser.parse_args()
+    configure_logging()
+
+    try:
+        previous = SimilarityIndex.load(args.output)
+    except FileNotFoundError:
+        previous = None
+    index = SimilarityIndex.build(args.images, workers=args.workers, previous=previous)
+    if args.lists and len(index):
+        index.train_coarse(lists=None if args.lists < 0 else args.lists)
+    index.save(args.output)
+    print(f'{len(index)} images indexed')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+import logging
+
+from bisect import bisect_left
+from typing import List, Iterable, Set
+
+
+def trigrams(text: str) -> Set[str]:
+    """
+    Returns the set of the 3-characters substrings of a text.
+    """
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def intersect_sorted(a: List[int], b: List[int]) -> List[int]:
+    """
+    Intersects two sorted lists.
+    Iterates over the shortest one and gallops in the longest with a binary search,
+    so the cost depends on the size of the smallest list.
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    result = []
+    lo = 0
+    for value in a:
+        lo = bisect_left(b, value, lo)
+        if lo == len(b):
+            break
+        if b[lo] == value:
+            result.append(value)
+    return result
+
+
+class TagIndex:
+
+    """
+
+    Inverted index over the images' tags.
+
+    Each indexed document is given a number, in insertion order.
+    We keep, for each tag, the sorted list of the numbers of the documents
+    having this tag (its posting list), and for each trigram,
+    the set of tags containing it, which is used for substring lookups.
+
+    """
+
+    def __init__(self):
+        self._keys = []  # Document number -> key (the MongoDB `_id`).
+        self._numbers = {}  # Key -> document number.
+        self._tags = {}  # Document number -> its tags.
+        self._postings = {}  # Tag -> sorted list of document numbers.
+        self._trigrams = {}  # Trigram -> set of tags.
+
+    @classmethod
+    def from_collection(cls, collection) -> 'TagIndex':
+        """
+        Builds the index from all the documents of a collection.
+        Only the tags are fetched.
+        """
+        index = cls()
+        for document in collection.find({}, {'tags': 1}):
+            index.add(document['_id'], document.get('tags', []))
+        logging.info(f'Indexed the tags of {len(index)} documents')
+        return index
+
+    def __len__(self) -> int:
+        return len(self._numbers)
+
+    def add(self, key, tags: Iterable[str]) -> None:
+        """
+        Indexes the tags of a document.
+        If the document was already indexed, its tags are replaced.
+        """
+        if key in self._numbers:
+            self.remove(key)
+        number = len(self._keys)
+        self._keys.append(key)
+        self._numbers[key] = number
+        tags = set(tag for tag in tags if isinstance(tag, str))
+        self._tags[number] = tags
+        for tag in tags:
+            if tag not in self._postings:
+                self._postings[tag] = []
+                for trigram in trigrams(tag):
+                    self._trigrams.setdefault(trigram, set()).add(tag)
+            # Numbers are attributed in increasing order, so the list stays sorted.
+            self._postings[tag].append(number)
+
+    def remove(self, key) -> None:
+        """
+        Removes a document from the index.
+        """
+        number = self._numbers.pop(key, None)
+        if number is None:
+            return
+        for tag in self._tags.pop(number):
+            postings = self._postings[tag]
+            postings.pop(bisect_left(postings, number))
+            if not postings:
+                del self._postings[tag]
+                for trigram in trigrams(tag):
+                    self._trigrams[trigram].discard(tag)
+
+    def matching_tags(self, pattern: str) -> Set[str]:
+        """
+        Returns the indexed tags containing a pattern.
+        The pattern is a plain substring, searched anywhere in the tag.
+        """
+        grams = trigrams(pattern)
+        if not grams:
+            # Too short to have trigrams.
+            return {tag for tag in self._postings if pattern in tag}
+
+        candidates = None
+        for gram in sorted(grams, key=lambda g: len(self._trigrams.get(g, ()))):
+            tags = self._trigrams.get(gram)
+            if not tags:
+                return set()
+            candidates = set(tags) if candidates is None else candidates & tags
+            if not candidates:
+                return set()
+        # Having all the trigrams doesn't mean the tag contains the pattern.
+        return {tag for tag in candidates if pattern in tag}
+
+    def _numbers_matching(self, pattern: str) -> List[int]:
+        postings = [self._postings[tag] for tag in self.matching_tags(pattern)]
+        if len(postings) == 1:
+            return postings[0]
+        return sorted(set().union(*postings))
+
+    def match(self, patterns: List[str]) -> list:
+        """
+        Returns the keys of the documents having, for every pattern, a tag matching it.
+
+        :param list patterns: A list of patterns. An "and" operator is used.
+        :return list: The keys, in insertion order.
+        """
+        numbers = None
+        # Start with the most selective pattern, so that the intersections stay small.
+        for postings in sorted((self._numbers_matching(p) for p in patterns), key=len):
+            numbers = postings if numbers is None else intersect_sorted(numbers, postings)
+            if not numbers:
+                return []
+        if numbers is None:
+            return [self._keys[number] for number in sorted(self._tags)]
+        return [self._keys[number] for number in numbers]
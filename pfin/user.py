@@ -1,4 +1,6 @@
-from .utils import validate_fields
+from functools import wraps
+
+from .utils import compile_validator
 
 # Every user object should have this structure.
 user_structure = {
@@ -10,11 +12,16 @@ user_structure = {
 }
 
 
+validate_user = compile_validator(user_structure)
+
+
 def validate_info(func):
     """
     Decorator used to validate the user information passed.
     That way, we can be assured all users have exactly the same information.
+    The undecorated class is available as `__wrapped__`.
     """
+    @wraps(func, updated=())
     def wrapper(*args, **kwargs):
         if len(args) > 0:
             dictionary = args[0]
@@ -22,7 +29,7 @@ def validate_info(func):
             dictionary = kwargs['info']
         else:
             raise ValueError(f"Missing required argument 'info'. ({args}, {kwargs})")
-        nice_structure = validate_fields(dictionary, user_structure)
+        nice_structure = validate_user(dictionary)
         return func(nice_structure)
     return wrapper
 
@@ -2,72 +2,121 @@ import json
 import base64
 import logging
 
-from PIL import Image
 from io import BytesIO
 from hashlib import sha256
+from collections import Counter
+from typing import List, Callable
 
 from .config import SALT
 
 
-def validate_fields(dictionary: dict, struct: dict) -> dict:
+# Aggregated count of the mismatches found while validating documents,
+# keyed by `(kind, field)`, kind being any of {'missing', 'invalid', 'leftover'}.
+validation_counters = Counter()
+
+
+def _is_int(value) -> bool:
     """
-    Takes a dictionary and an architecture and checks if the types and structure are valid.
-    Corrects the dictionary if necessary. The output dict is valid.
+    Tests a value to check if it is an integer or not.
+    """
+    try:
+        int(value)
+    except (ValueError, TypeError):
+        return False
+    else:
+        return True
+
+
+def compile_validator(struct: dict) -> Callable[[dict, Counter], dict]:
+    """
+    Takes an architecture and returns a function specialized in validating it.
+    The returned function takes a dictionary, checks if the types and structure are valid,
+    and corrects the dictionary if necessary. The output dict is valid.
     Recursive only in dictionaries. All other types are not iterated through (e.g. lists).
+    Mismatches are counted in a `Counter` (by default, `validation_counters`) instead of being logged.
 
     Example arch: {"content": str, "meta": {"time_sent": int, "digest": str, "aes": str}}
 
-    :param dict dictionary: A dictionary to check.
     :param dict struct: Dictionary containing the levels of architecture.
     """
-
-    def is_int(value) -> bool:
-        """
-        Tests a value to check if it is an integer or not.
-        """
-        try:
-            int(value)
-        except ValueError:
-            return False
+    # Everything which only depends on the structure is computed once, here.
+    defaults = []
+    int_fields = []
+    nested = []
+    for key, struct_value in struct.items():
+        if isinstance(struct_value, dict):
+            nested_validator = compile_validator(struct_value)
+            defaults.append((key, lambda v=nested_validator: v({}, Counter())))
+            nested.append((key, nested_validator))
         else:
-            return True
+            # `struct_value` is a `type` object, we will create new instances as default values.
+            defaults.append((key, struct_value))
+            if struct_value is int:
+                int_fields.append(key)
+    struct_keys = frozenset(struct)
+    struct_length = len(struct)
+
+    def validator(dictionary: dict, counters: Counter = validation_counters) -> dict:
+        if not isinstance(dictionary, dict):
+            counters[('invalid', None)] += 1
+            return dictionary
+
+        missing = set()
+        for key, default in defaults:
+            if key not in dictionary:
+                dictionary[key] = default()
+                missing.add(key)
+                counters[('missing', key)] += 1
+        for key in int_fields:
+            if key not in missing and not _is_int(dictionary[key]):
+                dictionary[key] = 0
+                counters[('invalid', key)] += 1
+        for key, nested_validator in nested:
+            if key not in missing:
+                dictionary[key] = nested_validator(dictionary[key], counters)
+
+        if len(dictionary) != struct_length:
+            for key in dictionary.keys() - struct_keys:
+                counters[('leftover', key)] += 1
 
-    if not isinstance(dictionary, dict):
-        logging.error(f"Argument 'dictionary' needs to be a dict, is {type(dictionary)}: {dictionary}")
-        return dictionary
-    if not isinstance(struct, dict):
-        logging.error(f"Argument 'struct' needs to be a dict, is {type(struct)}: {struct}")
         return dictionary
 
-    for key, struct_value in struct.items():
-        if key not in dictionary:
-            if isinstance(struct_value, dict):
-                dictionary[key] = struct_value
-            else:
-                # `struct_value` is a `type` object
-                # We therefore create a new instance
-                dictionary[key] = struct_value()
-            continue
-        else:
-            dict_value = dictionary[key]
+    return validator
 
-        if isinstance(struct_value, type):
-            # If value is a type object, we want to check that the value from the dict is of this type.
-            if struct_value is int:
-                if not is_int(dict_value):
-                    logging.warning(f"Couldn't cast to int {key!r}: {dict_value!r}")
-                    dictionary[key] = 0
-        elif isinstance(struct_value, dict):
-            # If value is a dict, we want to call this function recursively.
-            dictionary[key] = validate_fields(dict_value, struct_value)
 
-    if len(dictionary) != len(struct):
-        difference = set(dictionary.keys()).symmetric_difference(set(struct.keys()))
-        logging.warning(f'Leftover fields in the dictionary: {difference}')
-        for dif in difference:
-            print(f"{dif}={dictionary[dif]}")
+def validate_batch(documents: List[dict], validator: Callable) -> List[dict]:
+    """
+    Validates a list of documents in one pass with a compiled validator.
+    Mismatches are aggregated, added to `validation_counters`,
+    and reported with a single log message.
+
+    :param list documents: The documents to validate. They are corrected in place.
+    :param validator: A function returned by `compile_validator`.
+    :return list: The documents.
+    """
+    counters = Counter()
+    for document in documents:
+        validator(document, counters)
+    if counters:
+        validation_counters.update(counters)
+        logging.warning(f'Mismatches found while validating {len(documents)} documents: '
+                        f'{", ".join(f"{kind} {key!r} x{count}" for (kind, key), count in counters.items())}')
+    return documents
+
+
+def validate_fields(dictionary: dict, struct: dict) -> dict:
+    """
+    Takes a dictionary and an architecture and checks if the types and structure are valid.
+    Corrects the dictionary if necessary. The output dict is valid.
+    Prefer `compile_validator` when validating many dictionaries against the same structure.
 
-    return dictionary
+    :param dict dictionary: A dictionary to check.
+    :param dict struct: Dictionary containing the levels of architecture.
+    """
+    if not isinstance(struct, dict):
+        logging.error(f"Argument 'struct' needs to be a dict, is {type(struct)}: {struct}")
+        return dictionary
+    return compile_validator(struct)(dictionary)
 
 
 def hash_password(password: str) -> str:
@@ -79,9 +128,22 @@ def hash_password(password: str) -> str:
     return h.hexdigest()
 
 
-def encode_base64(image: Image) -> str:
+def hash_file(path: str, chunk_size: int = 1 << 20) -> str:
+    """
+    Returns the SHA-256 of a file's content.
+    The file is streamed by chunks, so it is never entirely in memory.
+    """
+    h = sha256()
+    with open(path, 'rb') as fl:
+        for chunk in iter(lambda: fl.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def encode_base64(image: 'PIL.Image.Image') -> str:
     """
     Takes a PIL image and returns its base64 value.
+    Pillow isn't imported by this module: only the image's `save` method is used.
     """
     buffered = BytesIO()
     image.save(buffered, format="JPEG")